@@ -6,6 +6,7 @@ Tests system functionality and validates ESP32 connections
 
 import sys
 import os
+import json
 import requests
 import time
 import platform
@@ -142,6 +143,405 @@ def test_flask_app():
         print_status(f"Flask app error: {e}", "error")
         return False
 
+WORKER_SCRIPT = """
+import sys
+sys.path.insert(0, sys.argv[2])
+import app
+from werkzeug.serving import make_server
+app.ack_tracker.wheel.start()
+make_server('127.0.0.1', int(sys.argv[1]), app.app, threaded=True).serve_forever()
+"""
+
+def test_multi_worker_delivery(worker_count=3):
+    """Test command delivery across worker processes sharing the SQLite state backend"""
+    print_header("Multi-Worker Delivery Test")
+    
+    import shutil
+    import socket
+    import subprocess
+    import tempfile
+    import threading
+    
+    temp_dir = tempfile.mkdtemp(prefix="vending-workers-")
+    env = dict(os.environ, VENDING_STATE_BACKEND="sqlite", VENDING_ARCHIVE="0",
+               VENDING_STATE_DB=os.path.join(temp_dir, "state.db"))
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+    
+    ports = []
+    for _ in range(worker_count):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        ports.append(probe.getsockname()[1])
+        probe.close()
+    
+    workers = [subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT, str(port), src_dir], env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+               for port in ports]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    device_id = "ESP32_MULTI_WORKER_TEST"
+    
+    try:
+        # Wait for every worker to come up
+        deadline = time.time() + 15
+        for url in urls:
+            while True:
+                try:
+                    requests.get(f"{url}/status", timeout=1)
+                    break
+                except requests.exceptions.ConnectionError:
+                    if time.time() > deadline:
+                        print_status(f"Worker at {url} did not start", "error")
+                        return False
+                    time.sleep(0.1)
+        print_status(f"{worker_count} workers running on ports {ports}", "success")
+        
+        # Register on worker 1, vend on worker 2, poll on worker 3
+        requests.post(f"{urls[0]}/esp32/register", json={"device_id": device_id, "ip_address": "127.0.0.1"}, timeout=3)
+        vend = requests.post(f"{urls[1 % worker_count]}/vend/1", timeout=3).json()
+        if vend.get("device_id") != device_id:
+            print_status(f"Vend did not reach the device registered on another worker: {vend}", "error")
+            return False
+        command = requests.get(f"{urls[2 % worker_count]}/esp32/commands/{device_id}", timeout=3).json()
+        if not command or command.get("slot") != 1:
+            print_status(f"Poll on another worker got {command}", "error")
+            return False
+        if requests.get(f"{urls[0]}/esp32/commands/{device_id}", timeout=3).json() is not None:
+            print_status("Command was delivered twice", "error")
+            return False
+        print_status("Vend queued on one worker was delivered once by another", "success")
+        
+        # Long-poll on worker 3 is woken by a vend on worker 2
+        result = {}
+        def long_poll():
+            result["command"] = requests.get(f"{urls[2 % worker_count]}/esp32/commands/{device_id}?wait=5", timeout=10).json()
+            result["returned_at"] = time.time()
+        poller = threading.Thread(target=long_poll)
+        poller.start()
+        time.sleep(0.5)
+        queued_at = time.time()
+        requests.post(f"{urls[1 % worker_count]}/vend/2", timeout=3)
+        poller.join()
+        wake_ms = (result["returned_at"] - queued_at) * 1000
+        if not result.get("command") or result["command"].get("slot") != 2:
+            print_status(f"Long-poll got {result.get('command')}", "error")
+            return False
+        print_status(f"Long-poll woken across processes in {wake_ms:.0f} ms", "success")
+        
+        # Confirmations land on yet another worker and settle the shared history
+        for slot, command in ((1, command), (2, result["command"])):
+            requests.post(f"{urls[0]}/esp32/confirm", json={"device_id": device_id, "slot": slot, "success": True,
+                          "message": "ok", "command_id": command.get("command_id")}, timeout=3)
+        history = requests.get(f"{urls[1 % worker_count]}/esp32/commands/history", timeout=3).json()
+        statuses = [entry["status"] for entry in history["commands"] if entry["device_id"] == device_id]
+        if statuses != ["completed", "completed"]:
+            print_status(f"Shared command history shows {statuses}", "error")
+            return False
+        print_status("Confirmations recorded in the shared command history", "success")
+        return True
+        
+    except Exception as e:
+        print_status(f"Multi-worker test error: {e}", "error")
+        return False
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait(timeout=5)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def test_cluster_routing(node_count=3):
+    """Test device sharding across several local nodes: forwarding to the owner and minimal moves on membership changes"""
+    print_header("Cluster Routing Test")
+    
+    import socket
+    import subprocess
+    import threading
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+    from vending.sharding import HashRing, DEFAULT_FORWARD_TIMEOUT
+    
+    ports = []
+    for _ in range(node_count):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        ports.append(probe.getsockname()[1])
+        probe.close()
+    urls = {f"node{index}": f"http://127.0.0.1:{port}" for index, port in enumerate(ports)}
+    nodes_spec = ",".join(f"{node}={url}" for node, url in urls.items())
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+    
+    nodes = [subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT, str(port), src_dir],
+                              env=dict(os.environ, VENDING_ARCHIVE="0", VENDING_NODE_ID=node,
+                                       VENDING_CLUSTER_NODES=nodes_spec),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for (node, _url), port in zip(urls.items(), ports)]
+    device_id = "ESP32_CLUSTER_TEST"
+    
+    try:
+        deadline = time.time() + 15
+        for url in urls.values():
+            while True:
+                try:
+                    requests.get(f"{url}/status", timeout=1)
+                    break
+                except requests.exceptions.ConnectionError:
+                    if time.time() > deadline:
+                        print_status(f"Node at {url} did not start", "error")
+                        return False
+                    time.sleep(0.1)
+        print_status(f"{node_count} nodes running on ports {ports}", "success")
+        
+        owner = requests.get(f"{urls['node0']}/cluster?device_id={device_id}", timeout=3).json()["owner"]
+        others = [url for node, url in urls.items() if node != owner]
+        
+        # Register and vend through nodes that do not own the device, collect on the owner
+        requests.post(f"{others[0]}/esp32/register", json={"device_id": device_id, "ip_address": "127.0.0.1"}, timeout=5)
+        vend = requests.post(f"{others[-1]}/vend/1?device_id={device_id}", timeout=10)
+        if vend.headers.get("X-Vending-Node") != owner or vend.json().get("device_id") != device_id:
+            print_status(f"Vend on the wrong node was not handled by {owner}: {vend.status_code} {vend.text}", "error")
+            return False
+        command = requests.get(f"{urls[owner]}/esp32/commands/{device_id}", timeout=3).json()
+        if not command or command.get("slot") != 1:
+            print_status(f"Owner {owner} has {command} queued instead of the vend", "error")
+            return False
+        print_status(f"Vend sent to the wrong node reached the owner ({owner})", "success")
+        
+        # A forwarded long-poll may outlast the default forward timeout
+        wait = DEFAULT_FORWARD_TIMEOUT + 2
+        result = {}
+        def long_poll():
+            response = requests.get(f"{others[0]}/esp32/commands/{device_id}?wait={wait}", timeout=wait + 10)
+            result["status"] = response.status_code
+            result["command"] = response.json()
+        poller = threading.Thread(target=long_poll)
+        poller.start()
+        time.sleep(DEFAULT_FORWARD_TIMEOUT + 0.5)
+        requests.post(f"{urls[owner]}/vend/2?device_id={device_id}", timeout=5)
+        poller.join()
+        if result.get("status") != 200 or not result.get("command") or result["command"].get("slot") != 2:
+            print_status(f"Forwarded {wait:.0f}s long-poll got {result}", "error")
+            return False
+        print_status(f"Forwarded long-poll held for {DEFAULT_FORWARD_TIMEOUT + 0.5:.1f}s and got the vend", "success")
+        
+        # Membership change: only devices on the new node's arcs move, and all of them to it
+        device_ids = [f"ESP32_{index:05d}" for index in range(10000)]
+        ring = HashRing(urls)
+        before = {device: ring.node_for(device) for device in device_ids}
+        ring.add_node("node_new")
+        moved = [device for device in device_ids if ring.node_for(device) != before[device]]
+        expected = len(device_ids) / (len(urls) + 1)
+        if any(ring.node_for(device) != "node_new" for device in moved) or not 0.5 * expected < len(moved) < 1.5 * expected:
+            print_status(f"Adding a node moved {len(moved)} of {len(device_ids)} devices", "error")
+            return False
+        print_status(f"Adding a node moved {len(moved)} of {len(device_ids)} devices, all to the new node "
+                     f"(ideal {expected:.0f})", "success")
+        return True
+        
+    except Exception as e:
+        print_status(f"Cluster test error: {e}", "error")
+        return False
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait(timeout=5)
+
+def test_registration_storm(device_count=1000, concurrency=50):
+    """Test how fast a server absorbs a fleet re-registering at once (one by one, then via gateway batches)"""
+    print_header("Registration Storm Test")
+    
+    import socket
+    import subprocess
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "src")
+    env = dict(os.environ, VENDING_STATE_BACKEND="memory", VENDING_ARCHIVE="0")
+    worker = subprocess.Popen([sys.executable, "-c", WORKER_SCRIPT, str(port), src_dir], env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    devices = [{"device_id": f"ESP32_STORM_{i:05d}", "ip_address": f"10.{i // 65536}.{i // 256 % 256}.{i % 256}"}
+               for i in range(device_count)]
+    
+    try:
+        deadline = time.time() + 15
+        while True:
+            try:
+                requests.get(f"{url}/status", timeout=1)
+                break
+            except requests.exceptions.ConnectionError:
+                if time.time() > deadline:
+                    print_status("Test server did not start", "error")
+                    return False
+                time.sleep(0.1)
+        
+        # Every device registers on its own, as after a power blip
+        sessions = threading.local()
+        def register(device):
+            if not hasattr(sessions, "http"):
+                sessions.http = requests.Session()
+            return sessions.http.post(f"{url}/esp32/register", json=device, timeout=10).json()
+        
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(register, devices))
+        elapsed = time.perf_counter() - started
+        ok = sum(1 for result in results if result.get("success"))
+        if ok != device_count:
+            print_status(f"Only {ok}/{device_count} individual registrations succeeded", "error")
+            return False
+        spread = max(result["poll_delay_ms"] for result in results) / 1000
+        print_status(f"{device_count} individual registrations in {elapsed:.2f}s "
+                     f"({device_count / elapsed:.0f} devices/s, {concurrency} concurrent)", "success")
+        print_status(f"First polls spread over {spread:.1f}s, poll interval "
+                     f"{results[-1]['poll_interval_ms'] / 1000:.1f}s", "info")
+        
+        # The same fleet through a gateway, 250 devices per request
+        http = requests.Session()
+        started = time.perf_counter()
+        batch_ok = 0
+        for start in range(0, device_count, 250):
+            response = http.post(f"{url}/esp32/register/batch", json={"devices": devices[start:start + 250]},
+                                 timeout=30).json()
+            batch_ok += response.get("registered", 0)
+        elapsed = time.perf_counter() - started
+        if batch_ok != device_count:
+            print_status(f"Only {batch_ok}/{device_count} batch registrations succeeded", "error")
+            return False
+        print_status(f"{device_count} batch registrations in {elapsed:.2f}s ({device_count / elapsed:.0f} devices/s)",
+                     "success")
+        
+        listed = http.get(f"{url}/esp32/devices", timeout=10).json()["wifi_devices"]
+        log_lines = http.get(f"{url}/esp32/communication/log", timeout=10).json()["total_entries"]
+        if len(listed) != device_count:
+            print_status(f"Server lists {len(listed)} devices, expected {device_count}", "error")
+            return False
+        print_status(f"All devices listed; registrations coalesced into {log_lines} log lines", "success")
+        return True
+        
+    except Exception as e:
+        print_status(f"Registration storm test error: {e}", "error")
+        return False
+    finally:
+        worker.terminate()
+        worker.wait(timeout=5)
+
+def test_serial_burst(command_count=500):
+    """Test how fast a burst of queued commands reaches a (pty-emulated) USB ESP32 and its replies come back"""
+    print_header("Serial Burst Test")
+    
+    if not hasattr(os, "openpty"):
+        print_status("Pseudo-terminals are not available on this OS - skipping", "warning")
+        return True
+    
+    import contextlib
+    import io
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from esp32_serial import ESP32SerialCommunication
+    from esp32_serial_emulator import ESP32SerialEmulator
+    
+    link = f"/tmp/esp32_burst_{os.getpid()}"
+    emulator = ESP32SerialEmulator(link, boot_delay=0.05)
+    esp32 = None
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):  # Both sides print every line
+            emulator.start()
+            esp32 = ESP32SerialCommunication(port=link)
+            if not esp32.connect(link):
+                print_status("Could not connect to the emulator", "error")
+                return False
+            time.sleep(0.2)
+            while not esp32.response_queue.empty():
+                esp32.response_queue.get()
+            emulator.commands.clear()
+            
+            started = time.perf_counter()
+            for _ in range(command_count):
+                esp32.send_command("PING", wait_for_response=False)
+            while len(emulator.commands) < command_count and time.perf_counter() - started < 30:
+                time.sleep(0.001)
+            delivered = time.perf_counter() - started
+            replies = 0
+            try:
+                while replies < 2 * command_count:  # The emulator answers a PING with two lines
+                    esp32.response_queue.get(timeout=5)
+                    replies += 1
+            except Exception:
+                pass
+            answered = time.perf_counter() - started
+        
+        if len(emulator.commands) < command_count or replies < 2 * command_count:
+            print_status(f"Only {len(emulator.commands)}/{command_count} commands delivered, "
+                         f"{replies}/{2 * command_count} replies read", "error")
+            return False
+        stats = esp32.write_stats
+        print_status(f"{command_count} commands delivered in {delivered * 1000:.0f} ms "
+                     f"({command_count / delivered:.0f} commands/s) using {stats['writes']} writes", "success")
+        print_status(f"All {replies} replies read after {answered * 1000:.0f} ms", "success")
+        return True
+        
+    except Exception as e:
+        print_status(f"Serial burst test error: {e}", "error")
+        return False
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if esp32:
+                esp32.auto_reconnect = False
+                esp32.disconnect()
+            emulator.stop()
+
+def test_vend_schedule(entry_count=100000, near_count=20):
+    """Test that scheduled vends release on time while a large backlog of far-future entries waits"""
+    print_header("Vend Schedule Test")
+    
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+    from vending.vend_schedule import VendSchedule, RELEASED, MAX_BATCH
+    
+    released = []
+    schedule = VendSchedule(release=lambda entry: (released.append((entry.due_at, time.time())), {"status": RELEASED})[1],
+                            max_pending=entry_count + near_count)
+    try:
+        schedule.start()
+        far = time.time() + 3600
+        started = time.perf_counter()
+        batches = []
+        for first in range(0, entry_count, MAX_BATCH):
+            items = [(far + index, f"ESP32_{index % 500}", 1 + index % 5)
+                     for index in range(first, min(first + MAX_BATCH, entry_count))]
+            batches.append(schedule.add(items)[0].batch_id)
+        scheduled = time.perf_counter() - started
+        print_status(f"{entry_count} vends scheduled in {scheduled * 1000:.0f} ms "
+                     f"({scheduled / entry_count * 1e6:.1f} us each)", "success")
+        
+        now = time.time()
+        schedule.add([(now + 0.2 + index * 0.02, None, 1) for index in range(near_count)])
+        deadline = time.time() + 5
+        while len(released) < near_count and time.time() < deadline:
+            time.sleep(0.05)
+        if len(released) < near_count:
+            print_status(f"Only {len(released)}/{near_count} due vends were released", "error")
+            return False
+        lateness = max(fired - due for due, fired in released) * 1000
+        print_status(f"{near_count} due vends released, at most {lateness:.1f} ms late", "success")
+        
+        started = time.perf_counter()
+        records = [schedule.cancel_batch(batch_id) for batch_id in batches]
+        elapsed = time.perf_counter() - started
+        cancelled = sum(record["cancelled"] for record in records if record)
+        if cancelled != entry_count or len(schedule):
+            print_status(f"Cancelled {cancelled}/{entry_count}, {len(schedule)} still pending", "error")
+            return False
+        print_status(f"{cancelled} vends cancelled in {elapsed * 1000:.0f} ms", "success")
+        return True
+        
+    except Exception as e:
+        print_status(f"Vend schedule test error: {e}", "error")
+        return False
+    finally:
+        schedule.stop()
+
 def test_server_connection():
     """Test Server Connection"""
     print_header("Server Connection Test")
@@ -228,6 +628,166 @@ def test_system_requirements():
     print_status("All required files present", "success")
     return True
 
+BENCH_BASELINE = "bench_baseline.json"
+BENCH_THRESHOLD = 0.25  # Relative slowdown (p50 up or throughput down; p99 gets 2x) that counts as a regression
+
+def bench_cases(device_count=500):
+    """(name, method, path-or-factory, json-or-factory) for the hot endpoints"""
+    counter = iter(range(10 ** 9))
+    def registration():
+        i = next(counter) % device_count
+        return {"device_id": f"BENCH_REG_{i:05d}", "ip_address": f"10.9.{i // 256}.{i % 256}"}
+    return [
+        ("status", "GET", "/status", None),
+        ("vend", "POST", "/vend/1?device_id=BENCH_VEND", None),
+        ("poll", "GET", "/esp32/commands/BENCH_POLL", None),
+        ("register", "POST", "/esp32/register", registration),
+        ("communication_log", "GET", "/esp32/communication/log?limit=50", None),
+    ]
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def bench_client(url=None):
+    """call(method, path, json) -> status code, against a live server or the app in-process (+ the app module)"""
+    if url:
+        http = requests.Session()
+        def call(method, path, body):
+            return http.request(method, url.rstrip("/") + path, json=body, timeout=10).status_code
+        return call, "live", None
+    
+    # Isolated in-process app: memory state, no archive, nothing started in the background
+    os.environ.setdefault("VENDING_STATE_BACKEND", "memory")
+    os.environ.setdefault("VENDING_ARCHIVE", "0")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+    import app as vending_app
+    client = vending_app.app.test_client()
+    def call(method, path, body):
+        return client.open(path, method=method, json=body).status_code
+    return call, "in-process", vending_app
+
+def time_requests(send, count, measure_cpu=True):
+    """Call send() count times - send returns a status code, or a view's return value"""
+    latencies = []
+    errors = 0
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for _ in range(count):
+        t0 = time.perf_counter()
+        status = send()
+        latencies.append(time.perf_counter() - t0)
+        if isinstance(status, tuple):
+            status = status[1]  # (response, status) from a view
+        if getattr(status, "status_code", status) >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    
+    latencies.sort()
+    return {
+        "requests": count,
+        "rps": round(count / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        # Server CPU per request - only meaningful in-process (live, it is the client's)
+        "cpu_us": round(cpu / count * 1e6, 1) if measure_cpu else None,
+        "errors": errors
+    }
+
+def run_benchmarks(url=None, requests_per_case=1000, warmup=100):
+    """Warm up, then time each endpoint sequentially - {name: {requests, rps, p50_ms, p99_ms, cpu_us, errors}}"""
+    call, mode, vending_app = bench_client(url)
+    print_status(f"Benchmarking {mode}{' ' + url if url else ''}: {warmup} warm-up + "
+                 f"{requests_per_case} timed requests per endpoint", "info")
+    
+    results = {}
+    with open(os.devnull, "w") as quiet:
+        real_stdout = sys.stdout
+        sys.stdout = quiet  # The app logs every request - keep the report readable
+        try:
+            call("POST", "/esp32/register", {"device_id": "BENCH_VEND", "ip_address": "127.0.0.1"})
+            call("POST", "/esp32/register", {"device_id": "BENCH_POLL", "ip_address": "127.0.0.1"})
+            for name, method, path, body in bench_cases():
+                for _ in range(warmup):
+                    call(method, path, body() if callable(body) else body)
+                
+                results[name] = time_requests(lambda: call(method, path, body() if callable(body) else body),
+                                              requests_per_case, measure_cpu=not url)
+            
+            if vending_app is not None:
+                # The poll view alone, without the test client's per-request WSGI environ building
+                with vending_app.app.test_request_context("/esp32/commands/BENCH_POLL"):
+                    view = lambda: vending_app.esp32_get_commands("BENCH_POLL")
+                    for _ in range(warmup):
+                        view()
+                    results["poll_view"] = time_requests(view, requests_per_case)
+        finally:
+            sys.stdout = real_stdout
+    
+    for name, result in results.items():
+        print_status(f"{name:<18} {result['rps']:>9.1f} req/s   p50 {result['p50_ms']:>7.3f} ms   "
+                     f"p99 {result['p99_ms']:>7.3f} ms" +
+                     (f"   cpu {result['cpu_us']:>6.1f} us" if result["cpu_us"] is not None else "") +
+                     (f"   {result['errors']} errors" if result["errors"] else ""),
+                     "error" if result["errors"] else "success")
+    return {"mode": mode, "python": platform.python_version(), "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+def compare_benchmarks(current, baseline, threshold=BENCH_THRESHOLD):
+    """Print the change against a baseline - returns the names of endpoints that regressed"""
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            print_status(f"{name}: not in baseline", "info")
+            continue
+        # Slowdown per metric (positive = worse); the tail is noisier, so p99 gets twice the tolerance
+        slowdown = {
+            "p50": (result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0, threshold),
+            "p99": (result["p99_ms"] / before["p99_ms"] - 1 if before["p99_ms"] else 0, threshold * 2),
+            "rps": (1 - result["rps"] / before["rps"] if before["rps"] else 0, threshold)
+        }
+        slower = [metric for metric, (change, limit) in slowdown.items() if change > limit]
+        summary = (f"p50 {slowdown['p50'][0]:+.0%}, p99 {slowdown['p99'][0]:+.0%}, "
+                   f"throughput {-slowdown['rps'][0]:+.0%}")
+        if slower:
+            regressions.append(name)
+            print_status(f"{name}: REGRESSED ({summary})", "error")
+        else:
+            print_status(f"{name}: ok ({summary})", "success")
+    return regressions
+
+def run_bench_mode(args):
+    """--bench: measure, compare with the baseline, optionally save - exit status 1 on regression"""
+    print_header("Endpoint Benchmarks")
+    current = run_benchmarks(args.url, args.requests, args.warmup)
+    
+    # One baseline per mode - in-process and live numbers are not comparable
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(current["mode"])
+    
+    regressions = []
+    if baseline:
+        print_header(f"Comparison with {args.baseline} ({current['mode']}, {baseline.get('created', 'unknown date')})")
+        regressions = compare_benchmarks(current, baseline, args.threshold)
+    elif not args.save:
+        print_status(f"No {current['mode']} baseline in {args.baseline} - run with --save to record one", "info")
+    
+    if args.save:
+        baselines[current["mode"]] = current
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print_status(f"{current['mode'].capitalize()} baseline saved to {args.baseline}", "success")
+    
+    if regressions:
+        print_status(f"{len(regressions)} endpoint(s) slower than baseline by more than "
+                     f"{args.threshold:.0%}: {', '.join(regressions)}", "error")
+        return False
+    return True
+
 def run_comprehensive_test():
     """Run all system tests"""
     print_header("Flask Vending Machine - System Check")
@@ -238,6 +798,11 @@ def run_comprehensive_test():
         ("Python Environment", test_python_environment), 
         ("ESP32 Module", test_esp32_module),
         ("Flask Application", test_flask_app),
+        ("Multi-Worker Delivery", test_multi_worker_delivery),
+        ("Cluster Routing", test_cluster_routing),
+        ("Registration Storm", test_registration_storm),
+        ("Serial Burst", test_serial_burst),
+        ("Vend Schedule", test_vend_schedule),
         ("Server Connection", test_server_connection)
     ]
     
@@ -274,4 +839,18 @@ def run_comprehensive_test():
         print_status("💡 System will work in simulation mode without ESP32", "info")
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Flask vending machine system check")
+    parser.add_argument("--bench", action="store_true", help="Benchmark the hot endpoints instead of the system check")
+    parser.add_argument("--url", default=None, help="Benchmark a running server (default: the app in-process)")
+    parser.add_argument("--requests", type=int, default=1000, help="Timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=100, help="Untimed requests per endpoint first")
+    parser.add_argument("--baseline", default=BENCH_BASELINE, help="Baseline JSON to compare with / save to")
+    parser.add_argument("--save", action="store_true", help="Write this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=BENCH_THRESHOLD,
+                        help="Relative slowdown flagged as a regression (0.25 = 25%%)")
+    args = parser.parse_args()
+    
+    if args.bench:
+        sys.exit(0 if run_bench_mode(args) else 1)
     run_comprehensive_test()
\ No newline at end of file
@@ -8,21 +8,46 @@ import serial.tools.list_ports
 import threading
 import time
 import platform
-from queue import Queue
+import random
+from queue import Queue, Empty
+
+HANDSHAKE_TIMEOUT = 3.0       # Upper bound - the handshake returns as soon as the banner arrives
+HANDSHAKE_PROBE_AFTER = 0.5   # Send DISCOVER if the device is silent (already booted, no reset on open)
+HANDSHAKE_QUIET_WINDOW = 0.3  # Device answered but without a banner - accept once it goes quiet
+RECONNECT_BASE_DELAY = 0.25
+RECONNECT_MAX_DELAY = 10.0
+STATUS_CACHE_TTL = 5.0        # A STATUS answer this fresh is served without touching the link
+STATUS_QUERY_TIMEOUT = 3.0
+HANDLER_IDLE_WAIT = 0.05      # Handler waits this long for a command while the device is silent
+MAX_WRITE_BYTES = 4096        # One coalesced write carries at most this much - the rest goes out next pass
+MAX_LINES_PER_PASS = 64       # Replies read before the handler gets back to queued commands
 
 class ESP32SerialCommunication:
-    def __init__(self, port=None, baudrate=115200, log_callback=None):
+    def __init__(self, port=None, baudrate=115200, log_callback=None, command_queue=None, command_pacing=0.0):
         self.port = port
         self.baudrate = baudrate
         self.serial_connection = None
-        self.command_queue = Queue()
+        # Pass a priority queue (put(command, priority)) to send vends ahead of other traffic
+        self.command_queue = command_queue if command_queue is not None else Queue()
         self.response_queue = Queue()
+        # Everything queued goes out in one write; firmware that needs a gap between lines sets
+        # command_pacing (seconds) and gets one command per write instead
+        self.command_pacing = command_pacing
+        self.write_stats = {"writes": 0, "commands": 0, "bytes": 0, "largest_batch": 0}
         self.is_connected = False
         self.auto_reconnect = True
         self.connection_monitor_thread = None
         self.log_callback = log_callback  # Callback for logging communication
         self.device_id = None  # Will be set when connected
         self.device_info = {}  # Store device information
+        self.reconnecting = False
+        self.reconnect_count = 0
+        self._reconnect_lock = threading.Lock()
+        self.last_status = None          # Last STATUS: line, solicited or not
+        self.status_updated_at = None    # time.monotonic() of last_status
+        self._status_lock = threading.Lock()
+        self._status_inflight = None     # Event shared by every caller waiting on the STATUS on the wire
+        self.status_stats = {"cache_hits": 0, "queries": 0, "joined": 0, "unsolicited": 0, "timeouts": 0}
         
     def set_port(self, port):
         """Manually set the port"""
@@ -254,42 +279,13 @@ class ESP32SerialCommunication:
         # Disconnect if already connected
         if self.is_connected:
             self.disconnect()
+        
+        # An explicit connect re-arms supervision (disconnect() turns it off)
+        self.auto_reconnect = True
             
         try:
-            # Optimized serial settings with better error handling
-            self.serial_connection = serial.Serial(
-                port=self.port, 
-                baudrate=self.baudrate, 
-                timeout=1.0,  # Increased for better detection
-                write_timeout=1.0,
-                bytesize=serial.EIGHTBITS,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE
-            )
-            time.sleep(2)  # Give ESP32 time to respond
-            
-            # Verify it's our ESP32 vending machine
-            if self._verify_esp32_device():
-                self.is_connected = True
-                
-                # Set device ID for logging
-                self.device_id = f"serial_{self.port}"
-                self.device_info = {
-                    "device_id": self.device_id,
-                    "type": "serial",
-                    "port": self.port,
-                    "baudrate": self.baudrate,
-                    "status": "connected"
-                }
-                
-                # Start communication handler
-                threading.Thread(target=self._serial_handler, daemon=True).start()
-                
-                # Start connection monitor
-                if self.auto_reconnect:
-                    self.connection_monitor_thread = threading.Thread(target=self._connection_monitor, daemon=True)
-                    self.connection_monitor_thread.start()
-                
+            if self._open_and_verify():
+                self._start_session()
                 print(f"✅ Connected to ESP32 vending machine on {self.port}")
                 return True
             else:
@@ -317,52 +313,124 @@ class ESP32SerialCommunication:
             self.is_connected = False
             return False
     
+    def _open_and_verify(self):
+        """Open the port and run the handshake (no fixed boot delay)"""
+        # Optimized serial settings with better error handling
+        self.serial_connection = serial.Serial(
+            port=self.port, 
+            baudrate=self.baudrate, 
+            timeout=1.0,  # Increased for better detection
+            write_timeout=1.0,
+            bytesize=serial.EIGHTBITS,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE
+        )
+        
+        # Verify it's our ESP32 vending machine
+        return self._verify_esp32_device()
+    
+    def _start_session(self):
+        """Mark connected and start the reader/writer and supervisor threads"""
+        self.is_connected = True
+        
+        # Set device ID for logging
+        self.device_id = f"serial_{self.port}"
+        self.device_info.update({
+            "device_id": self.device_id,
+            "type": "serial",
+            "port": self.port,
+            "baudrate": self.baudrate,
+            "status": "connected",
+            "reconnects": self.reconnect_count
+        })
+        
+        # Start communication handler
+        threading.Thread(target=self._serial_handler, daemon=True).start()
+        
+        # Start connection monitor
+        if self.auto_reconnect and not (self.connection_monitor_thread and self.connection_monitor_thread.is_alive()):
+            self.connection_monitor_thread = threading.Thread(target=self._connection_monitor, daemon=True)
+            self.connection_monitor_thread.start()
+    
     def _connection_monitor(self):
-        """Monitor connection and update status"""
-        while self.auto_reconnect and self.is_connected:
+        """Monitor connection and hand dropped ports to the reconnect loop"""
+        while self.auto_reconnect:
             try:
-                if self.serial_connection and not self.serial_connection.is_open:
+                if self.is_connected and self.serial_connection and not self.serial_connection.is_open:
                     print("⚠️ Serial connection lost, marking as disconnected")
-                    self.is_connected = False
-                    break
-                time.sleep(5)  # Check every 5 seconds
+                    self._connection_lost()
+                time.sleep(1)  # Check every second
             except Exception as e:
                 print(f"⚠️ Connection monitor error: {e}")
-                self.is_connected = False
-                break
+                self._connection_lost()
+                time.sleep(1)
+    
+    def _connection_lost(self):
+        """Port dropped - mark disconnected and start the supervised reconnect loop"""
+        self.is_connected = False
+        self.device_info["status"] = "reconnecting" if self.auto_reconnect else "disconnected"
+        self._clear_status()
+        
+        if self.serial_connection:
+            try:
+                self.serial_connection.close()
+            except Exception:
+                pass
+        
+        if not self.auto_reconnect:
+            return
+        
+        with self._reconnect_lock:
+            if self.reconnecting:
+                return
+            self.reconnecting = True
+        
+        if self.log_callback:
+            self.log_callback("error", f"Serial connection to {self.port} lost - reconnecting", "error",
+                              device_id=self.device_id, device_type="serial")
+        threading.Thread(target=self._reconnect_loop, daemon=True).start()
+    
+    def _reconnect_delay(self, attempt):
+        """Exponential backoff with jitter so several hosts don't retry in lockstep"""
+        ceiling = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+    
+    def _reconnect_loop(self):
+        """Reopen the same port until the device is back (or supervision is switched off)"""
+        attempt = 0
+        started = time.time()
+        try:
+            while self.auto_reconnect and not self.is_connected:
+                time.sleep(self._reconnect_delay(attempt))
+                if not self.auto_reconnect:
+                    break
+                
+                try:
+                    if self._open_and_verify():
+                        self.reconnect_count += 1
+                        self._start_session()
+                        elapsed = time.time() - started
+                        print(f"🔄 Reconnected to ESP32 on {self.port} after {elapsed:.2f}s ({attempt + 1} attempts)")
+                        if self.log_callback:
+                            self.log_callback("received", f"Serial reconnected after {elapsed:.2f}s", "success",
+                                              device_id=self.device_id, device_type="serial")
+                        return
+                    if self.serial_connection:
+                        self.serial_connection.close()
+                except Exception:
+                    pass  # Port not back yet (unplugged, re-enumerating, busy)
+                
+                attempt += 1
+        finally:
+            self.reconnecting = False
     
     def _verify_esp32_device(self):
         """Verify the connected device is an ESP32 (more lenient check)"""
         try:
-            # Clear any existing data in buffer
-            self.serial_connection.reset_input_buffer()
-            time.sleep(0.1)
-            
-            # Send simple AT command (most ESP32s respond to this)
-            self.serial_connection.write(b"AT\n")
-            self.serial_connection.flush()
-            
-            # Wait for any response
-            start_time = time.time()
-            responses = []
-            
-            while time.time() - start_time < 3:  # 3 second timeout
-                if self.serial_connection.in_waiting:
-                    try:
-                        response = self.serial_connection.readline().decode('utf-8', errors='ignore').strip()
-                        if response:
-                            responses.append(response)
-                            print(f"📡 Received: {response}")
-                    except:
-                        # Handle any decoding errors
-                        raw_response = self.serial_connection.readline()
-                        responses.append(f"[Raw: {raw_response}]")
-                        print(f"📡 Received raw: {raw_response}")
-                
-                time.sleep(0.1)
+            ok, responses = self._handshake()
             
             # If we got any response, consider it a valid ESP32
-            if responses:
+            if ok:
                 print(f"✅ ESP32 device detected (responses: {len(responses)})")
                 return True
             
@@ -384,18 +452,87 @@ class ESP32SerialCommunication:
             # Allow connection even if verification fails
             return True
     
+    def _handshake(self, timeout=HANDSHAKE_TIMEOUT):
+        """Read the boot banner - returns (ok, lines) as soon as DEVICE_ID:/ready is seen"""
+        conn = self.serial_connection
+        original_timeout = conn.timeout
+        conn.timeout = 0.05  # Short reads so the loop can react the moment a line arrives
+        
+        start = time.monotonic()
+        deadline = start + timeout
+        probed = False
+        responses = []
+        last_line_at = None
+        pending = b""
+        
+        try:
+            while time.monotonic() < deadline:
+                chunk = conn.readline()
+                now = time.monotonic()
+                
+                if chunk:
+                    pending += chunk
+                    if not pending.endswith(b"\n"):
+                        continue  # Partial line - keep reading
+                    line = pending.decode('utf-8', errors='ignore').strip()
+                    pending = b""
+                    if not line:
+                        continue
+                    
+                    responses.append(line)
+                    last_line_at = now
+                    print(f"📡 Received: {line}")
+                    
+                    if "STATUS:" in line.upper():
+                        self._record_status(line)
+                    if "DEVICE_ID:" in line:
+                        self.device_info["hardware_id"] = line.split("DEVICE_ID:", 1)[1].strip()
+                        return True, responses
+                    if "ready" in line.lower():
+                        return True, responses
+                    continue
+                
+                if last_line_at is not None and now - last_line_at >= HANDSHAKE_QUIET_WINDOW:
+                    return True, responses  # Talked, but not our banner format
+                
+                if not probed and not responses and now - start >= HANDSHAKE_PROBE_AFTER:
+                    # Already running (no reset on open) - ask it to identify itself
+                    conn.write(b"DISCOVER\n")
+                    conn.flush()
+                    probed = True
+            
+            return bool(responses), responses
+        finally:
+            conn.timeout = original_timeout
+    
+    def _enqueue(self, command, priority):
+        """Queue a line for the handler - priority only matters with a priority queue"""
+        if isinstance(self.command_queue, Queue):
+            self.command_queue.put(command)
+        else:
+            self.command_queue.put(command, priority)
+    
     def send_vend_command(self, slot_id):
-        """Send vend command to ESP32"""
+        """Send vend command to ESP32 - returns the queued line (a handle for withdraw()) or False"""
         if self.is_connected:
             command = f"VEND:{slot_id}\n"
-            self.command_queue.put(command)
+            self._enqueue(command, "vend")
             print(f"📤 Queued command: {command.strip()}")
-            return True
+            return command
         else:
             print(f"❌ Not connected to ESP32")
             return False
     
-    def send_command(self, command, wait_for_response=True, timeout=5):
+    def withdraw(self, command):
+        """Drop a line from send_vend_command() the writer hasn't sent yet - True if it was still queued
+
+        Matched by identity, so an equal line from another vend of the same slot stays queued.
+        """
+        if not hasattr(self.command_queue, "remove"):
+            return False
+        return self.command_queue.remove(lambda queued: queued is command) > 0
+    
+    def send_command(self, command, wait_for_response=True, timeout=5, priority="operator"):
         """Send any command to ESP32 and optionally wait for response"""
         if not self.is_connected or not self.serial_connection or not self.serial_connection.is_open:
             print("❌ ESP32 not connected")
@@ -406,7 +543,7 @@ class ESP32SerialCommunication:
             if not command.endswith('\n'):
                 command += '\n'
                 
-            self.command_queue.put(command)
+            self._enqueue(command, priority)
             
             if wait_for_response:
                 try:
@@ -424,68 +561,162 @@ class ESP32SerialCommunication:
             self.is_connected = False
             return None
     
-    def get_status(self):
-        """Get ESP32 status"""
-        return self.send_command("STATUS", wait_for_response=True, timeout=3)
+    def _record_status(self, line):
+        """Cache a STATUS: line and release everyone waiting on the in-flight query"""
+        with self._status_lock:
+            self.last_status = line
+            self.status_updated_at = time.monotonic()
+            waiting, self._status_inflight = self._status_inflight, None
+            if waiting is None:
+                self.status_stats["unsolicited"] += 1
+        if waiting is not None:
+            waiting.set()
+    
+    def _clear_status(self):
+        with self._status_lock:
+            self.last_status = None
+            self.status_updated_at = None
+    
+    def cached_status(self, max_age=STATUS_CACHE_TTL):
+        """Last STATUS line if younger than max_age, else None - never touches the device"""
+        updated_at = self.status_updated_at
+        if updated_at is None or time.monotonic() - updated_at > max_age:
+            return None
+        return self.last_status
+    
+    def status_age(self):
+        updated_at = self.status_updated_at
+        return None if updated_at is None else time.monotonic() - updated_at
+    
+    def get_status(self, max_age=STATUS_CACHE_TTL, timeout=STATUS_QUERY_TIMEOUT):
+        """Get ESP32 status - cached when fresh; concurrent callers share one STATUS query"""
+        status = self.cached_status(max_age)
+        if status is not None:
+            self.status_stats["cache_hits"] += 1
+            return status
+        if not self.is_connected:
+            return None
+        
+        with self._status_lock:
+            waiting = self._status_inflight
+            leader = waiting is None
+            if leader:
+                waiting = self._status_inflight = threading.Event()
+                self.status_stats["queries"] += 1
+            else:
+                self.status_stats["joined"] += 1
+        
+        if leader:
+            self._enqueue("STATUS\n", "diagnostic")
+        
+        if not waiting.wait(timeout):
+            with self._status_lock:
+                if self._status_inflight is waiting:
+                    self._status_inflight = None  # Let the next caller ask again
+                    self.status_stats["timeouts"] += 1
+            print("⏰ Timeout waiting for STATUS")
+            return None
+        return self.last_status
+    
+    def _take_commands(self, wait):
+        """Commands to send in one write - everything queued right now (in dispatch order), or one when pacing"""
+        commands = []
+        size = 0
+        try:
+            command = self.command_queue.get(timeout=wait) if wait > 0 else self.command_queue.get_nowait()
+            while True:
+                commands.append(command)
+                size += len(command)
+                if self.command_pacing or size >= MAX_WRITE_BYTES:
+                    break
+                command = self.command_queue.get_nowait()
+        except Empty:
+            pass
+        return commands
+    
+    def _write_commands(self, commands):
+        data = "".join(commands).encode()
+        self.serial_connection.write(data)
+        self.serial_connection.flush()  # Force immediate send - one flush per batch
+        
+        self.write_stats["writes"] += 1
+        self.write_stats["commands"] += len(commands)
+        self.write_stats["bytes"] += len(data)
+        self.write_stats["largest_batch"] = max(self.write_stats["largest_batch"], len(commands))
+        for command in commands:
+            print(f"📡 [SENT] {command.strip()}")
+            
+            # Log to callback if available
+            if self.log_callback:
+                self.log_callback("sent", command.strip(), "command", 
+                                device_id=self.device_id, device_type="serial")
+    
+    def _handle_response(self, response):
+        print(f"📨 [RECV] {response}")
+        
+        # Determine message type for logging
+        response_upper = response.upper()
+        if "STATUS:" in response_upper:
+            self._record_status(response)
+        msg_type = "info"
+        if "VEND" in response_upper:
+            print(f"🏪 [VEND] Vending response: {response}")
+            msg_type = "vend"
+        elif "STATUS" in response_upper:
+            print(f"📊 [STATUS] Device status: {response}")
+            msg_type = "status"
+        elif "DISCOVER" in response_upper or "ESP32" in response_upper:
+            print(f"🔍 [DISCOVERY] Device info: {response}")
+            msg_type = "discovery"
+        elif "ERROR" in response_upper:
+            print(f"❌ [ERROR] ESP32 error: {response}")
+            msg_type = "error"
+        elif "SUCCESS" in response_upper or "OK" in response_upper:
+            print(f"✅ [SUCCESS] Command completed: {response}")
+            msg_type = "success"
+        else:
+            print(f"💬 [INFO] ESP32 message: {response}")
+            msg_type = "info"
+        
+        # Log to callback if available
+        if self.log_callback:
+            self.log_callback("received", response, msg_type,
+                            device_id=self.device_id, device_type="serial")
+            
+        self.response_queue.put(response)
     
     def _serial_handler(self):
         """Background thread to handle serial communication with enhanced logging"""
+        next_write_at = 0.0  # Pacing: earliest time the next command may go out
         while self.is_connected:
             try:
-                # Send queued commands with immediate processing
-                if not self.command_queue.empty():
-                    command = self.command_queue.get()
-                    self.serial_connection.write(command.encode())
-                    self.serial_connection.flush()  # Force immediate send
-                    print(f"📡 [SENT] {command.strip()}")
-                    
-                    # Log to callback if available
-                    if self.log_callback:
-                        self.log_callback("sent", command.strip(), "command", 
-                                        device_id=self.device_id, device_type="serial")
+                # Send everything queued in one write; wait for commands only while the device is silent
+                device_waiting = self.serial_connection.in_waiting
+                delay = next_write_at - time.monotonic()
+                if delay <= 0:
+                    commands = self._take_commands(0 if device_waiting else HANDLER_IDLE_WAIT)
+                    if commands:
+                        self._write_commands(commands)
+                        if self.command_pacing:
+                            next_write_at = time.monotonic() + self.command_pacing
+                elif not device_waiting:
+                    time.sleep(min(delay, HANDLER_IDLE_WAIT))
                 
-                # Read responses with faster polling and detailed logging
-                if self.serial_connection.in_waiting:
+                # Read every complete response waiting (bounded, so queued commands are not starved)
+                for _ in range(MAX_LINES_PER_PASS):
+                    if not self.serial_connection.in_waiting:
+                        break
                     response = self.serial_connection.readline().decode().strip()
                     if response:
-                        print(f"📨 [RECV] {response}")
-                        
-                        # Determine message type for logging
-                        response_upper = response.upper()
-                        msg_type = "info"
-                        if "VEND" in response_upper:
-                            print(f"🏪 [VEND] Vending response: {response}")
-                            msg_type = "vend"
-                        elif "STATUS" in response_upper:
-                            print(f"📊 [STATUS] Device status: {response}")
-                            msg_type = "status"
-                        elif "DISCOVER" in response_upper or "ESP32" in response_upper:
-                            print(f"🔍 [DISCOVERY] Device info: {response}")
-                            msg_type = "discovery"
-                        elif "ERROR" in response_upper:
-                            print(f"❌ [ERROR] ESP32 error: {response}")
-                            msg_type = "error"
-                        elif "SUCCESS" in response_upper or "OK" in response_upper:
-                            print(f"✅ [SUCCESS] Command completed: {response}")
-                            msg_type = "success"
-                        else:
-                            print(f"💬 [INFO] ESP32 message: {response}")
-                            msg_type = "info"
-                        
-                        # Log to callback if available
-                        if self.log_callback:
-                            self.log_callback("received", response, msg_type,
-                                            device_id=self.device_id, device_type="serial")
-                            
-                        self.response_queue.put(response)
-                
-                time.sleep(0.05)  # Faster polling for better responsiveness
+                        self._handle_response(response)
                 
             except Exception as e:
+                if not self.is_connected:
+                    break  # Port closed by disconnect() while we were reading
                 print(f"❌ [ERROR] Serial communication error: {e}")
                 if self.log_callback:
                     self.log_callback("error", f"Serial communication error: {e}", "error")
-                self.is_connected = False
+                self._connection_lost()
                 break
     
     def disconnect(self):
@@ -501,6 +732,7 @@ class ESP32SerialCommunication:
                 print(f"⚠️ Error during disconnect: {e}")
         
         # Clear queues
+        self._clear_status()
         while not self.command_queue.empty():
             self.command_queue.get()
         while not self.response_queue.empty():
@@ -510,7 +742,6 @@ class ESP32SerialCommunication:
         """Attempt to reconnect"""
         print("🔄 Attempting to reconnect...")
         self.disconnect()
-        time.sleep(1)
         return self.connect()
 
 # Add this to your Flask app.py
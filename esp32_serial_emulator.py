@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+USB Serial ESP32 Emulator
+Pseudo-terminal stand-in for esp32_mock_vend.ino (Linux/macOS only)
+"""
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+class ESP32SerialEmulator:
+    def __init__(self, link_path="/tmp/esp32_emulator", boot_delay=0.3, vend_time=0.0,
+                 device_id="ESP32_USB_EMULATOR"):
+        self.link_path = link_path  # Stable path that survives "reboots" (new pty each time)
+        self.boot_delay = boot_delay
+        self.vend_time = vend_time
+        self.device_id = device_id
+        self.master_fd = None
+        self.slave_fd = None
+        self.slave_name = None
+        self.running = False
+        self.thread = None
+        self.commands = []  # (timestamp, command) for every line received
+        self.write_lock = threading.Lock()
+
+    def start(self):
+        """Create the pty, publish it at link_path and boot"""
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)  # No echo/line editing - behave like a UART
+        self.slave_name = os.ttyname(self.slave_fd)
+
+        if self.link_path:
+            try:
+                os.unlink(self.link_path)
+            except FileNotFoundError:
+                pass
+            os.symlink(self.slave_name, self.link_path)
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"🔌 ESP32 emulator on {self.link_path or self.slave_name} ({self.slave_name})")
+        return self.link_path or self.slave_name
+
+    def stop(self):
+        """Unplug - the host sees I/O errors on the port"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master_fd = self.slave_fd = None
+        if self.link_path:
+            try:
+                os.unlink(self.link_path)
+            except FileNotFoundError:
+                pass
+
+    def reboot(self, down_time=0.5):
+        """Unplug, stay away for down_time seconds, then come back on a new pty"""
+        self.stop()
+        time.sleep(down_time)
+        return self.start()
+
+    def send(self, line):
+        with self.write_lock:
+            if self.master_fd is not None:
+                os.write(self.master_fd, (line + "\r\n").encode())
+
+    def _banner(self):
+        time.sleep(self.boot_delay)
+        if not self.running:
+            return
+        self.send("========================================")
+        self.send("ESP32 USB Serial Vending Machine v1.1")
+        self.send("DEVICE_ID:" + self.device_id)
+        self.send("DEVICE_TYPE:VENDING_MACHINE")
+        self.send("FIRMWARE_VERSION:1.1")
+        self.send("SLOTS_AVAILABLE:5")
+        self.send("✅ System ready!")
+
+    def _handle(self, command):
+        self.commands.append((time.time(), command))
+
+        if command.startswith("VEND:"):
+            try:
+                slot = int(command[5:])
+            except ValueError:
+                slot = 0
+            if not 1 <= slot <= 5:
+                self.send("❌ Error: Invalid slot number. Must be 1-5")
+                return
+            self.send(f"🎯 Vending from slot {slot}...")
+            if self.vend_time:
+                time.sleep(self.vend_time)
+            self.send(f"✅ VEND_SUCCESS:{slot}")
+        elif command == "DISCOVER":
+            self.send("DEVICE_RESPONSE:ESP32_USB_VENDING")
+            self.send("DEVICE_ID:" + self.device_id)
+            self.send("STATUS:READY")
+        elif command in ("STATUS", "PING"):
+            self.send("✅ STATUS:ONLINE")
+            self.send("📊 SLOTS:5")
+        else:
+            self.send(f"❌ Error: Unknown command '{command}'")
+
+    def _run(self):
+        self._banner()
+        buffer = b""
+        while self.running:
+            try:
+                ready, _, _ = select.select([self.master_fd], [], [], 0.05)
+                if not ready:
+                    continue
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                time.sleep(0.05)  # Host side not open yet
+                continue
+
+            buffer += data
+            while b"\n" in buffer:
+                raw, buffer = buffer.split(b"\n", 1)
+                command = raw.decode("utf-8", errors="ignore").strip()
+                if command:
+                    self._handle(command)
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate a USB serial vending ESP32 on a pty")
+    parser.add_argument("--link", default="/tmp/esp32_emulator", help="Symlink to the pty")
+    parser.add_argument("--boot-delay", type=float, default=0.3)
+    parser.add_argument("--vend-time", type=float, default=0.0, help="Simulated motor time per vend")
+    args = parser.parse_args()
+
+    emulator = ESP32SerialEmulator(args.link, args.boot_delay, args.vend_time)
+    emulator.start()
+    print("🛑 Press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+WiFi ESP32 Stand-in
+Simulates one or many WiFi vending ESP32s for testing without hardware
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from vending.heartbeat import encode_heartbeat, HEARTBEAT_PORT
+
+DISCOVERY_PORT = 12346
+
+class _CommandHandler(BaseHTTPRequestHandler):
+    """POST /command - the push endpoint a WiFi ESP32 can expose"""
+    protocol_version = "HTTP/1.1"  # Keep-alive, so the server's connection pool is exercised
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        device = self.server.device
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            command = json.loads(self.rfile.read(length) or b"null")
+        except ValueError:
+            command = None
+
+        if self.path != device.command_path or not isinstance(command, dict):
+            self._reply(400, {"accepted": False})
+            return
+
+        device.handle_command(command)
+        self._reply(200, {"accepted": True, "device_id": device.device_id})
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # Keep simulator output readable
+
+class SimulatedWiFiDevice:
+    def __init__(self, device_id, server_host="127.0.0.1", http_port=5000,
+                 heartbeat_port=HEARTBEAT_PORT, ip_address="127.0.0.1"):
+        self.device_id = device_id
+        self.server_host = server_host
+        self.http_port = http_port
+        self.heartbeat_port = heartbeat_port
+        self.ip_address = ip_address
+        self.sequence = 0
+        self.status = 0  # 0 = ready (see HEARTBEAT_STATUS)
+        self.http = requests.Session()  # Keep-alive, like the firmware's HTTPClient reuse
+        self.command_server = None
+        self.command_path = "/command"
+        self.received_commands = []
+        self.auto_confirm = True
+        self.vend_time = 0.0  # Simulated motor run time before confirming
+        self.poll_delay = 0.0     # Registration hints: wait this long before the first poll...
+        self.poll_interval = 2.0  # ...then poll this often
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_host}:{self.http_port}"
+
+    def discover(self, broadcast_address="255.255.255.255", timeout=2.0):
+        """Find the Flask server the same way the firmware does"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(b"ESP32_DISCOVERY_REQUEST", (broadcast_address, DISCOVERY_PORT))
+            data, _addr = sock.recvfrom(128)
+            response = data.decode()
+            if response.startswith("FLASK_SERVER:"):
+                self.server_host = response.split(":", 1)[1]
+                print(f"✅ {self.device_id}: Flask server found at {self.server_host}")
+                return self.server_host
+        except socket.timeout:
+            print(f"⏰ {self.device_id}: No discovery response")
+        finally:
+            sock.close()
+        return None
+
+    def registration_payload(self):
+        payload = {
+            "device_id": self.device_id,
+            "ip_address": self.ip_address,
+            "status": "online",
+            "slots_available": 5
+        }
+        if self.command_server:
+            payload["command_port"] = self.command_server.server_address[1]
+            payload["command_path"] = self.command_path
+        return payload
+
+    def apply_registration(self, result):
+        """Take the poll hints from a registration result"""
+        self.sequence = 0
+        if result.get("success"):
+            self.poll_delay = result.get("poll_delay_ms", 0) / 1000
+            self.poll_interval = result.get("poll_interval_ms", 2000) / 1000
+        return result
+
+    def register(self):
+        """POST /esp32/register (advertising the push endpoint if one is running)"""
+        response = self.http.post(f"{self.base_url}/esp32/register", json=self.registration_payload(), timeout=5)
+        return self.apply_registration(response.json())
+
+    def start_command_server(self, port=0, host="127.0.0.1"):
+        """Expose POST /command so the server can push commands (port 0 = any free port)"""
+        self.command_server = ThreadingHTTPServer((host, port), _CommandHandler)
+        self.command_server.daemon_threads = True
+        self.command_server.device = self
+        threading.Thread(target=self.command_server.serve_forever, daemon=True).start()
+        print(f"🔌 {self.device_id}: command endpoint on http://{host}:{self.command_server.server_address[1]}{self.command_path}")
+        return self.command_server.server_address[1]
+
+    def stop_command_server(self):
+        if self.command_server:
+            self.command_server.shutdown()
+            self.command_server.server_close()
+            self.command_server = None
+
+    def poll(self):
+        """GET /esp32/commands/<device_id> - returns the command or None"""
+        response = self.http.get(f"{self.base_url}/esp32/commands/{self.device_id}", timeout=5)
+        command = response.json()
+        if command:
+            self.handle_command(command)
+        return command
+
+    def handle_command(self, command):
+        """Record a command (pushed or polled) and confirm it like the firmware would"""
+        command["received_at"] = time.time()
+        self.received_commands.append(command)
+        print(f"📨 {self.device_id}: {command.get('command')}:{command.get('slot')}")
+        if self.auto_confirm and command.get("command") == "VEND":
+            threading.Thread(target=self.confirm, args=(command.get("slot"), True), daemon=True).start()
+
+    def confirm(self, slot, success, message=None):
+        """POST /esp32/confirm"""
+        if self.vend_time:
+            time.sleep(self.vend_time)
+        try:
+            self.http.post(f"{self.base_url}/esp32/confirm", json={
+                "device_id": self.device_id,
+                "slot": slot,
+                "success": success,
+                "message": message or (f"Slot {slot} dispensed" if success else f"Slot {slot} failed")
+            }, timeout=5)
+        except requests.exceptions.RequestException as e:
+            print(f"❌ {self.device_id}: confirm failed: {e}")
+
+    def heartbeat_packet(self):
+        """Next heartbeat datagram for this device"""
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return encode_heartbeat(self.device_id, self.sequence, self.status)
+
+    def send_heartbeat(self, sock=None):
+        """Send one heartbeat (optionally on a shared socket)"""
+        packet = self.heartbeat_packet()
+        own_socket = sock is None
+        if own_socket:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(packet, (self.server_host, self.heartbeat_port))
+        finally:
+            if own_socket:
+                sock.close()
+
+class SimulatedFleet:
+    """Many stand-in devices sharing one UDP socket"""
+
+    def __init__(self, count, server_host="127.0.0.1", http_port=5000,
+                 heartbeat_port=HEARTBEAT_PORT, prefix="ESP32_SIM_"):
+        self.devices = [
+            SimulatedWiFiDevice(f"{prefix}{i:05d}", server_host, http_port, heartbeat_port)
+            for i in range(count)
+        ]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def register_all(self):
+        ok = 0
+        for device in self.devices:
+            try:
+                if device.register().get("success"):
+                    ok += 1
+            except requests.exceptions.RequestException as e:
+                print(f"❌ {device.device_id}: registration failed: {e}")
+        return ok
+
+    def register_batch(self, batch_size=250):
+        """Register through POST /esp32/register/batch, like a gateway would"""
+        ok = 0
+        http = self.devices[0].http if self.devices else requests.Session()
+        for start in range(0, len(self.devices), batch_size):
+            batch = self.devices[start:start + batch_size]
+            try:
+                response = http.post(f"{batch[0].base_url}/esp32/register/batch",
+                                     json={"devices": [device.registration_payload() for device in batch]}, timeout=30)
+                results = response.json().get("results", [])
+            except requests.exceptions.RequestException as e:
+                print(f"❌ Batch registration failed: {e}")
+                continue
+            for device, result in zip(batch, results):
+                if device.apply_registration(result or {}).get("success"):
+                    ok += 1
+        return ok
+
+    def heartbeat_round(self, spread=0.0, batch_size=100):
+        """One heartbeat from every device, optionally spread over `spread` seconds"""
+        batches = max(1, (len(self.devices) + batch_size - 1) // batch_size)
+        pause = spread / batches
+        for start in range(0, len(self.devices), batch_size):
+            for device in self.devices[start:start + batch_size]:
+                device.send_heartbeat(self.sock)
+            if pause:
+                time.sleep(pause)
+        return len(self.devices)
+
+    def run(self, interval=5.0, duration=30.0):
+        sent = 0
+        end_time = time.time() + duration
+        while time.time() < end_time:
+            started = time.time()
+            # Real devices are not phase-locked, so spread each round over most of the interval
+            sent += self.heartbeat_round(spread=interval * 0.8)
+            time.sleep(max(0.0, interval - (time.time() - started)))
+        return sent
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate WiFi vending ESP32s")
+    parser.add_argument("--server", default=None, help="Flask server host (default: UDP discovery)")
+    parser.add_argument("--http-port", type=int, default=5000)
+    parser.add_argument("--heartbeat-port", type=int, default=HEARTBEAT_PORT)
+    parser.add_argument("--devices", type=int, default=1, help="Number of simulated devices")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between heartbeats")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to run")
+    parser.add_argument("--no-register", action="store_true", help="Only send heartbeats (the server ignores them until the devices register)")
+    parser.add_argument("--gateway", action="store_true", help="Register through the batch endpoint")
+    parser.add_argument("--push", action="store_true",
+                        help="Run a command endpoint per device so the server can push commands")
+    args = parser.parse_args()
+
+    server = args.server
+    if server is None:
+        server = SimulatedWiFiDevice("ESP32_SIM_DISCOVERY").discover() or "127.0.0.1"
+
+    fleet = SimulatedFleet(args.devices, server, args.http_port, args.heartbeat_port)
+    print(f"🤖 Simulating {args.devices} WiFi devices against {server}")
+
+    if args.push:
+        for device in fleet.devices:
+            device.start_command_server()
+
+    if not args.no_register:
+        registered = fleet.register_batch() if args.gateway else fleet.register_all()
+        print(f"📶 Registered {registered}/{args.devices} devices")
+
+    sent = fleet.run(args.interval, args.duration)
+    print(f"💓 Sent {sent} heartbeats")
+
+if __name__ == "__main__":
+    main()
@@ -34,6 +34,8 @@ WiFiClient wifiClient;
 HTTPClient http;
 unsigned long lastHeartbeat = 0;
 bool systemReady = false;
+unsigned long pollIntervalMs = 2000;                // Server hint from registration (poll_interval_ms)
+unsigned long nextPollAt = 0;                      // First poll waits poll_delay_ms after a boot storm
 
 void setup() {
   Serial.begin(115200);
@@ -83,10 +85,9 @@ void loop() {
   }
   
   // Poll server for commands (optimized for faster response)
-  static unsigned long lastPoll = 0;
-  if (millis() - lastPoll > 2000) {  // Poll every 2 seconds instead of 5
+  if ((long)(millis() - nextPollAt) >= 0) {  // Every pollIntervalMs (2 s unless the server says otherwise)
     checkForCommands();
-    lastPoll = millis();
+    nextPollAt = millis() + pollIntervalMs;
   }
   
   // Heartbeat indicator (faster blink)
@@ -271,6 +272,13 @@ void registerWithServer() {
     String response = http.getString();
     Serial.println("✅ Registration successful!");
     Serial.println("Response: " + response);
+    
+    // Spread the fleet's first polls after a power blip, as the server suggests
+    StaticJsonDocument<256> hints;
+    if (!deserializeJson(hints, response)) {
+      pollIntervalMs = hints["poll_interval_ms"] | 2000;
+      nextPollAt = millis() + (unsigned long)(hints["poll_delay_ms"] | 0);
+    }
   } else {
     Serial.println("❌ Registration failed");
     Serial.println("Make sure Flask server is running");
@@ -1,82 +1,334 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, request, jsonify, redirect
 import time
+import json
+import threading
+import fnmatch
 from datetime import datetime
 import sys
 import os
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from vending.static_assets import init_static_assets, make_cached_response, REVALIDATE_CACHE_CONTROL
+from vending.discovery import start_discovery_service
+from vending.heartbeat import start_heartbeat_service, HEARTBEAT_STATUS
+from vending.push import PushDelivery, build_command_url, PUSHED, UNKNOWN as PUSH_UNKNOWN
+from vending.analytics import VendAnalytics, WINDOWS as ANALYTICS_WINDOWS
+from vending.scheduler import CommandAckTracker
+from vending.state import create_state_backend, OPEN_COMMAND_STATUSES
+from vending.sharding import ClusterRouter, FORWARDED_HEADER, NODE_HEADER, CLIENT_ADDR_HEADER
+from vending.snapshot import write_snapshot, read_snapshot, claim_snapshot, remove_snapshot, set_aside_snapshot
+from vending.profiling import init_request_timing, SamplingProfiler, collapsed_text, profile_summary
+from vending.health import HealthTracker
+from vending.priority import CommandPriorityQueue, PRIORITY_CLASSES, classify
+from vending.registration import RegistrationMonitor
+from vending.commlog import DEFAULT_RETENTION as DEFAULT_LOG_RETENTION, \
+    DEFAULT_DEVICE_RETENTION as DEFAULT_DEVICE_LOG_RETENTION, DEFAULT_LIMIT as DEFAULT_LOG_LIMIT
+from vending.archive import SegmentArchive, DEFAULT_MAX_BYTES as DEFAULT_ARCHIVE_MAX_BYTES
+from vending.telemetry import TelemetryStore, DEFAULT_SAMPLES as TELEMETRY_DEFAULT_SAMPLES
+from vending.fastjson import init_fast_json
+from vending.broadcast import BroadcastTracker, DEFAULT_TIMEOUT as BROADCAST_DEFAULT_TIMEOUT, \
+    QUEUED as BROADCAST_QUEUED, DELIVERED as BROADCAST_DELIVERED, PENDING as BROADCAST_PENDING, PUSHED as BROADCAST_PUSHED, SENT as BROADCAST_SENT, \
+    REPLIED as BROADCAST_REPLIED, FAILED as BROADCAST_FAILED, TIMEOUT as BROADCAST_TIMEOUT
+from vending.vend_schedule import VendSchedule, DEFAULT_MAX_PENDING as SCHEDULE_DEFAULT_MAX_PENDING, \
+    DEFAULT_MAX_LATE as SCHEDULE_DEFAULT_MAX_LATE, MAX_BATCH as MAX_SCHEDULE_BATCH, \
+    DEFAULT_LIMIT as SCHEDULE_DEFAULT_LIMIT, RELEASED as SCHEDULE_RELEASED, FAILED as SCHEDULE_FAILED
+
 app = Flask(__name__)
 
-# ESP32 communication log (for real-time monitoring)
-esp32_comm_log = []
-MAX_LOG_ENTRIES = 100
+# jsonify()/get_json() through orjson when it is installed (same output, less CPU per response)
+json_encoder = init_fast_json(app)
+
+# Per-route latency histograms (first before_request hook, so it sees every request)
+route_timings = init_request_timing(app)
+profiler = SamplingProfiler()
+
+# Fingerprint + precompress static assets and pre-render the index page once
+static_asset_cache, index_page = init_static_assets(app)
+_asset_stats = static_asset_cache.stats()
+print(f"🗜️ Static assets precompressed: {_asset_stats['files']} files, "
+      f"{_asset_stats['identity_bytes']} -> {_asset_stats['gzip_bytes']} bytes (gzip)")
+
+# ESP32 communication log (for real-time monitoring), indexed by device, type and direction
+#   VENDING_LOG_RETENTION entries in total, VENDING_LOG_DEVICE_RETENTION per device
+MAX_LOG_ENTRIES = int(os.environ.get("VENDING_LOG_RETENTION", DEFAULT_LOG_RETENTION))
+MAX_DEVICE_LOG_ENTRIES = int(os.environ.get("VENDING_LOG_DEVICE_RETENTION", DEFAULT_DEVICE_LOG_RETENTION))
+SNAPSHOT_LOG_ENTRIES = 1000
+
+# Storage for ESP32 devices, commands, stock and the comm log (WiFi mode)
+# VENDING_STATE_BACKEND=sqlite shares it between worker processes through VENDING_STATE_DB
+STATE_BACKEND = os.environ.get("VENDING_STATE_BACKEND", "memory")
+STATE_DB_PATH = os.environ.get("VENDING_STATE_DB",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vending_state.db'))
+state = create_state_backend(STATE_BACKEND, STATE_DB_PATH, MAX_LOG_ENTRIES, MAX_DEVICE_LOG_ENTRIES)
+comm_log = state.comm_log
+
+# Everything logged (and every command history change) is also spilled to rotating gzip NDJSON
+# segments under VENDING_ARCHIVE_DIR, up to VENDING_ARCHIVE_MAX_BYTES per stream (VENDING_ARCHIVE=0 disables)
+ARCHIVE_ENABLED = os.environ.get("VENDING_ARCHIVE", "1") != "0"
+ARCHIVE_DIR = os.environ.get("VENDING_ARCHIVE_DIR",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'archive'))
+ARCHIVE_MAX_BYTES = int(os.environ.get("VENDING_ARCHIVE_MAX_BYTES", DEFAULT_ARCHIVE_MAX_BYTES))
+archives = {
+    stream: SegmentArchive(ARCHIVE_DIR, stream, max_bytes=ARCHIVE_MAX_BYTES)
+    for stream in ("comm", "commands")
+} if ARCHIVE_ENABLED else {}
 
 def log_esp32_communication(direction, message, msg_type="info", device_id=None, device_type=None):
-    """Log ESP32 communication for monitoring with device information"""
-    global esp32_comm_log
-    
-    log_entry = {
-        "timestamp": time.time(),
-        "direction": direction,  # "sent" or "received"
-        "message": message,
-        "type": msg_type,  # "info", "vend", "status", "error", "success"
-        "formatted_time": datetime.now().strftime("%H:%M:%S.%f")[:-3],
-        "device_id": device_id or "unknown",
-        "device_type": device_type or "unknown"  # "serial" or "wifi"
-    }
-    
-    esp32_comm_log.append(log_entry)
+    """Log ESP32 communication for monitoring with device information - returns the entry's seq"""
+    timestamp = time.time()
+    device_id = device_id or "unknown"
+    device_type = device_type or "unknown"  # "serial" or "wifi"
+    seq = comm_log.append(direction,  # "sent" or "received"
+                          message,
+                          msg_type,  # "info", "vend", "status", "error", "success"
+                          device_id, device_type, timestamp)
+    if archives:
+        archives["comm"].append({"seq": seq, "timestamp": timestamp, "direction": direction, "message": message,
+                                 "type": msg_type, "device_id": device_id, "device_type": device_type})
+    return seq
+
+def archive_command(event, entry):
+    if archives:
+        archives["commands"].append({"timestamp": time.time(), "event": event, "entry": dict(entry)})
+
+def record_history(entry):
+    """Add a command history entry (and archive it)"""
+    command_history.append(entry)
+    archive_command("created", entry)
+
+def update_history(entry, **fields):
+    command_history.update(entry, **fields)
+    archive_command("updated", entry)
+
+# Registrations in a burst share one log line instead of flooding the dashboard after a power blip
+REGISTRATION_LOG_WINDOW = 5.0
+registration_log = {"seq": None, "started_at": 0.0, "count": 0, "lock": threading.Lock()}
+
+def log_registrations(registered):
+    """Log (device_id, ip_address) registrations - coalesced into the current burst's line"""
+    if not registered:
+        return
+    now = time.time()
+    with registration_log["lock"]:
+        if registration_log["seq"] is None or now - registration_log["started_at"] > REGISTRATION_LOG_WINDOW:
+            device_id, ip_address = registered[0]
+            registration_log["seq"] = log_esp32_communication(
+                "received", f"WiFi device {device_id} registered from {ip_address}", "discovery", device_id, "wifi")
+            registration_log["started_at"] = now
+            registration_log["count"] = 0
+            print(f"📶 WiFi ESP32 registered: {device_id} from {ip_address}")
+        
+        registration_log["count"] += len(registered)
+        if registration_log["count"] > 1:
+            device_id, ip_address = registered[-1]
+            comm_log.update_message(registration_log["seq"], f"{registration_log['count']} WiFi devices registered "
+                                                             f"(latest {device_id} from {ip_address})")
+
+def serial_log_callback(direction, message, msg_type="info", device_id=None, device_type=None):
+    """Log serial traffic and pick vend results out of the ESP32's output"""
+    log_esp32_communication(direction, message, msg_type, device_id, device_type)
     
-    # Keep only recent entries
-    if len(esp32_comm_log) > MAX_LOG_ENTRIES:
-        esp32_comm_log = esp32_comm_log[-MAX_LOG_ENTRIES:]
+    if direction == "received" and "VEND_SUCCESS:" in message:
+        try:
+            slot = int(message.split("VEND_SUCCESS:", 1)[1].split()[0])
+        except (IndexError, ValueError):
+            return
+        complete_vend(device_id, slot, True, message)
 
 # Try to import ESP32 serial communication
+# Port detection opens and probes every port, so it runs in the background from create_app()
+# Queued commands go out in one write; VENDING_SERIAL_PACING_MS > 0 sends them one at a time that far apart
+SERIAL_COMMAND_PACING = float(os.environ.get("VENDING_SERIAL_PACING_MS", "0")) / 1000
 esp32_serial = None
 try:
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
     from esp32_serial import ESP32SerialCommunication
     
-        # Auto-detect ESP32 port dynamically (any port, any ESP32)
-    import platform
-    import serial
-    
-    # Create ESP32 communication instance with auto-detection
-    esp32_serial = ESP32SerialCommunication(port=None, log_callback=log_esp32_communication)
-    
-    # Try to auto-detect ESP32 port dynamically
-    detected_port = esp32_serial._auto_detect_port()
-    if detected_port:
-        esp32_serial.set_port(detected_port)
-        print(f"📡 ESP32 dynamically detected on port: {detected_port}")
-    else:
-        # Only if absolutely no ESP32 found, use platform defaults
-        if platform.system() == "Windows":
-            default_port = "COM3"
-        else:
-            default_port = "/dev/ttyUSB0"
-        
-        esp32_serial.set_port(default_port)
-        print(f"📡 No ESP32 detected, using fallback port: {default_port}")
-        print("   Use the web interface to manually scan and connect")
+    # Create ESP32 communication instance - the port is filled in by discover_serial_device()
+    esp32_serial = ESP32SerialCommunication(port=None, log_callback=serial_log_callback,
+                                            command_queue=CommandPriorityQueue(),
+                                            command_pacing=SERIAL_COMMAND_PACING)
 except ImportError as e:
     print(f"⚠️ ESP32 serial module not available: {e}")
 except Exception as e:
     print(f"⚠️ ESP32 serial initialization error: {e}")
 
-# In-memory storage for ESP32 devices and commands (WiFi mode)
-esp32_devices = {}
-network_devices = {}  # WiFi connected ESP32 devices (alternative name)
-pending_commands = {}
-command_history = []
+# Background serial discovery progress ("pending" until create_app() starts it)
+serial_discovery = {"state": "pending", "started_at": None, "finished_at": None}
+_background_started = False
+
+esp32_devices = state.devices
+network_devices = state.network_devices  # WiFi connected ESP32 devices (alternative name)
+command_history = state.command_history
+
+# Background UDP services (discovery responder + heartbeat channel)
+udp_services = None
+heartbeat_protocol = None
+
+# Server-push delivery for WiFi devices that expose a command endpoint (VENDING_PUSH_DELIVERY=0 disables)
+PUSH_DELIVERY_ENABLED = os.environ.get("VENDING_PUSH_DELIVERY", "1") != "0"
+push_delivery = PushDelivery()
+
+# Fleet-wide command fan-out (POST /esp32/broadcast) on a shared dispatch pool
+broadcasts = BroadcastTracker()
+
+# Registration rate, and the poll delay/interval hints handed back to registering devices
+registration_monitor = RegistrationMonitor()
+MAX_BATCH_REGISTRATIONS = 1000
+
+# Numeric /esp32/data fields kept per device and metric in fixed-size rings (per process)
+TELEMETRY_SAMPLES = int(os.environ.get("VENDING_TELEMETRY_SAMPLES", TELEMETRY_DEFAULT_SAMPLES))
+telemetry = TelemetryStore(samples=TELEMETRY_SAMPLES)
+
+# Per-device slot stock (devices without inventory data are untracked and always vend)
+slot_inventory = state.inventory
+
+# Rolling vend counters (minute/hour/day rings), updated on every vend and confirm
+vend_analytics = VendAnalytics()
+
+# Ack deadlines for in-flight commands (hashed timer wheel)
+COMMAND_ACK_TIMEOUTS = {"serial": 5.0, "wifi": 15.0}  # WiFi includes the poll interval
+MAX_COMMAND_RETRIES = 2
+MAX_POLL_WAIT = 30.0  # Longest ?wait= a polling device may ask for
+EMPTY_POLL_BODY = b"null\n"  # Pre-encoded "no command" - most polls find nothing queued
+ack_tracker = CommandAckTracker(on_expire=lambda record: handle_command_timeout(record))
+
+# Timed vends (POST /vend/schedule) on a timer heap, released like POST /vend at their due time (per process)
+#   VENDING_SCHEDULE_MAX_PENDING caps waiting entries; ones due more than VENDING_SCHEDULE_MAX_LATE s ago are skipped
+vend_schedule = VendSchedule(release=lambda entry: release_scheduled_vend(entry),
+                             max_pending=int(os.environ.get("VENDING_SCHEDULE_MAX_PENDING", SCHEDULE_DEFAULT_MAX_PENDING)),
+                             max_late=float(os.environ.get("VENDING_SCHEDULE_MAX_LATE", SCHEDULE_DEFAULT_MAX_LATE)))
+
+# Rolling per-device health with a circuit breaker - vend routing skips devices whose circuit is open
+device_health = HealthTracker()
+
+# Graceful drain: stop taking vends, wait for confirmations, then snapshot for a warm restart
+SNAPSHOT_PATH = os.environ.get("VENDING_SNAPSHOT",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vending_snapshot.json.gz'))
+SNAPSHOT_MAX_AGE = 24 * 3600  # Older device data is not worth restoring
+DRAIN_TIMEOUT = float(os.environ.get("VENDING_DRAIN_TIMEOUT", "10"))
+# Once the snapshot is taken, polls get nothing: queued commands live only in the snapshot (held_commands)
+drain_status = {"draining": False, "started_at": None, "snapshot": None, "holding": False, "held_commands": {}}
+
+# Consistent-hash device sharding across server nodes (off unless both variables are set)
+#   VENDING_NODE_ID=a VENDING_CLUSTER_NODES="a=http://10.0.0.5:5000,b=http://10.0.0.6:5000"
+cluster = ClusterRouter.from_config(os.environ.get("VENDING_NODE_ID"), os.environ.get("VENDING_CLUSTER_NODES"),
+                                    os.environ.get("VENDING_CLUSTER_FORWARD", "proxy"))
+SHARDED_ENDPOINTS = {
+    "vend", "esp32_register", "esp32_connect", "esp32_data", "esp32_get_commands", "esp32_queue_command", "esp32_confirm",
+    "vend_by_slot_name", "inventory_device", "inventory_restock", "device_health_view", "device_health_reset",
+    "device_telemetry", "scheduled_vends"
+}
 
 # Device management
-active_device = None  # Currently selected device for commands
 device_priority = ["serial", "wifi"]  # Default priority order
 
+def get_active_device():
+    """Currently selected device for commands (None = automatic)"""
+    return state.settings.get("active_device")
+
+def set_active_device(device_id):
+    state.settings["active_device"] = device_id
+
+def touch_device(device_id, **fields):
+    """Update a WiFi device in both registries - False if it isn't registered"""
+    found = False
+    for store in (esp32_devices, network_devices):
+        device_info = store.get(device_id)
+        if device_info is not None:
+            device_info.update(fields)
+            store[device_id] = device_info  # Write back (shared backends hand out copies)
+            found = True
+    if found and fields.get('status') == 'online':
+        state.presence.assign(device_id, fields.get('last_seen', time.time()))
+    return found
+
+def store_wifi_device(device_id, device_info):
+    """Add or replace a WiFi device in both registries - an online device gets a presence slot"""
+    network_devices[device_id] = device_info
+    esp32_devices[device_id] = device_info
+    if device_info.get('status') == 'online':
+        state.presence.assign(device_id, device_info.get('last_seen', time.time()))
+    else:
+        state.presence.release(device_id)
+
+def with_presence(device_info, seen):
+    """Device record with last_seen brought up to date from presence slots (seen = state.presence.snapshot())
+
+    Empty polls only write the slot, so the record's own last_seen can lag behind.
+    """
+    last_seen = seen.get(device_info.get('device_id'))
+    if last_seen is not None and last_seen > (device_info.get('last_seen') or 0):
+        return dict(device_info, last_seen=last_seen)
+    return device_info
+
+def request_client_addr():
+    """Address the request came from - a forward from a peer node carries the original client's"""
+    if cluster is not None and request.headers.get(FORWARDED_HEADER) and cluster.is_peer(request.remote_addr):
+        return request.headers.get(CLIENT_ADDR_HEADER) or request.remote_addr
+    return request.remote_addr
+
+def request_device_id():
+    """The device a request is about (URL, query string or JSON body) - None if it names none"""
+    if request.view_args and request.view_args.get('device_id'):
+        return request.view_args['device_id']
+    if request.args.get('device_id'):
+        return request.args['device_id']
+    data = request.get_json(silent=True)
+    if isinstance(data, dict) and data.get('device_id'):
+        return str(data['device_id'])
+    return None
+
+@app.before_request
+def route_to_owning_node():
+    """Sharded cluster: hand device-specific requests to the node that owns the device"""
+    if cluster is None or request.endpoint not in SHARDED_ENDPOINTS or request.headers.get(FORWARDED_HEADER):
+        return None
+    
+    device_id = request_device_id()
+    if not device_id or device_id.startswith("serial_"):
+        return None  # USB devices belong to the node they are plugged into
+    
+    owner = cluster.owner(device_id)
+    if owner == cluster.node_id:
+        cluster.stats["local"] += 1
+        return None
+    
+    path = request.full_path if request.query_string else request.path
+    if cluster.mode == "redirect":
+        cluster.stats["redirected"] += 1
+        response = redirect(cluster.url_for(owner, path), code=307)
+    else:
+        timeout = None
+        if request.endpoint == "esp32_get_commands":
+            # A long-poll holds the owner's answer for up to ?wait= seconds - give it that on top
+            timeout = cluster.timeout + min(max(request.args.get('wait', 0, type=float), 0), MAX_POLL_WAIT)
+        status, headers, body = cluster.forward(owner, request.method, path, request.get_data(), request.headers,
+                                                timeout, request_client_addr())
+        response = app.response_class(body, status=status, headers=headers)
+    response.headers[NODE_HEADER] = owner
+    return response
+
+@app.before_request
+def reject_vends_while_draining():
+    """A draining server finishes in-flight vends but takes no new ones (or new commands for the queues)"""
+    if drain_status["draining"] and (request.endpoint in ("vend", "vend_by_slot_name") or
+                                     (request.endpoint in ("scheduled_vends", "esp32_queue_command", "esp32_broadcast")
+                                      and request.method == "POST")):
+        response = jsonify({
+            "status": "error",
+            "message": "Server is shutting down - try again shortly",
+            "reason": "draining"
+        })
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(DRAIN_TIMEOUT) + 5)
+        return response
+    return None
+
 @app.route('/')
 def index():
-    """Serve the main vending machine interface"""
-    return render_template('index.html')
+    """Serve the main vending machine interface (pre-rendered at startup)"""
+    return make_cached_response(app.response_class, request, index_page, REVALIDATE_CACHE_CONTROL)
 
 @app.route('/vend/<int:slot_id>', methods=['POST'])
 def vend(slot_id):
@@ -93,12 +345,21 @@ def vend(slot_id):
         communication_used = None
         success = False
         device_used = None
+        empty_device = None  # Set when a candidate device is out of stock for this slot
         
-        # Use active device if selected
+        # Use the requested device (?device_id= or JSON body), else the selected active device
+        requested_device = request_device_id()
+        active_device = requested_device or get_active_device()
         if active_device:
-            if active_device.startswith("serial_") and esp32_serial and esp32_serial.is_connected:
-                # Use selected serial device
-                success = esp32_serial.send_vend_command(slot_id)
+            if (active_device.startswith("serial_") and esp32_serial and esp32_serial.is_connected and
+                    device_health.allow(active_device)):
+                # Use selected serial device (reserve stock first - empty slots never reach the motor)
+                if not slot_inventory.reserve(active_device, slot_id):
+                    return slot_empty_response(active_device, slot_id)
+                
+                success = dispatch_vend(active_device, slot_id) is not None
+                if not success:
+                    slot_inventory.restore(active_device, slot_id)
                 if success:
                     communication_used = "serial"
                     device_used = active_device
@@ -113,46 +374,50 @@ def vend(slot_id):
                         "device_port": esp32_serial.port
                     }), 200
                     
-            elif active_device in esp32_devices and esp32_devices[active_device].get('status') == 'online':
-                # Use selected WiFi device
-                pending_commands[active_device] = {
-                    "command": "VEND",
-                    "slot": slot_id,
-                    "timestamp": time.time()
-                }
+            elif (active_device in esp32_devices and esp32_devices[active_device].get('status') == 'online' and
+                    device_health.allow(active_device)):
+                if not slot_inventory.reserve(active_device, slot_id):
+                    return slot_empty_response(active_device, slot_id)
+                
+                # Use selected WiFi device (push if it exposes an endpoint, else queue for its poll)
+                delivery = dispatch_vend(active_device, slot_id)["delivery"]
                 
                 communication_used = "wifi"
                 device_used = active_device
                 success = True
-                print(f"📡 WiFi command queued for selected device {active_device}: Slot {slot_id}")
-                
-                # Log command
-                log_esp32_communication("sent", f"VEND:{slot_id}", "command", 
-                                      device_id=active_device, device_type="wifi")
-                
-                command_history.append({
-                    "timestamp": datetime.now().isoformat(),
-                    "device_id": active_device,
-                    "slot": slot_id,
-                    "status": "sent",
-                    "communication": "wifi"
-                })
+                print(f"📡 WiFi command {'queued for' if delivery == 'poll' else 'pushed to'} selected device {active_device}: Slot {slot_id}")
                 
                 return jsonify({
                     "status": "command_sent",
                     "slot": slot_id,
                     "message": f"Command sent to selected ESP32 for slot {slot_id}",
                     "device_id": active_device,
-                    "communication": "wifi"
+                    "communication": "wifi",
+                    "delivery": delivery
                 }), 200
         
+        if requested_device:
+            return jsonify({
+                "status": "error",
+                "message": f"Device {requested_device} is not online or its circuit is open",
+                "slot": slot_id,
+                "device_id": requested_device
+            }), 409
+        
         # Fallback: Auto-select best available device
         # Priority 1: Try serial communication first (ESP32 via USB)
-        if esp32_serial and esp32_serial.is_connected:
-            success = esp32_serial.send_vend_command(slot_id)
+        if esp32_serial and esp32_serial.is_connected and device_health.allow(f"serial_{esp32_serial.port}"):
+            serial_device_id = f"serial_{esp32_serial.port}"
+            if slot_inventory.reserve(serial_device_id, slot_id):
+                success = dispatch_vend(serial_device_id, slot_id) is not None
+                if not success:
+                    slot_inventory.restore(serial_device_id, slot_id)
+            else:
+                empty_device = serial_device_id
+            
             if success:
                 communication_used = "serial"
-                device_used = f"serial_{esp32_serial.port}"
+                device_used = serial_device_id
                 print(f"📡 Serial command sent to ESP32: VEND:{slot_id}")
                 
                 return jsonify({
@@ -167,43 +432,34 @@ def vend(slot_id):
         # Priority 2: Check if any WiFi ESP32 devices are connected
         online_wifi_devices = get_online_wifi_devices()
         
-        if online_wifi_devices:
-            # Send command to first available ESP32 (WiFi mode)
-            device_id = online_wifi_devices[0]
-            
-            # Store command for ESP32 to pick up
-            pending_commands[device_id] = {
-                "command": "VEND",
-                "slot": slot_id,
-                "timestamp": time.time()
-            }
+        # Send command to the first healthy ESP32 that has stock in this slot (WiFi mode)
+        device_id = next((d for d in online_wifi_devices
+                          if device_health.allow(d) and slot_inventory.reserve(d, slot_id)), None)
+        if online_wifi_devices and device_id is None:
+            empty_device = empty_device or online_wifi_devices[0]
+        
+        if device_id:
+            # Push to the ESP32 directly, or store the command for it to pick up
+            delivery = dispatch_vend(device_id, slot_id)["delivery"]
             
             communication_used = "wifi"
             device_used = device_id
             success = True
-            print(f"📡 WiFi command queued for ESP32 {device_id}: Slot {slot_id}")
-            
-            # Log command
-            log_esp32_communication("sent", f"VEND:{slot_id}", "command", 
-                                  device_id=device_id, device_type="wifi")
-            
-            # Log command
-            command_history.append({
-                "timestamp": datetime.now().isoformat(),
-                "device_id": device_id,
-                "slot": slot_id,
-                "status": "sent",
-                "communication": "wifi"
-            })
+            print(f"📡 WiFi command {'queued for' if delivery == 'poll' else 'pushed to'} ESP32 {device_id}: Slot {slot_id}")
             
             return jsonify({
                 "status": "command_sent",
                 "slot": slot_id,
                 "message": f"WiFi command sent to ESP32 for slot {slot_id}",
                 "device_id": device_id,
-                "communication": "wifi"
+                "communication": "wifi",
+                "delivery": delivery
             }), 200
         
+        # Every connected device is out of stock for this slot
+        if empty_device:
+            return slot_empty_response(empty_device, slot_id)
+        
         # Priority 3: Fallback to simulation if no ESP32 connected
         if not success:
             command = f"VEND:{slot_id}"
@@ -225,16 +481,245 @@ def vend(slot_id):
             "slot": slot_id
         }), 500
 
+def slot_empty_response(device_id, slot_id):
+    """Reject a vend for an empty slot without contacting the device"""
+    print(f"📭 Slot {slot_id} is empty on {device_id} - vend rejected")
+    vend_analytics.record_rejected(device_id, slot_id)
+    return jsonify({
+        "status": "error",
+        "message": f"Slot {slot_id} is out of stock",
+        "slot": slot_id,
+        "device_id": device_id,
+        "reason": "out_of_stock"
+    }), 409
+
+def record_vend_dispatch(device_id, slot_id, communication, command_id=None, attempts=1, rerouted=False):
+    """Book-keeping for a vend about to go out: history entry, analytics and the ack deadline
+    
+    Runs before the command is sent, so a confirmation that beats the dispatch
+    (push devices answer inside the POST) always finds its tracked record.
+    Follow with vend_dispatched() or, if the send failed, vend_not_dispatched().
+    """
+    command_id = command_id or ack_tracker.new_command_id()
+    history_entry = {
+        "timestamp": datetime.now().isoformat(),
+        "command_id": command_id,
+        "device_id": device_id,
+        "slot": slot_id,
+        "status": "sent",
+        "communication": communication,
+        "attempts": attempts
+    }
+    record_history(history_entry)
+    
+    counted = attempts == 1 or rerouted  # A retry on the same device is still the same dispatch
+    if counted:
+        vend_analytics.record_dispatch(device_id, slot_id)
+    device_health.record_dispatch(device_id)
+    
+    record = {
+        "command_id": command_id,
+        "device_id": device_id,
+        "slot": slot_id,
+        "communication": communication,
+        "attempts": attempts,
+        "dispatched_at": time.time(),
+        "history_entry": history_entry,
+        "counted": counted
+    }
+    ack_tracker.track(record, COMMAND_ACK_TIMEOUTS.get(communication, 15.0))
+    return record
+
+def vend_dispatched(record, delivery=None):
+    """The command left - note how (written with the entry's next update, not an extra history write)"""
+    record["delivery"] = delivery
+    if delivery:
+        record["history_entry"]["delivery"] = delivery
+
+def vend_not_dispatched(record, reason):
+    """The send failed - drop the deadline and close the history entry (the caller restores the stock)"""
+    if ack_tracker.discard(record["command_id"]) is None:
+        return  # Settled already
+    update_history(record["history_entry"], status='failed', result_message=reason)
+    if record["counted"]:
+        vend_analytics.record_result(record["device_id"], record["slot"], False)
+
+def complete_vend(device_id, slot, success, message=None, command_id=None):
+    """A device reported the result of a vend - stop its deadline and settle stock/analytics"""
+    record = ack_tracker.ack(device_id, slot, command_id)
+    
+    if record is not None:
+        history_entry = record["history_entry"]
+    elif command_id:
+        # Untracked here (confirmed after its deadline, or dispatched by another worker) - still open?
+        history_entry = command_history.get(command_id)
+        if history_entry is not None and history_entry.get('status') not in OPEN_COMMAND_STATUSES:
+            history_entry = None
+    else:
+        history_entry = command_history.find_open(device_id, slot)
+    
+    if success:
+        device_health.record_success(device_id, time.time() - record["dispatched_at"] if record else None)
+    else:
+        device_health.record_failure(device_id, "failure")
+    
+    if history_entry is None:
+        # Settled by its deadline already: the unit went back into stock and a failure was counted
+        if success:
+            slot_inventory.reserve(device_id, slot)  # It did dispense after all - take the unit out again
+        print(f"⏰ Late {'success' if success else 'failure'} from {device_id} for slot {slot} - already settled")
+        return record
+    
+    update_history(history_entry, status='completed' if success else 'failed', result_message=message)
+    vend_analytics.record_result(device_id, slot, bool(success))
+    if not success:
+        # Failed dispense - put the reserved unit back
+        slot_inventory.restore(device_id, slot)
+    return record
+
+def is_device_online(device_id):
+    """Whether a serial or WiFi device can take commands right now"""
+    if device_id.startswith("serial_"):
+        return bool(esp32_serial and esp32_serial.is_connected and device_id == f"serial_{esp32_serial.port}")
+    return device_id in get_online_wifi_devices()
+
+def send_vend_to_device(device_id, slot_id, record):
+    """Send a VEND to a specific device - returns the delivery ("serial", "push", "poll", "push_unconfirmed") or None"""
+    if device_id.startswith("serial_"):
+        line = is_device_online(device_id) and esp32_serial.send_vend_command(slot_id)
+        if line:
+            record["serial_line"] = line  # Lets a timeout withdraw it if the writer hasn't sent it yet
+            return "serial"
+        return None
+    
+    return dispatch_wifi_command(device_id, {
+        "command": "VEND",
+        "slot": slot_id,
+        "timestamp": time.time(),
+        "command_id": record["command_id"]
+    })
+
+def dispatch_vend(device_id, slot_id, attempts=1, rerouted=False):
+    """Track and send a VEND (stock already reserved) - returns the tracked record, or None if it did not go out"""
+    communication = "serial" if device_id.startswith("serial_") else "wifi"
+    record = record_vend_dispatch(device_id, slot_id, communication, attempts=attempts, rerouted=rerouted)
+    delivery = send_vend_to_device(device_id, slot_id, record)
+    if delivery is None:
+        vend_not_dispatched(record, f"Could not send to {device_id}")
+        return None
+    vend_dispatched(record, None if delivery == "serial" else delivery)
+    return record
+
+def pick_retry_device(device_id, slot_id):
+    """Same device if it is still online, otherwise another online device with stock in the slot"""
+    if is_device_online(device_id) and device_health.allow(device_id):
+        return device_id
+    
+    candidates = []
+    if esp32_serial and esp32_serial.is_connected:
+        candidates.append(f"serial_{esp32_serial.port}")
+    candidates.extend(get_online_wifi_devices())
+    
+    for candidate in candidates:
+        if candidate != device_id and device_health.allow(candidate) and slot_inventory.reserve(candidate, slot_id):
+            return candidate
+    return None
+
+def handle_command_timeout(record):
+    """No confirmation before the deadline - retry, reroute, or mark the command failed"""
+    device_id = record["device_id"]
+    slot_id = record["slot"]
+    history_entry = record["history_entry"]
+    
+    # Another worker may have received the confirmation (shared state backend)
+    current = command_history.get(record["command_id"])
+    if current is not None and current.get('status') in ('completed', 'failed'):
+        return
+    
+    # A command the device never picked up is still waiting - withdraw it before retrying or failing
+    # (poll queue, or the serial writer's queue while the port reconnects)
+    if record["communication"] == "serial":
+        if esp32_serial and record.get("serial_line"):
+            esp32_serial.withdraw(record["serial_line"])
+    else:
+        state.withdraw_command(device_id, record["command_id"])
+    
+    print(f"⏰ No confirmation from {device_id} for slot {slot_id} (attempt {record['attempts']})")
+    device_health.record_failure(device_id, "timeout")
+    log_esp32_communication("received", f"Timeout waiting for VEND:{slot_id} confirmation", "error", 
+                          device_id=device_id, device_type=record["communication"])
+    
+    if record["attempts"] <= MAX_COMMAND_RETRIES:
+        target = pick_retry_device(device_id, slot_id)
+        if target is not None:
+            if target != device_id:
+                # Rerouted - the original device never dispensed
+                slot_inventory.restore(device_id, slot_id)
+                vend_analytics.record_result(device_id, slot_id, False)
+            
+            if dispatch_vend(target, slot_id, attempts=record["attempts"] + 1, rerouted=target != device_id):
+                update_history(history_entry, status='retrying' if target == device_id else 'rerouted',
+                               result_message=f"Timed out, retried on {target}")
+                print(f"🔁 Retrying slot {slot_id} on {target}")
+                return
+            
+            if target != device_id:
+                slot_inventory.restore(target, slot_id)
+                device_id = None  # Original already settled above
+    
+    update_history(history_entry, status='failed',
+                   result_message=f"No confirmation after {record['attempts']} attempt(s)")
+    if device_id is not None:
+        slot_inventory.restore(device_id, slot_id)
+        vend_analytics.record_result(device_id, slot_id, False)
+
+def format_command(command):
+    """Render a command dict the way it appears on the wire/log (e.g. VEND:3)"""
+    return f"{command.get('command')}:{command.get('slot')}" if command.get('slot') else command.get('command')
+
+def dispatch_wifi_command(device_id, command, priority=None):
+    """Deliver a command to a WiFi ESP32 - push when it exposes an endpoint, otherwise queue for its next poll
+
+    Returns "push", "poll", or "push_unconfirmed" when the push went out but no 2xx came back.
+    """
+    device_info = esp32_devices.get(device_id) or network_devices.get(device_id) or {}
+    command_url = device_info.get('command_url')
+    command_str = format_command(command)
+    
+    if PUSH_DELIVERY_ENABLED and command_url:
+        outcome, detail = push_delivery.push(device_id, command_url, command)
+        if outcome == PUSHED:
+            log_esp32_communication("sent", f"{command_str} (push)", "command", 
+                                  device_id=device_id, device_type="wifi")
+            return "push"
+        if outcome == PUSH_UNKNOWN:
+            # The device may have taken it - queueing it as well could run it twice. A vend's ack deadline settles it
+            print(f"⚠️ Push to {device_id} unconfirmed ({detail}) - not re-queued")
+            log_esp32_communication("sent", f"{command_str} (push, unconfirmed: {detail})", "error", 
+                                  device_id=device_id, device_type="wifi")
+            return "push_unconfirmed"
+        
+        print(f"⚠️ Push to {device_id} failed ({detail}) - falling back to poll queue")
+        log_esp32_communication("sent", f"Push failed ({detail}), queued for poll", "error", 
+                              device_id=device_id, device_type="wifi")
+    
+    state.queue_command(device_id, command, priority)
+    log_esp32_communication("sent", command_str, "command", 
+                          device_id=device_id, device_type="wifi")
+    return "poll"
+
 @app.route('/status')
 def status():
     """Health check endpoint - shows both serial and WiFi status"""
     serial_status = "connected" if (esp32_serial and esp32_serial.is_connected) else "disconnected"
+    if serial_status == "disconnected" and serial_discovery["state"] == "discovering":
+        serial_status = "discovering"
     online_wifi_devices = get_online_wifi_devices()
     wifi_devices = len(online_wifi_devices)
     
     return jsonify({
-        "status": "online", 
-        "message": "Vending machine is ready",
+        "status": "draining" if drain_status["draining"] else "online", 
+        "message": "Vending machine is shutting down" if drain_status["draining"] else "Vending machine is ready",
         "esp32_serial": serial_status,
         "esp32_wifi_devices": wifi_devices,
         "online_devices": wifi_devices + (1 if serial_status == "connected" else 0),
@@ -242,7 +727,9 @@ def status():
         "communication_modes": {
             "serial": {
                 "status": serial_status,
-                "port": esp32_serial.port if esp32_serial else "not configured"
+                "port": esp32_serial.port if esp32_serial else "not configured",
+                "device_status": esp32_serial.last_status if esp32_serial else None,
+                "discovery": serial_discovery["state"]
             },
             "wifi": f"{wifi_devices} devices online",
             "wifi_device_list": online_wifi_devices
@@ -253,41 +740,130 @@ def status():
 # ESP32 WiFi Communication Endpoints
 # =================================
 
+def register_wifi_device(data, now, source_addr=None):
+    """Store one registration - returns the device_id, or raises ValueError for a bad entry
+
+    Commands are only pushed to the address the registration came from (source_addr), so a
+    client cannot point the server at another host. Gateway registrations are polled.
+    """
+    device_id = data.get('device_id')
+    ip_address = data.get('ip_address')
+    if not device_id or not ip_address:
+        raise ValueError("Missing device_id or ip_address")
+    
+    # Add to both storage systems for compatibility
+    device_info = {
+        "ip_address": ip_address,
+        "last_seen": now,
+        "status": "online",  # Changed from "connected" to "online" for consistency
+        "device_id": device_id,
+        "type": "wifi"
+    }
+    
+    # Devices that run a command server can receive pushed commands
+    command_url = None
+    if ip_address == source_addr:
+        command_url = build_command_url(ip_address, data.get('command_port'), data.get('command_path'))
+    elif data.get('command_port'):
+        print(f"⚠️ {device_id} registered from {source_addr} for {ip_address} - not pushing to it, it will be polled")
+    if command_url:
+        device_info["command_url"] = command_url
+    else:
+        push_delivery.drop(device_id)
+    
+    # Store in both locations
+    store_wifi_device(device_id, device_info)
+    
+    # A (re-)registering device restarts its heartbeat sequence
+    if heartbeat_protocol:
+        heartbeat_protocol.forget(device_id)
+    return device_id
+
 @app.route('/esp32/register', methods=['POST'])
 def esp32_register():
-    """Register a WiFi ESP32 device"""
+    """Register a WiFi ESP32 device - the response says when to start polling and how often"""
     try:
         data = request.get_json()
-        device_id = data.get('device_id')
-        ip_address = data.get('ip_address')
-        
-        if not device_id or not ip_address:
-            return jsonify({"success": False, "error": "Missing device_id or ip_address"}), 400
-        
-        # Add to both storage systems for compatibility
-        device_info = {
-            "ip_address": ip_address,
-            "last_seen": time.time(),
-            "status": "online",  # Changed from "connected" to "online" for consistency
-            "device_id": device_id,
-            "type": "wifi"
-        }
-        
-        # Store in both locations
-        network_devices[device_id] = device_info
-        esp32_devices[device_id] = device_info
-        
-        log_esp32_communication("received", f"WiFi device {device_id} registered from {ip_address}", 
-                              "discovery", device_id, "wifi")
+        now = time.time()
+        try:
+            device_id = register_wifi_device(data, now, request_client_addr())
+        except ValueError as e:
+            registration_monitor.stats["rejected"] += 1
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        print(f"📶 WiFi ESP32 registered: {device_id} from {ip_address}")
+        registration_monitor.observe(1, now)
+        log_registrations([(device_id, data.get('ip_address'))])
         
-        return jsonify({"success": True, "message": f"Device {device_id} registered"})
+        return jsonify(dict(registration_monitor.hint(device_id, len(esp32_devices), now),
+                            success=True, message=f"Device {device_id} registered"))
         
     except Exception as e:
         log_esp32_communication("received", f"Registration error: {str(e)}", "error")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/esp32/register/batch', methods=['POST'])
+def esp32_register_batch():
+    """Register many devices in one request (gateways, boot storms) - one result per device, in order"""
+    data = request.get_json(silent=True) or {}
+    entries = data.get('devices')
+    if not isinstance(entries, list):
+        return jsonify({"success": False, "error": "devices must be a list of registrations"}), 400
+    if len(entries) > MAX_BATCH_REGISTRATIONS:
+        return jsonify({"success": False, "error": f"At most {MAX_BATCH_REGISTRATIONS} devices per batch"}), 413
+    
+    # With sharding, each owning node registers its own devices (one sub-batch per node)
+    local = list(enumerate(entries))
+    results = [None] * len(entries)
+    if cluster is not None and not request.headers.get(FORWARDED_HEADER):
+        by_owner = {}
+        for index, entry in local:
+            device_id = entry.get('device_id') if isinstance(entry, dict) else None
+            owner = cluster.owner(device_id) if device_id else cluster.node_id
+            by_owner.setdefault(owner, []).append((index, entry))
+        local = by_owner.pop(cluster.node_id, [])
+        for owner, owned in by_owner.items():
+            status_code, _headers, body = cluster.forward(owner, "POST", "/esp32/register/batch",
+                                                          json.dumps({"devices": [entry for _index, entry in owned]}),
+                                                          {"Content-Type": "application/json"},
+                                                          client_addr=request_client_addr())
+            remote = json.loads(body).get("results", []) if status_code == 200 else []
+            for position, (index, entry) in enumerate(owned):
+                results[index] = remote[position] if position < len(remote) else {
+                    "device_id": entry.get('device_id'), "success": False,
+                    "error": f"Owning node {owner} did not accept the batch ({status_code})"}
+    
+    now = time.time()
+    source_addr = request_client_addr()
+    registered = []
+    with state.transaction():
+        for index, entry in local:
+            try:
+                device_id = register_wifi_device(entry if isinstance(entry, dict) else {}, now, source_addr)
+            except ValueError as e:
+                registration_monitor.stats["rejected"] += 1
+                results[index] = {"device_id": entry.get('device_id') if isinstance(entry, dict) else None,
+                                  "success": False, "error": str(e)}
+                continue
+            registered.append((index, device_id, entry.get('ip_address')))
+    
+    registration_monitor.observe(len(registered), now)
+    registration_monitor.stats["batches"] += 1
+    fleet_size = len(esp32_devices)
+    for index, device_id, _ip_address in registered:
+        results[index] = dict(registration_monitor.hint(device_id, fleet_size, now), device_id=device_id, success=True)
+    log_registrations([(device_id, ip_address) for _index, device_id, ip_address in registered])
+    
+    return jsonify({
+        "success": True,
+        "registered": sum(1 for result in results if result and result.get("success")),
+        "results": results
+    }), 200
+
+@app.route('/esp32/register/stats')
+def esp32_register_stats():
+    """Registration rate and counters"""
+    return jsonify(registration_monitor.describe()), 200
+
 @app.route('/esp32/connect', methods=['POST'])
 def esp32_connect():
     """Alternative endpoint for ESP32 device connection"""
@@ -304,33 +880,61 @@ def esp32_data():
         # Update last seen time for both storage systems
         current_time = time.time()
         
-        if device_id in network_devices:
-            network_devices[device_id]['last_seen'] = current_time
-            network_devices[device_id]['status'] = 'online'
+        touch_device(device_id, last_seen=current_time, status='online')
         
-        if device_id in esp32_devices:
-            esp32_devices[device_id]['last_seen'] = current_time
-            esp32_devices[device_id]['status'] = 'online'
-        else:
+        if device_id not in esp32_devices:
             # Add device if not exists
-            esp32_devices[device_id] = {
+            store_wifi_device(device_id, {
                 "ip_address": data.get('ip_address', 'unknown'),
                 "last_seen": current_time,
                 "status": "online",
                 "device_id": device_id,
                 "type": "wifi"
-            }
+            })
+        
+        # Numeric fields become queryable time series
+        metrics = telemetry.record(device_id, data, current_time)
         
         # Log the received data
         log_esp32_communication("received", f"Received {data_type} data: {data}", 
                               "info", device_id, "wifi")
         
-        return jsonify({"success": True, "message": "Data received"})
+        return jsonify({"success": True, "message": "Data received", "metrics": len(metrics)})
         
     except Exception as e:
         log_esp32_communication("received", f"Data reception error: {str(e)}", "error")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/esp32/telemetry')
+def telemetry_stats():
+    """Telemetry store size and memory bound"""
+    return jsonify(telemetry.describe()), 200
+
+@app.route('/esp32/telemetry/<device_id>')
+def device_telemetry(device_id):
+    """Telemetry for one device: ?metric=rssi,heap&start=&end= (epoch s) or &since=3600, &bucket=60 to downsample"""
+    if not request.args.get('metric'):
+        return jsonify({"device_id": device_id, "metrics": telemetry.metrics(device_id)}), 200
+    
+    end = request.args.get('end', type=float)
+    start = request.args.get('start', type=float)
+    since = request.args.get('since', type=float)
+    if since is not None:
+        start = time.time() - since
+    bucket = request.args.get('bucket', type=int)
+    if bucket is not None and bucket <= 0:
+        return jsonify({"error": "bucket must be a positive number of seconds"}), 400
+    
+    series = {}
+    for metric in request.args['metric'].split(','):
+        result = telemetry.query(device_id, metric.strip(), start, end, bucket)
+        if result is not None:
+            series[metric.strip()] = result
+    if not series:
+        return jsonify({"error": f"No telemetry for {device_id} ({request.args['metric']})"}), 404
+    return jsonify({"device_id": device_id, "start": start, "end": end, "bucket": bucket,
+                    "series": series}), 200
+
 @app.route('/vend', methods=['POST'])
 def vend_by_slot_name():
     """Vend by slot name (e.g., A1, B2, C3)"""
@@ -366,44 +970,74 @@ def vend_by_slot_name():
 def esp32_get_commands(device_id):
     """ESP32 polls for pending commands (WiFi mode)"""
     try:
-        # Update last seen time for both storage systems
         current_time = time.time()
         
-        if device_id in esp32_devices:
-            esp32_devices[device_id]['last_seen'] = current_time
-            esp32_devices[device_id]['status'] = 'online'
-            
-        if device_id in network_devices:
-            network_devices[device_id]['last_seen'] = current_time
-            network_devices[device_id]['status'] = 'online'
-        else:
-            # Add device if polling but not registered yet
-            network_devices[device_id] = {
-                "ip_address": request.remote_addr,
-                "last_seen": current_time,
-                "status": "online",
-                "device_id": device_id,
-                "type": "wifi"
-            }
-            esp32_devices[device_id] = network_devices[device_id]
+        # Known online device: liveness is one presence-slot write. Otherwise do the full registry update
+        if not state.presence.touch(device_id, current_time):
+            if not touch_device(device_id, last_seen=current_time, status='online'):
+                # Add device if polling but not registered yet
+                store_wifi_device(device_id, {
+                    "ip_address": request.remote_addr,
+                    "last_seen": current_time,
+                    "status": "online",
+                    "device_id": device_id,
+                    "type": "wifi"
+                })
         
-        # Check for pending commands
-        if device_id in pending_commands:
-            command = pending_commands.pop(device_id)  # Remove after sending
-            
+        # Next command by priority class (atomic take - another worker may be serving the same device)
+        # A drain that has taken its snapshot hands out nothing - the command would run again after the restart
+        command = None if drain_status["holding"] else state.take_command(device_id)
+        
+        # ?wait=N long-polls: hold the request until a command is queued (in any worker) or N seconds pass
+        if command is None and request.args and not drain_status["holding"]:
+            wait = min(request.args.get('wait', 0, type=float), MAX_POLL_WAIT)
+            if wait > 0 and state.wait_for_command(device_id, wait) and not drain_status["holding"]:
+                command = state.take_command(device_id)
+        
+        if command is not None:
             # Log the command being sent to WiFi device
-            command_str = f"{command.get('command')}:{command.get('slot')}" if command.get('slot') else command.get('command')
-            log_esp32_communication("sent", command_str, "command", 
+            log_esp32_communication("sent", format_command(command), "command", 
                                   device_id=device_id, device_type="wifi")
+            if "broadcast_id" in command:
+                broadcasts.delivered(device_id, command)
             
             return jsonify(command), 200
         else:
-            return jsonify(None), 200  # No commands pending
+            return app.response_class(EMPTY_POLL_BODY, mimetype="application/json")  # No commands pending
             
     except Exception as e:
         print(f"Error getting commands for {device_id}: {e}")
         return jsonify({"error": "Command retrieval failed"}), 500
 
+@app.route('/esp32/commands/<device_id>', methods=['POST'])
+def esp32_queue_command(device_id):
+    """Queue an operator or diagnostic command - vends still go out first (priority defaults from the name)"""
+    data = request.get_json(silent=True) or {}
+    command_name = str(data.get('command') or '').strip().upper()
+    if not command_name:
+        return jsonify({"error": "command is required"}), 400
+    if command_name.startswith("VEND"):
+        return jsonify({"error": "Use /vend to dispense - it tracks confirmations and inventory"}), 400
+    
+    priority = data.get('priority') or classify(command_name)
+    if priority not in PRIORITY_CLASSES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITY_CLASSES)}"}), 400
+    
+    if device_id.startswith('serial_'):
+        if not is_device_online(device_id):
+            return jsonify({"error": f"Serial device {device_id} is not connected"}), 409
+        esp32_serial.send_command(command_name, wait_for_response=False, priority=priority)
+        return jsonify({"device_id": device_id, "command": command_name, "priority": priority,
+                        "delivery": "serial", "queued": esp32_serial.command_queue.counts()}), 202
+    
+    if device_id not in esp32_devices and device_id not in network_devices:
+        return jsonify({"error": f"Unknown device {device_id}"}), 404
+    command = {"command": command_name, "timestamp": time.time()}
+    delivery = dispatch_wifi_command(device_id, command, priority)
+    queued = state.pending_commands(device_id).get(device_id, [])
+    return jsonify({"device_id": device_id, "command": command_name, "priority": priority,
+                    "delivery": delivery, "queued": len(queued)}), 202
+
 @app.route('/esp32/confirm', methods=['POST'])
 def esp32_confirm():
     """ESP32 sends confirmation of command execution (WiFi mode)"""
@@ -421,12 +1055,14 @@ def esp32_confirm():
         log_esp32_communication("received", message, msg_type, 
                               device_id=device_id, device_type="wifi")
         
-        # Update command history
-        for cmd in command_history:
-            if cmd.get('device_id') == device_id and cmd.get('slot') == slot:
-                cmd['status'] = 'completed' if success else 'failed'
-                cmd['result_message'] = message
-                break
+        try:
+            slot_number = int(slot)
+        except (TypeError, ValueError):
+            slot_number = None
+        
+        # Cancel the ack deadline, update history, settle stock and analytics
+        if slot_number is not None:
+            complete_vend(device_id, slot_number, success, message, data.get('command_id'))
         
         return jsonify({"status": "confirmation_received"}), 200
         
@@ -447,9 +1083,10 @@ def esp32_devices_list():
             "communication": "serial"
         })
     
+    seen = state.presence.snapshot()
     return jsonify({
         "serial_devices": serial_info,
-        "wifi_devices": list(esp32_devices.values()),
+        "wifi_devices": [with_presence(info, seen) for info in esp32_devices.values()],
         "total_devices": len(esp32_devices) + len(serial_info)
     })
 
@@ -457,10 +1094,402 @@ def esp32_devices_list():
 def command_history_view():
     """View command history"""
     return jsonify({
-        "commands": command_history[-50:],  # Last 50 commands
+        "commands": command_history.recent(50),  # Last 50 commands
         "total_commands": len(command_history)
     })
 
+@app.route('/esp32/commands/in-flight')
+def commands_in_flight():
+    """Commands waiting for confirmation, with their ack deadlines"""
+    in_flight = [
+        {key: record[key] for key in ("command_id", "device_id", "slot", "communication", "attempts", "deadline")}
+        for record in ack_tracker.in_flight()
+    ]
+    return jsonify({
+        "commands": in_flight[:200],
+        "total_in_flight": len(in_flight),
+        "stats": ack_tracker.stats
+    })
+
+# =================================
+# Fleet Broadcasts
+# =================================
+
+def broadcast_targets(data):
+    """Device ids a broadcast goes to - the "devices" list as given, else every known device
+    narrowed by "type" (serial/wifi) and "match" (fnmatch pattern), online only unless "include_offline"
+    """
+    if data.get('devices'):
+        return list(dict.fromkeys(str(device_id) for device_id in data['devices']))
+    
+    device_type = data.get('type')
+    include_offline = bool(data.get('include_offline'))
+    targets = []
+    if device_type in (None, 'serial') and esp32_serial and esp32_serial.port:
+        if include_offline or esp32_serial.is_connected:
+            targets.append(f"serial_{esp32_serial.port}")
+    if device_type in (None, 'wifi'):
+        if include_offline:
+            targets.extend(dict.fromkeys(list(esp32_devices) + list(network_devices)))
+        else:
+            targets.extend(get_online_wifi_devices())
+    
+    pattern = data.get('match')
+    if pattern:
+        targets = fnmatch.filter(targets, pattern)
+    return targets
+
+def dispatch_broadcast(broadcast, device_id):
+    """Send one device its copy of a broadcast command (runs on the broadcast pool)"""
+    if device_id.startswith('serial_'):
+        if not is_device_online(device_id):
+            broadcast.update(device_id, BROADCAST_FAILED, error="Serial device is not connected")
+            return
+        if broadcast.command == "STATUS":
+            # Shares the single-flight STATUS query, so the result carries the device's answer
+            broadcast.update(device_id, BROADCAST_QUEUED, delivery="serial")
+            reply = esp32_serial.get_status(max_age=0, timeout=broadcast.remaining())
+            if reply is None:
+                broadcast.update(device_id, BROADCAST_TIMEOUT, error="No STATUS reply before the deadline")
+            else:
+                broadcast.update(device_id, BROADCAST_REPLIED, reply=reply)
+            return
+        esp32_serial.send_command(broadcast.command, wait_for_response=False, priority=broadcast.priority)
+        broadcast.update(device_id, BROADCAST_SENT, delivery="serial")
+        return
+    
+    if cluster is not None and not cluster.is_local(device_id):
+        broadcast.update(device_id, BROADCAST_FAILED, error=f"Owned by node {cluster.owner(device_id)}")
+        return
+    if device_id not in esp32_devices and device_id not in network_devices:
+        broadcast.update(device_id, BROADCAST_FAILED, error="Unknown device")
+        return
+    command_id = f"{broadcast.broadcast_id}-{device_id}"
+    command = {"command": broadcast.command, "timestamp": time.time(),
+               "command_id": command_id, "broadcast_id": broadcast.broadcast_id}
+    delivery = dispatch_wifi_command(device_id, command, broadcast.priority)
+    if delivery == "push_unconfirmed":
+        broadcast.update(device_id, BROADCAST_FAILED, error="Push unconfirmed - the device may or may not have it")
+        return
+    if not broadcast.update(device_id, BROADCAST_PUSHED if delivery == "push" else BROADCAST_QUEUED, delivery=delivery):
+        if delivery == "poll":
+            state.withdraw_command(device_id, command_id)  # Broadcast was closed while this was being queued
+
+def finish_broadcast(broadcast):
+    """Close a broadcast at its deadline - every device ends with a final result
+    
+    Commands still waiting in a poll queue are withdrawn and time out, so a
+    finished broadcast never runs later. One that is gone from the queue was
+    taken by a poll (here, or in another worker with a shared backend).
+    """
+    for device_id, result in broadcast.unfinished():
+        if result["status"] == BROADCAST_QUEUED and result.get("delivery") == "poll":
+            if state.withdraw_command(device_id, f"{broadcast.broadcast_id}-{device_id}"):
+                broadcast.update(device_id, BROADCAST_TIMEOUT, error="Not picked up before the deadline - withdrawn")
+            else:
+                broadcast.update(device_id, BROADCAST_DELIVERED)
+        elif result["status"] == BROADCAST_PENDING:
+            broadcast.update(device_id, BROADCAST_TIMEOUT, error="Deadline passed before dispatch")
+        else:
+            broadcast.update(device_id, BROADCAST_TIMEOUT, error="No result before the deadline")
+    broadcasts.finish(broadcast)
+    return broadcast.summary()
+
+@app.route('/esp32/broadcast', methods=['GET', 'POST'])
+def esp32_broadcast():
+    """Fan a command out to the fleet (or a filtered part of it) and collect per-device results
+
+    POST {"command": "STATUS", "priority"?, "devices"?: [...], "type"?, "match"?, "include_offline"?, "timeout"?}
+    ?stream=1 answers with NDJSON: a header line, one line per result as it arrives, then a summary line.
+    GET lists running and recent broadcasts.
+    """
+    if request.method == 'GET':
+        return jsonify(broadcasts.describe())
+    
+    data = request.get_json(silent=True) or {}
+    command_name = str(data.get('command') or '').strip().upper()
+    if not command_name:
+        return jsonify({"error": "command is required"}), 400
+    if command_name.startswith("VEND"):
+        return jsonify({"error": "Vends cannot be broadcast - use /vend for each device"}), 400
+    priority = data.get('priority') or classify(command_name)
+    if priority not in PRIORITY_CLASSES:
+        return jsonify({"error": f"priority must be one of {', '.join(PRIORITY_CLASSES)}"}), 400
+    try:
+        timeout = float(data.get('timeout', BROADCAST_DEFAULT_TIMEOUT))
+    except (TypeError, ValueError):
+        return jsonify({"error": "timeout must be a number of seconds"}), 400
+    
+    targets = broadcast_targets(data)
+    if not targets:
+        return jsonify({"error": "No devices match the broadcast"}), 404
+    
+    broadcast = broadcasts.start(command_name, priority, targets, dispatch_broadcast, timeout)
+    log_esp32_communication("sent", f"Broadcast {command_name} to {len(targets)} devices ({broadcast.broadcast_id})",
+                            "command")
+    
+    if request.args.get('stream') == '1':
+        def generate():
+            finished = False
+            try:
+                yield json.dumps({"broadcast_id": broadcast.broadcast_id, "command": command_name,
+                                  "priority": priority, "devices": len(targets), "timeout": broadcast.timeout}) + "\n"
+                for event in broadcast.stream():
+                    yield json.dumps(event) + "\n"
+                summary = finish_broadcast(broadcast)
+                finished = True
+                # Results settled at the deadline (delivered, withdrawn, timed out) go out before the summary
+                for event in broadcast.pending_events():
+                    yield json.dumps(event) + "\n"
+                yield json.dumps(dict(summary, done=True)) + "\n"
+            finally:
+                if not finished:
+                    finish_broadcast(broadcast)  # Client went away - still close the broadcast
+        return app.response_class(generate(), mimetype='application/x-ndjson')
+    
+    broadcast.wait()
+    summary = finish_broadcast(broadcast)
+    return jsonify(dict(summary, results=list(broadcast.results.values()))), 200
+
+# =================================
+# Scheduled Vends
+# =================================
+
+def release_scheduled_vend(entry):
+    """A scheduled vend is due - dispatch it the way POST /vend would (runs on the release pool)"""
+    slot_id = entry.slot
+    if entry.device_id:
+        if not is_device_online(entry.device_id):
+            return {"status": SCHEDULE_FAILED, "error": f"Device {entry.device_id} is not online"}
+        candidates = [entry.device_id]
+    else:
+        candidates = []
+        if esp32_serial and esp32_serial.is_connected:
+            candidates.append(f"serial_{esp32_serial.port}")
+        candidates.extend(get_online_wifi_devices())
+        if not candidates:
+            print(f"🖥️ No ESP32 connected - Simulating scheduled VEND:{slot_id}")
+            return {"status": SCHEDULE_RELEASED, "communication": "simulation"}
+    
+    error = "Circuit open on every candidate device"
+    for device_id in candidates:
+        if not device_health.allow(device_id):
+            continue
+        if not slot_inventory.reserve(device_id, slot_id):
+            vend_analytics.record_rejected(device_id, slot_id)
+            error = f"Slot {slot_id} is empty"
+            continue
+        
+        record = dispatch_vend(device_id, slot_id)
+        if record is None:
+            slot_inventory.restore(device_id, slot_id)
+            error = f"Device {device_id} did not take the command"
+            continue
+        
+        print(f"🗓️ Scheduled vend {entry.schedule_id} released to {device_id}: Slot {slot_id}")
+        return {"status": SCHEDULE_RELEASED, "device_id": device_id, "command_id": record["command_id"],
+                "communication": record["communication"], "delivery": record["delivery"]}
+    return {"status": SCHEDULE_FAILED, "error": error}
+
+def schedule_items(data, now):
+    """(due_at, device_id, slot) for a POST /vend/schedule body - raises ValueError for a bad one
+
+    Every slot of every device, in that order, starting at "at" (epoch seconds) or
+    "delay" seconds from now, each "interval" seconds after the one before.
+    """
+    slots = data.get('slots') or [data.get('slot')]
+    devices = data.get('devices') or [data.get('device_id')]
+    if not isinstance(slots, list) or not isinstance(devices, list):
+        raise ValueError("slots and devices must be lists")
+    if None in slots:
+        raise ValueError("slot is required")
+    try:
+        slots = [int(slot) for slot in slots]
+        start = float(data['at']) if data.get('at') is not None else now + float(data.get('delay') or 0)
+        interval = float(data.get('interval') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("slot, at, delay and interval must be numbers")
+    if any(slot < 1 or slot > 5 for slot in slots):
+        raise ValueError("Invalid slot ID. Must be between 1-5")
+    if interval < 0:
+        raise ValueError("interval cannot be negative")
+    if len(slots) * len(devices) > MAX_SCHEDULE_BATCH:
+        raise ValueError(f"At most {MAX_SCHEDULE_BATCH} vends per request")
+    
+    devices = [str(device_id) if device_id else None for device_id in devices]
+    if cluster is not None:
+        remote = [device_id for device_id in devices
+                  if device_id and not device_id.startswith("serial_") and not cluster.is_local(device_id)]
+        if remote:
+            raise ValueError(f"Owned by other nodes, schedule them there: {', '.join(remote[:10])}")
+    
+    pairs = [(device_id, slot) for device_id in devices for slot in slots]
+    return [(start + index * interval, device_id, slot) for index, (device_id, slot) in enumerate(pairs)]
+
+@app.route('/vend/schedule', methods=['GET', 'POST', 'DELETE'])
+def scheduled_vends():
+    """Timed vends, released into device queues at their due time
+    
+    POST {"slot": 3, "device_id"?, "at": epoch | "delay": s, "reference"?} schedules one vend;
+    "slots"/"devices" lists with "interval" schedule a staggered sweep as one batch.
+    GET lists pending vends due soonest (?device_id=&batch_id=&limit=) and recent results.
+    DELETE ?batch_id= cancels a whole batch.
+    """
+    if request.method == 'GET':
+        info = vend_schedule.describe()
+        info["entries"] = vend_schedule.list(request.args.get('device_id'), request.args.get('batch_id'),
+                                             request.args.get('limit', SCHEDULE_DEFAULT_LIMIT, type=int))
+        return jsonify(info), 200
+    
+    if request.method == 'DELETE':
+        batch_id = request.args.get('batch_id')
+        if not batch_id:
+            return jsonify({"error": "batch_id is required"}), 400
+        record = vend_schedule.cancel_batch(batch_id)
+        if record is None:
+            return jsonify({"error": f"No pending vends in batch {batch_id}"}), 404
+        print(f"🗓️ Cancelled {record['cancelled']} scheduled vend(s) in {batch_id}")
+        return jsonify(record), 200
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        items = schedule_items(data, time.time())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    reference = data.get('reference')
+    try:
+        entries = vend_schedule.add(items, None if reference is None else str(reference))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 503
+    
+    print(f"🗓️ Scheduled {len(entries)} vend(s) as {entries[0].batch_id}, "
+          f"first due {datetime.fromtimestamp(entries[0].due_at).strftime('%Y-%m-%d %H:%M:%S')}")
+    return jsonify({
+        "batch_id": entries[0].batch_id,
+        "scheduled": len(entries),
+        "first_due": entries[0].due_at,
+        "last_due": entries[-1].due_at,
+        "schedule_ids": [entry.schedule_id for entry in entries]
+    }), 201
+
+@app.route('/vend/schedule/<schedule_id>', methods=['DELETE'])
+def scheduled_vend_cancel(schedule_id):
+    """Cancel one scheduled vend before it is released"""
+    record = vend_schedule.cancel(schedule_id)
+    if record is None:
+        return jsonify({"error": f"No pending scheduled vend {schedule_id}"}), 404
+    return jsonify(record), 200
+
+# =================================
+# Device Health
+# =================================
+
+@app.route('/esp32/health')
+def device_health_view():
+    """Rolling health and circuit state per device (?device_id= for one)"""
+    device_id = request.args.get('device_id')
+    if device_id:
+        return jsonify(dict(device_health.get(device_id), device_id=device_id)), 200
+    return jsonify({
+        "devices": device_health.snapshot(),
+        "stats": device_health.stats
+    }), 200
+
+@app.route('/esp32/health/<device_id>/reset', methods=['POST'])
+def device_health_reset(device_id):
+    """Operator override: close the circuit and forget the device's history"""
+    device_health.reset(device_id)
+    print(f"🩺 Health reset for {device_id}")
+    return jsonify({"device_id": device_id, "state": "closed"}), 200
+
+# =================================
+# Slot Inventory
+# =================================
+
+@app.route('/inventory')
+def inventory_list():
+    """Stock levels for every device with inventory data"""
+    devices = slot_inventory.snapshot_all()
+    return jsonify({
+        "devices": devices,
+        "tracked_devices": len(devices)
+    })
+
+@app.route('/inventory/<device_id>')
+def inventory_device(device_id):
+    """Stock levels for one device"""
+    return jsonify(slot_inventory.snapshot(device_id))
+
+@app.route('/inventory/<device_id>/restock', methods=['POST'])
+def inventory_restock(device_id):
+    """Restock slots: {"slots": {"1": 10, "2": 8}, "mode": "set"|"add", "capacity": {"1": 12}}"""
+    try:
+        data = request.get_json() or {}
+        mode = data.get('mode', 'set')
+        if mode not in ('set', 'add'):
+            return jsonify({"error": "Invalid mode. Must be 'set' or 'add'"}), 400
+        
+        raw_levels = data.get('slots')
+        if raw_levels is None and 'slot' in data:
+            raw_levels = {data['slot']: data.get('quantity', 0)}
+        if not isinstance(raw_levels, dict) or not raw_levels:
+            return jsonify({"error": "slots required, e.g. {\"slots\": {\"1\": 10}}"}), 400
+        
+        levels = {}
+        capacities = {}
+        for slot, units in raw_levels.items():
+            slot = int(slot)
+            units = int(units)
+            if slot < 1 or slot > slot_inventory.slot_count or units < 0:
+                return jsonify({"error": f"Invalid slot {slot} or quantity {units}"}), 400
+            levels[slot] = units
+        for slot, cap in (data.get('capacity') or {}).items():
+            capacities[int(slot)] = int(cap)
+        
+        slot_inventory.restock(device_id, levels, mode=mode, capacities=capacities)
+        log_esp32_communication("sent", f"Restocked slots {sorted(levels)} ({mode})", "info", 
+                              device_id=device_id)
+        
+        return jsonify(slot_inventory.snapshot(device_id)), 200
+        
+    except (TypeError, ValueError):
+        return jsonify({"error": "Slots and quantities must be integers"}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# =================================
+# Vend Analytics
+# =================================
+
+@app.route('/analytics')
+def analytics():
+    """Windowed vend counters: ?window=minute|hour|day&device_id=...&slot=...&series=1"""
+    window = request.args.get('window', 'hour')
+    if window not in ANALYTICS_WINDOWS:
+        return jsonify({"error": f"Invalid window. Must be one of {list(ANALYTICS_WINDOWS)}"}), 400
+    
+    device_id = request.args.get('device_id') or None
+    slot = request.args.get('slot', type=int)
+    include_series = request.args.get('series') in ('1', 'true')
+    
+    result = vend_analytics.query(window, device_id, slot, include_series)
+    
+    # Per-slot breakdown for the same scope (fixed 5 lookups)
+    if slot is None:
+        result["by_slot"] = {
+            str(s): vend_analytics.query(window, device_id, s)["totals"]
+            for s in range(1, slot_inventory.slot_count + 1)
+        }
+    
+    result.update({
+        "window": window,
+        "bucket_seconds": ANALYTICS_WINDOWS[window][0],
+        "device_id": device_id,
+        "slot": slot
+    })
+    return jsonify(result)
+
 # =================================
 # ESP32 Connection Management
 # =================================
@@ -493,6 +1522,9 @@ def esp32_serial_connect():
         if not port:
             return jsonify({"error": "Port required"}), 400
         
+        if serial_discovery["state"] == "discovering":
+            return jsonify({"error": "Serial discovery in progress - try again in a moment"}), 409
+        
         # Attempt connection
         success = esp32_serial.connect(port)
         
@@ -540,14 +1572,27 @@ def esp32_serial_disconnect():
 
 @app.route('/esp32/serial/status', methods=['GET'])
 def esp32_serial_status():
-    """Get detailed ESP32 serial status"""
+    """Get detailed ESP32 serial status (device_status is cached - ?refresh=1 queries a stale device)"""
     if not esp32_serial:
         return jsonify({"error": "Serial communication not available"}), 500
     
+    if request.args.get('refresh') == '1':
+        device_status = esp32_serial.get_status()  # Shared with any query already on the wire
+    else:
+        device_status = esp32_serial.last_status
+    status_age = esp32_serial.status_age()
+    
     return jsonify({
         "connected": esp32_serial.is_connected,
         "port": esp32_serial.port,
         "auto_reconnect": esp32_serial.auto_reconnect,
+        "reconnecting": esp32_serial.reconnecting,
+        "reconnect_count": esp32_serial.reconnect_count,
+        "device_status": device_status,
+        "device_status_age": round(status_age, 3) if status_age is not None else None,
+        "status_queries": esp32_serial.status_stats,
+        "writes": dict(esp32_serial.write_stats, pacing_ms=esp32_serial.command_pacing * 1000),
+        "discovery": serial_discovery,
         "has_connection": esp32_serial.serial_connection is not None,
         "connection_open": esp32_serial.serial_connection.is_open if esp32_serial.serial_connection else False
     }), 200
@@ -572,7 +1617,11 @@ def communication_mode():
             "wifi_devices": len(wifi_devices),
             "wifi_device_list": wifi_devices,
             "modes": ["serial", "wifi", "simulation"],
-            "active_device": active_device
+            "active_device": get_active_device(),
+            "push_delivery": {
+                "enabled": PUSH_DELIVERY_ENABLED,
+                "stats": push_delivery.stats
+            }
         }), 200
     
     elif request.method == 'POST':
@@ -592,26 +1641,31 @@ def get_online_wifi_devices():
     """Get list of online WiFi devices from both storage systems"""
     online_devices = []
     current_time = time.time()
+    seen = state.presence.snapshot()  # Polls keep last_seen here
     
     # Check esp32_devices
     for device_id, device_info in esp32_devices.items():
         if device_info.get('status') == 'online':
             # Check if device is still active (last seen within 30 seconds)
-            last_seen = device_info.get('last_seen', 0)
+            last_seen = with_presence(device_info, seen).get('last_seen', 0)
             if current_time - last_seen < 30:
                 online_devices.append(device_id)
             else:
-                # Mark as offline if too much time has passed
+                # Mark as offline if too much time has passed (its next poll takes the full update path)
                 device_info['status'] = 'offline'
+                esp32_devices[device_id] = device_info
+                state.presence.release(device_id)
     
     # Check network_devices as well
     for device_id, device_info in network_devices.items():
         if device_id not in online_devices and device_info.get('status') == 'online':
-            last_seen = device_info.get('last_seen', 0)
+            last_seen = with_presence(device_info, seen).get('last_seen', 0)
             if current_time - last_seen < 30:
                 online_devices.append(device_id)
             else:
                 device_info['status'] = 'offline'
+                network_devices[device_id] = device_info
+                state.presence.release(device_id)
     
     return online_devices
 
@@ -637,7 +1691,9 @@ def list_all_devices():
         devices.append(serial_device)
     
     # Add WiFi devices from both storage locations
+    seen = state.presence.snapshot()
     for device_id, device_info in esp32_devices.items():
+        device_info = with_presence(device_info, seen)
         wifi_device = {
             "device_id": device_id,
             "type": "wifi",
@@ -653,6 +1709,7 @@ def list_all_devices():
     for device_id, device_info in network_devices.items():
         # Check if device already added from esp32_devices
         if not any(d['device_id'] == device_id for d in devices):
+            device_info = with_presence(device_info, seen)
             wifi_device = {
                 "device_id": device_id,
                 "type": "wifi",
@@ -666,7 +1723,7 @@ def list_all_devices():
     
     return jsonify({
         "devices": devices,
-        "active_device": active_device,
+        "active_device": get_active_device(),
         "total_devices": len(devices),
         "connected_devices": len([d for d in devices if d['connected']])
     })
@@ -674,8 +1731,6 @@ def list_all_devices():
 @app.route('/esp32/devices/select', methods=['POST'])
 def select_active_device():
     """Select which device to use for commands"""
-    global active_device
-    
     try:
         data = request.get_json()
         device_id = data.get('device_id')
@@ -714,12 +1769,12 @@ def select_active_device():
                 "status": "offline"
             }), 400
         
-        active_device = device_id
+        set_active_device(device_id)
         
         print(f"🎯 Active device selected: {device_id} ({device_type})")
         
         return jsonify({
-            "active_device": active_device,
+            "active_device": device_id,
             "device_type": device_type,
             "message": f"Active device set to {device_id}",
             "status": "online"
@@ -731,8 +1786,6 @@ def select_active_device():
 @app.route('/esp32/devices/auto-select', methods=['POST'])
 def auto_select_device():
     """Auto-select best available device based on priority"""
-    global active_device
-    
     try:
         # Priority: Serial first, then WiFi
         selected_device = None
@@ -753,15 +1806,15 @@ def auto_select_device():
                 print(f"🎯 Auto-selected WiFi device: {selected_device}")
         
         if selected_device:
-            active_device = selected_device
+            set_active_device(selected_device)
             return jsonify({
-                "active_device": active_device,
+                "active_device": selected_device,
                 "device_type": device_type,
-                "message": f"Auto-selected {device_type} device: {active_device}",
+                "message": f"Auto-selected {device_type} device: {selected_device}",
                 "status": "online"
             }), 200
         else:
-            active_device = None
+            set_active_device(None)
             return jsonify({
                 "active_device": None,
                 "device_type": None,
@@ -774,17 +1827,37 @@ def auto_select_device():
 
 @app.route('/esp32/communication/log')
 def communication_log():
-    """Get recent ESP32 communication log"""
-    return jsonify({
-        "log_entries": esp32_comm_log[-50:],  # Last 50 entries
-        "total_entries": len(esp32_comm_log)
-    })
+    """Recent ESP32 communication log - filter with device_id, type, direction, since/until (epoch s), after_seq
+    
+    With after_seq the entries right after it come back a page (limit) at a time, and
+    updated_entries carries lines already past the cursor whose message changed since.
+    """
+    device_id = request.args.get('device_id')
+    msg_type = request.args.get('type')
+    direction = request.args.get('direction')
+    after_seq = request.args.get('after_seq', type=int)
+    entries = comm_log.query(
+        device_id=device_id,
+        msg_type=msg_type,
+        direction=direction,
+        since=request.args.get('since', type=float),
+        until=request.args.get('until', type=float),
+        after_seq=after_seq,
+        limit=request.args.get('limit', DEFAULT_LOG_LIMIT, type=int)
+    )
+    result = {
+        "log_entries": entries,
+        "total_entries": len(comm_log),
+        "last_seq": comm_log.last_seq()
+    }
+    if after_seq is not None:
+        result["updated_entries"] = comm_log.changed(after_seq, device_id, msg_type, direction)
+    return jsonify(result)
 
 @app.route('/esp32/communication/log/clear', methods=['POST'])
 def clear_communication_log():
     """Clear the communication log"""
-    global esp32_comm_log
-    esp32_comm_log = []
+    comm_log.clear()
     return jsonify({"message": "Communication log cleared"})
 
 @app.route('/esp32/communication/test', methods=['POST'])
@@ -808,66 +1881,415 @@ def test_communication_log():
         "entries_added": len(test_entries)
     })
 
+def apply_heartbeat_batch(batch):
+    """Bulk liveness update from the UDP heartbeat channel (runs once per flush, on the heartbeat worker)
+
+    Returns the ids that are not registered - a heartbeat carries no registration data, so an
+    unknown sender is ignored until it calls POST /esp32/register.
+    """
+    unknown = []
+    # One transaction per flush on a shared backend
+    with state.transaction():
+        for device_id, (sequence, status_code, received_at, ip_address) in batch.items():
+            if cluster is not None and not cluster.is_local(device_id):
+                continue  # Another node owns it - it stays online there through its polls
+            
+            fields = {"last_seen": received_at, "status": "online", "heartbeat_seq": sequence}
+            if status_code is not None:
+                fields["device_state"] = HEARTBEAT_STATUS.get(status_code, f"code_{status_code}")
+            if not touch_device(device_id, **fields):
+                unknown.append(device_id)
+    return unknown
+
 def start_udp_discovery_service():
-    """Start UDP service for ESP32 auto-discovery"""
-    import socket
-    import threading
+    """Start UDP services: ESP32 auto-discovery (port 12346) and heartbeats (port 12347)"""
+    global udp_services, heartbeat_protocol
     
-    def udp_discovery_handler():
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            sock.bind(('', 12346))
-            sock.settimeout(1.0)  # Non-blocking with timeout
-            
-            print("📻 UDP discovery service started on port 12346")
-            
-            while True:
-                try:
-                    data, addr = sock.recvfrom(1024)
-                    message = data.decode()
-                    
-                    if message == "ESP32_DISCOVERY_REQUEST":
-                        # Get local IP address
-                        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                        s.connect(("8.8.8.8", 80))
-                        local_ip = s.getsockname()[0]
-                        s.close()
-                        
-                        # Send response with Flask server IP
-                        response = f"FLASK_SERVER:{local_ip}"
-                        sock.sendto(response.encode(), addr)
-                        print(f"📡 Sent discovery response to {addr[0]}: {local_ip}")
-                        
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    print(f"⚠️ UDP discovery error: {e}")
-                    break
-                    
-        except Exception as e:
-            print(f"⚠️ Failed to start UDP discovery: {e}")
+    try:
+        udp_services = start_discovery_service(log_callback=log_esp32_communication)
+    except Exception as e:
+        print(f"⚠️ Failed to start UDP discovery: {e}")
+        return udp_services
     
-    # Start UDP discovery in background thread
-    threading.Thread(target=udp_discovery_handler, daemon=True).start()
-
-if __name__ == '__main__':
-    print("🏪 Flask Vending Machine Server (Hybrid Communication)")
-    print("=" * 60)
+    try:
+        heartbeat_protocol = start_heartbeat_service(udp_services, apply_heartbeat_batch)
+    except Exception as e:
+        print(f"⚠️ Failed to start UDP heartbeat service: {e}")
     
-    # Start UDP discovery service for fast ESP32 detection
-    start_udp_discovery_service()
+    return udp_services
+
+def discover_serial_device():
+    """Find and connect the USB ESP32 - runs on a background thread while the server is already serving"""
+    serial_discovery["state"] = "discovering"
+    serial_discovery["started_at"] = time.time()
     
-    # Try to connect to ESP32 via serial
-    if esp32_serial:
+    try:
+        # Auto-detect ESP32 port dynamically (any port, any ESP32)
+        detected_port = esp32_serial._auto_detect_port()
+        if detected_port:
+            esp32_serial.set_port(detected_port)
+            print(f"📡 ESP32 dynamically detected on port: {detected_port}")
+        else:
+            # Only if absolutely no ESP32 found, use platform defaults
+            import platform
+            default_port = "COM3" if platform.system() == "Windows" else "/dev/ttyUSB0"
+            esp32_serial.set_port(default_port)
+            print(f"📡 No ESP32 detected, using fallback port: {default_port}")
+        
         print("🔌 Attempting to connect to ESP32 via USB serial...")
         if esp32_serial.connect():
+            serial_discovery["state"] = "connected"
             print(f"✅ ESP32 connected via serial (USB port: {esp32_serial.port})")
         else:
+            serial_discovery["state"] = "not_found"
             print("❌ ESP32 not found on serial port")
             print("   Make sure ESP32 is connected via USB")
             print("   You can manually connect through the web interface")
             print("   Use the Connection Management panel at http://localhost:5000")
+    except Exception as e:
+        serial_discovery["state"] = "error"
+        print(f"⚠️ ESP32 serial discovery error: {e}")
+    finally:
+        serial_discovery["finished_at"] = time.time()
+
+def build_snapshot(pending_commands=None):
+    """Everything a restarted server needs to route to the fleet straight away"""
+    seen = state.presence.snapshot()
+    return {
+        "devices": {device_id: with_presence(info, seen) for device_id, info in esp32_devices.items()},
+        "network_devices": {device_id: with_presence(info, seen) for device_id, info in network_devices.items()},
+        "pending_commands": state.pending_commands() if pending_commands is None else pending_commands,
+        "active_device": get_active_device(),
+        "inventory": slot_inventory.snapshot_all(),
+        "comm_log": comm_log.recent(SNAPSHOT_LOG_ENTRIES),
+        "scheduled_vends": vend_schedule.pending_entries()
+    }
+
+def requeue_commands(pending):
+    """Queue commands from a snapshot or hand-off: {device_id: [{"priority", "command"}, ...]}
+
+    Snapshots written before priority classes held a single command per device.
+    """
+    count = 0
+    for device_id, queued in (pending or {}).items():
+        if isinstance(queued, dict):
+            queued = [{"command": queued}]
+        for item in queued:
+            state.queue_command(device_id, item["command"], item.get("priority"))
+            count += 1
+    return count
+
+def restore_snapshot(snapshot):
+    """Load a drain snapshot - devices keep their last_seen, so only recently seen ones count as online"""
+    restored_commands = 0
+    
+    # A shared backend already kept devices, queued commands, stock and the comm log in its database
+    if not state.shared:
+        with state.transaction():
+            for device_id, device_info in snapshot.get("devices", {}).items():
+                esp32_devices[device_id] = device_info
+            for device_id, device_info in snapshot.get("network_devices", {}).items():
+                network_devices[device_id] = device_info
+                if device_info.get('status') == 'online':
+                    state.presence.assign(device_id, device_info.get('last_seen', 0))
+            restored_commands = requeue_commands(snapshot.get("pending_commands"))
+            if snapshot.get("active_device"):
+                set_active_device(snapshot["active_device"])
+        
+        for device_id, stock in snapshot.get("inventory", {}).items():
+            if stock.get("tracked"):
+                slots = stock.get("slots", {})
+                slot_inventory.restock(device_id, {int(slot): info["available"] for slot, info in slots.items()},
+                                       "set", {int(slot): info["capacity"] for slot, info in slots.items()
+                                               if info.get("capacity") is not None})
+        
+        for entry in snapshot.get("comm_log", []):
+            comm_log.append(entry.get("direction"), entry.get("message"), entry.get("type"), entry.get("device_id", "unknown"),
+                            entry.get("device_type", "unknown"), entry.get("timestamp"))
+    
+    # Schedules are per process - only the worker that claimed the snapshot gets here, so each entry is armed once
+    # A full schedule raises, and create_app() keeps the snapshot aside rather than dropping the entries
+    restored_schedule = vend_schedule.restore(snapshot.get("scheduled_vends"))
+    print(f"♻️ Warm restart: {len(snapshot.get('devices', {}))} devices, "
+          f"{restored_commands} queued commands, {restored_schedule} scheduled vends restored from snapshot")
+
+def hold_queued_commands():
+    """End poll delivery and take every queued command for the snapshot
+
+    The take is atomic per queue, so each command either went out to a poll already or is in the
+    snapshot - never both. A shared backend keeps its queue across the restart instead, so there
+    polls only stop on this worker and the queue stays where it is.
+    """
+    drain_status["holding"] = True
+    if state.shared:
+        return state.pending_commands()
+    held = drain_status["held_commands"]
+    for device_id, queued in state.take_all_commands().items():
+        held.setdefault(device_id, []).extend(queued)
+    return held
+
+def drain_and_snapshot(timeout=None):
+    """Stop taking vends, wait up to timeout for in-flight confirmations, then write the snapshot"""
+    timeout = DRAIN_TIMEOUT if timeout is None else timeout
+    drain_status["draining"] = True
+    drain_status["started_at"] = time.time()
+    vend_schedule.stop()  # Pending scheduled vends wait in the snapshot instead of firing mid-drain
+    
+    waiting = len(ack_tracker)
+    if waiting:
+        print(f"⏳ Draining: waiting up to {timeout:.0f}s for {waiting} in-flight vend confirmation(s)")
+    deadline = time.time() + timeout
+    while len(ack_tracker) and time.time() < deadline and drain_status["draining"]:
+        time.sleep(0.1)
+    if not drain_status["draining"]:
+        return {"cancelled": True}  # DELETE /admin/drain arrived while waiting
+    
+    result = {
+        "waited_seconds": round(time.time() - drain_status["started_at"], 2),
+        "unconfirmed": len(ack_tracker),
+        "snapshot_path": SNAPSHOT_PATH
+    }
+    try:
+        snapshot = build_snapshot(hold_queued_commands())
+        result["snapshot_bytes"] = write_snapshot(SNAPSHOT_PATH, snapshot)
+        result["devices"] = len(snapshot["devices"])
+        result["pending_commands"] = sum(len(queued) for queued in snapshot["pending_commands"].values())
+        result["scheduled_vends"] = len(snapshot["scheduled_vends"])
+        print(f"💾 Snapshot written: {result['devices']} devices, {result['pending_commands']} queued commands "
+              f"({result['snapshot_bytes']} bytes)")
+    except Exception as e:
+        result["error"] = str(e)
+        print(f"⚠️ Failed to write snapshot: {e}")
+    
+    drain_status["snapshot"] = result
+    for archive in archives.values():
+        archive.flush()
+    return result
+
+def resume_from_drain():
+    """Leave drain mode - held commands go back on the queues and the snapshot is deleted (it would replay them)"""
+    held = drain_status["held_commands"]
+    requeued = requeue_commands(held) if not state.shared else 0
+    remove_snapshot(SNAPSHOT_PATH)
+    drain_status.update(draining=False, started_at=None, snapshot=None, holding=False, held_commands={})
+    vend_schedule.start()
+    print(f"▶️ Drain called off - {requeued} queued command(s) back on the queues")
+    return {"status": "online", "requeued_commands": requeued}
+
+@app.route('/admin/drain', methods=['POST', 'DELETE'])
+def admin_drain():
+    """POST: drain mode and a snapshot (vends get 503, polls get nothing once it is written); DELETE: resume"""
+    if request.method == 'DELETE':
+        if not drain_status["draining"]:
+            return jsonify({"error": "Server is not draining"}), 409
+        return jsonify(resume_from_drain()), 200
+    data = request.get_json(silent=True) or {}
+    return jsonify(drain_and_snapshot(data.get('timeout'))), 200
+
+@app.route('/admin/timings', methods=['GET', 'DELETE'])
+def admin_timings():
+    """Per-route latency percentiles since startup or the last reset (DELETE resets)"""
+    if request.method == 'DELETE':
+        route_timings.reset()
+        return jsonify({"status": "reset"}), 200
+    return jsonify(route_timings.summary(include_buckets=request.args.get('buckets') == '1')), 200
+
+@app.route('/admin/profile')
+def admin_profile():
+    """Sample every thread's stack for ?seconds= (default 5) and return the profile
+    
+    format=collapsed (default) returns folded stacks for flamegraph.pl/speedscope;
+    format=json returns per-thread counts and the hottest functions.
+    """
+    seconds = request.args.get('seconds', 5, type=float)
+    interval = request.args.get('interval_ms', 5, type=float) / 1000
+    output = request.args.get('format', 'collapsed')
+    
+    try:
+        stacks, rounds = profiler.run(seconds, interval)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    
+    if output == 'json':
+        return jsonify(profile_summary(stacks, rounds, interval)), 200
+    return app.response_class(collapsed_text(stacks), mimetype='text/plain'), 200
+
+@app.route('/admin/archive')
+def admin_archive():
+    """Archived segment counts and sizes per stream"""
+    if not archives:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, "streams": {name: archive.describe() for name, archive in archives.items()}}), 200
+
+@app.route('/admin/archive/<stream>/export')
+def admin_archive_export(stream):
+    """Stream archived records as NDJSON (?since=&until= epoch seconds) - constant memory, any size"""
+    archive = archives.get(stream)
+    if archive is None:
+        return jsonify({"error": f"Unknown archive stream: {stream} (use {', '.join(archives) or 'none - archiving is off'})"}), 404
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    
+    return app.response_class(archive.export(since, until), mimetype='application/x-ndjson',
+                              headers={"Content-Disposition": f'attachment; filename="{stream}-export.ndjson"'})
+
+# =================================
+# Cluster Membership & Heartbeat Stats
+# =================================
+
+@app.route('/cluster')
+def cluster_info():
+    """Sharding membership, forwarding counters, and the owner of ?device_id="""
+    if cluster is None:
+        return jsonify({"enabled": False}), 200
+    
+    info = cluster.describe()
+    info["enabled"] = True
+    info["local_devices"] = len(esp32_devices)
+    device_id = request.args.get('device_id')
+    if device_id:
+        info["owner"] = cluster.owner(device_id)
+    return jsonify(info), 200
+
+@app.route('/cluster/nodes', methods=['POST'])
+def cluster_set_nodes():
+    """Change membership ({"nodes": {"a": "http://host:5000", ...}}) and hand off devices that moved
+    
+    Send the same node list to every node. Consistent hashing means only the
+    devices on the arcs of added/removed nodes change owner.
+    """
+    if cluster is None:
+        return jsonify({"error": "Sharding is not enabled on this node"}), 400
+    
+    data = request.get_json(silent=True) or {}
+    nodes = data.get('nodes')
+    if not isinstance(nodes, dict) or not nodes:
+        return jsonify({"error": "nodes must map node ids to base URLs"}), 400
+    
+    try:
+        added, removed = cluster.set_nodes({name: url.rstrip('/') for name, url in nodes.items()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Devices that now hash to another node move there with their queued commands
+    moved = {}
+    seen = state.presence.snapshot()
+    for device_id, device_info in esp32_devices.items():
+        owner = cluster.owner(device_id)
+        if owner != cluster.node_id:
+            moved.setdefault(owner, []).append(with_presence(device_info, seen))
+    
+    handed_off = 0
+    failed = {}
+    for owner, devices in moved.items():
+        device_ids = [device["device_id"] for device in devices]
+        queued = {}
+        for device_id in device_ids:
+            queued.update(state.pending_commands(device_id))
+        payload = {"devices": devices, "pending_commands": queued}
+        status_code, _headers, _body = cluster.forward(owner, "POST", "/cluster/handoff", json.dumps(payload),
+                                                       {"Content-Type": "application/json"})
+        if status_code != 200:
+            failed[owner] = len(devices)
+            continue
+        
+        for device_id in device_ids:
+            esp32_devices.pop(device_id, None)
+            network_devices.pop(device_id, None)
+            state.presence.release(device_id)
+            state.drop_commands(device_id)
+            push_delivery.drop(device_id)
+        handed_off += len(devices)
+    
+    print(f"🧭 Cluster membership changed (+{added} -{removed}) - {handed_off} devices handed off")
+    return jsonify({
+        "added": added,
+        "removed": removed,
+        "moved_devices": handed_off,
+        "failed_handoffs": failed,
+        "local_devices": len(esp32_devices)
+    }), 200
+
+@app.route('/cluster/handoff', methods=['POST'])
+def cluster_handoff():
+    """Take over devices (and their queued commands) from a node that no longer owns them"""
+    # Hand-offs carry push URLs and commands - only other nodes may send them
+    if cluster is None or not cluster.is_peer(request.remote_addr):
+        return jsonify({"error": "Hand-offs are only accepted from cluster nodes"}), 403
+    data = request.get_json(silent=True) or {}
+    devices = data.get('devices') or []
+    
+    with state.transaction():
+        for device_info in devices:
+            device_id = device_info.get('device_id')
+            if device_id:
+                store_wifi_device(device_id, device_info)
+        requeue_commands(data.get('pending_commands'))
+    
+    print(f"🧭 Took over {len(devices)} devices from node {request.headers.get(FORWARDED_HEADER, 'unknown')}")
+    return jsonify({"accepted": len(devices)}), 200
+
+@app.route('/esp32/heartbeat/stats')
+def heartbeat_stats():
+    """UDP heartbeat channel counters"""
+    if not heartbeat_protocol:
+        return jsonify({"enabled": False}), 200
+    
+    return jsonify({
+        "enabled": True,
+        "stats": heartbeat_protocol.stats,
+        "tracked_devices": len(heartbeat_protocol.last_sequence)
+    }), 200
+
+def create_app():
+    """Application factory - returns the app and starts background services once
+    
+    Nothing slow happens at import time: UDP services and the ack timer start here,
+    and serial port discovery runs on a background thread so requests are served
+    immediately (GET /status reports "discovering" until it finishes).
+    WSGI servers can load "app:create_app()".
+    """
+    global _background_started
+    
+    if _background_started:
+        return app
+    _background_started = True
+    
+    # Devices from the last drain are routable before any of them re-registers
+    # One worker claims the file; it goes only once the restore has worked - a bad entry keeps it aside for recovery
+    snapshot_path = claim_snapshot(SNAPSHOT_PATH)
+    snapshot = read_snapshot(snapshot_path, SNAPSHOT_MAX_AGE, consume=False) if snapshot_path else None
+    if snapshot:
+        try:
+            restore_snapshot(snapshot)
+        except Exception as e:
+            print(f"⚠️ Snapshot restore failed: {e}")
+            set_aside_snapshot(snapshot_path)
+        else:
+            remove_snapshot(snapshot_path)
+    
+    ack_tracker.wheel.start()
+    vend_schedule.start()
+    for archive in archives.values():
+        archive.start()
+    
+    # Start UDP discovery service for fast ESP32 detection
+    start_udp_discovery_service()
+    
+    if esp32_serial:
+        serial_discovery["state"] = "discovering"
+        threading.Thread(target=discover_serial_device, name="serial-discovery", daemon=True).start()
+    
+    return app
+
+if __name__ == '__main__':
+    print("🏪 Flask Vending Machine Server (Hybrid Communication)")
+    print("=" * 60)
+    
+    # UDP services start now; serial discovery continues in the background
+    create_app()
+    if esp32_serial:
+        print("🔍 Searching for a USB ESP32 in the background (GET /status shows progress)")
     
     print("\n📡 Server will also accept WiFi ESP32 connections")
     print("   WiFi ESP32s should use esp32_wifi_vend.ino firmware")
@@ -881,12 +2303,31 @@ if __name__ == '__main__':
     print("   2. WiFi Network (polled)")
     print("   3. Simulation (fallback)")
     
-    print("\n🛑 Press Ctrl+C to stop the server")
+    print("\n🛑 Press Ctrl+C to stop the server (drains first; press again to stop at once)")
     print("=" * 60)
     
+    from werkzeug.serving import make_server
+    import signal
+    
+    # No debug reloader - auto-restart interferes with serial connections
+    server = make_server('0.0.0.0', 5000, app, threaded=True)
+    
+    def request_shutdown(signum, frame):
+        if drain_status["draining"]:
+            raise KeyboardInterrupt  # Second Ctrl+C - stop without waiting
+        print("\n\n🛑 Shutdown requested - draining (new vends are refused)")
+        # Keep serving while draining so confirmations can still arrive
+        threading.Thread(target=lambda: (drain_and_snapshot(), server.shutdown()), daemon=True).start()
+    
+    signal.signal(signal.SIGINT, request_shutdown)
+    signal.signal(signal.SIGTERM, request_shutdown)
+    
     try:
-        # Disable debug mode to prevent auto-restart that interferes with serial connections
-        app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
+        server.serve_forever()
+        print("🛑 Server stopped")
+        if esp32_serial and esp32_serial.is_connected:
+            esp32_serial.disconnect()
+            print("🔌 ESP32 serial connection closed")
     except KeyboardInterrupt:
         print("\n\n🛑 Server stopped by user")
         if esp32_serial and esp32_serial.is_connected:
@@ -35,7 +35,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Monitor state
     let isMonitoring = false;
     let monitorInterval = null;
-    let lastLogCount = 0;
+    let lastLogSeq = 0;
+    const LOG_PAGE_SIZE = 100;      // Entries per request - the display keeps the last 100 anyway
+    const LOG_PAGES_PER_POLL = 10;  // A bigger backlog is caught up on the next polls, never skipped
     let selectedDevice = null;
     
     // Initialize
@@ -525,41 +527,62 @@ document.addEventListener('DOMContentLoaded', function() {
      */
     async function updateCommunicationLog() {
         try {
-            const response = await fetch('/esp32/communication/log');
-            const data = await response.json();
-            
-            if (response.ok) {
+            // The server returns entries after the last one shown, a page at a time - page until one comes back short
+            for (let page = 0; page < LOG_PAGES_PER_POLL; page++) {
+                const response = await fetch(`/esp32/communication/log?after_seq=${lastLogSeq}&limit=${LOG_PAGE_SIZE}`);
+                if (!response.ok) {
+                    return;
+                }
+                const data = await response.json();
                 const logEntries = data.log_entries || [];
-                const totalEntries = data.total_entries || 0;
                 
                 // Update log count
-                logCountElement.textContent = `${totalEntries} messages`;
+                logCountElement.textContent = `${data.total_entries || 0} messages`;
                 
-                // Show only new entries
-                if (logEntries.length > lastLogCount) {
-                    const newEntries = logEntries.slice(lastLogCount);
-                    
-                    newEntries.forEach(entry => {
+                // Lines already shown whose message changed since (coalesced registration bursts)
+                (data.updated_entries || []).forEach(updateLogEntry);
+                
+                if (logEntries.length > 0) {
+                    logEntries.forEach(entry => {
                         addLogEntry(entry);
                     });
                     
-                    lastLogCount = logEntries.length;
+                    lastLogSeq = logEntries[logEntries.length - 1].seq;
                     
                     // Auto-scroll to bottom
                     communicationLogElement.scrollTop = communicationLogElement.scrollHeight;
                 }
+                if (logEntries.length < LOG_PAGE_SIZE) {
+                    return;
+                }
             }
         } catch (error) {
             console.warn('Could not update communication log:', error);
         }
     }
     
+    /**
+     * Refresh the message of a log line that is still displayed
+     */
+    function updateLogEntry(entry) {
+        const logDiv = communicationLogElement.querySelector(`.log-entry[data-seq="${entry.seq}"]`);
+        if (!logDiv || Number(logDiv.dataset.updatedSeq || 0) >= entry.updated_seq) {
+            return;
+        }
+        logDiv.dataset.updatedSeq = entry.updated_seq;
+        logDiv.querySelector('.log-message').textContent = entry.message || '';
+    }
+    
     /**
      * Add a log entry to the display
      */
     function addLogEntry(entry) {
         const logDiv = document.createElement('div');
         logDiv.className = `log-entry ${entry.direction} ${entry.type}`;
+        logDiv.dataset.seq = entry.seq;
+        if (entry.updated_seq) {
+            logDiv.dataset.updatedSeq = entry.updated_seq;
+        }
         
         const timestamp = entry.formatted_time || new Date().toLocaleTimeString();
         const direction = entry.direction === 'sent' ? 'SENT' : 'RECV';
@@ -612,7 +635,7 @@ document.addEventListener('DOMContentLoaded', function() {
             
             if (response.ok) {
                 communicationLogElement.innerHTML = '<div class="log-placeholder">Communication log cleared</div>';
-                lastLogCount = 0;
+                lastLogSeq = 0;
                 logCountElement.textContent = '0 messages';
                 updateMessage('✅ Communication log cleared', 'success');
             } else {
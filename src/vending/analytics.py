@@ -0,0 +1,165 @@
+"""
+Vend Analytics
+Incrementally aggregated vend counters in minute/hour/day ring buffers
+"""
+
+import threading
+import time
+from array import array
+from collections import deque
+
+COUNT_FIELDS = ("dispatched", "success", "failure", "rejected")
+
+# window name -> (bucket resolution in seconds, number of buckets)
+WINDOWS = {
+    "minute": (1, 60),
+    "hour": (60, 60),
+    "day": (3600, 24)
+}
+
+MAX_IN_FLIGHT_PER_SLOT = 64  # Dispatch timestamps kept for latency matching
+
+class RollingWindow:
+    """Fixed ring of time buckets - old buckets are reset lazily when their slot is reused"""
+
+    def __init__(self, resolution, bucket_count):
+        self.resolution = resolution
+        self.bucket_count = bucket_count
+        self.epochs = array("q", [-1] * bucket_count)
+        self.counts = {field: array("L", [0] * bucket_count) for field in COUNT_FIELDS}
+        self.latency_sum = array("d", [0.0] * bucket_count)
+        self.latency_max = array("d", [0.0] * bucket_count)
+        self.latency_count = array("L", [0] * bucket_count)
+
+    def _bucket(self, now):
+        epoch = int(now // self.resolution)
+        index = epoch % self.bucket_count
+        if self.epochs[index] != epoch:
+            self.epochs[index] = epoch
+            for counts in self.counts.values():
+                counts[index] = 0
+            self.latency_sum[index] = 0.0
+            self.latency_max[index] = 0.0
+            self.latency_count[index] = 0
+        return index
+
+    def add(self, field, now, latency=None):
+        index = self._bucket(now)
+        self.counts[field][index] += 1
+        if latency is not None:
+            self.latency_sum[index] += latency
+            self.latency_count[index] += 1
+            if latency > self.latency_max[index]:
+                self.latency_max[index] = latency
+
+    def totals(self, now):
+        """Sum the live buckets - bounded by bucket_count, independent of history length"""
+        oldest = int(now // self.resolution) - self.bucket_count
+        totals = {field: 0 for field in COUNT_FIELDS}
+        latency_sum = 0.0
+        latency_count = 0
+        latency_max = 0.0
+
+        for index in range(self.bucket_count):
+            if self.epochs[index] <= oldest:
+                continue
+            for field in COUNT_FIELDS:
+                totals[field] += self.counts[field][index]
+            latency_sum += self.latency_sum[index]
+            latency_count += self.latency_count[index]
+            latency_max = max(latency_max, self.latency_max[index])
+
+        completed = totals["success"] + totals["failure"]
+        totals["success_rate"] = round(totals["success"] / completed, 4) if completed else None
+        totals["avg_latency_ms"] = round(latency_sum / latency_count * 1000, 1) if latency_count else None
+        totals["max_latency_ms"] = round(latency_max * 1000, 1) if latency_count else None
+        return totals
+
+    def series(self, now):
+        """Per-bucket counts, oldest first"""
+        current = int(now // self.resolution)
+        points = []
+        for epoch in range(current - self.bucket_count + 1, current + 1):
+            index = epoch % self.bucket_count
+            live = self.epochs[index] == epoch
+            point = {"t": epoch * self.resolution}
+            for field in COUNT_FIELDS:
+                point[field] = self.counts[field][index] if live else 0
+            points.append(point)
+        return points
+
+class VendSeries:
+    """Minute, hour and day windows for one aggregation key"""
+
+    def __init__(self):
+        self.windows = {name: RollingWindow(res, count) for name, (res, count) in WINDOWS.items()}
+
+    def add(self, field, now, latency=None):
+        for window in self.windows.values():
+            window.add(field, now, latency)
+
+class VendAnalytics:
+    """Vend counters per fleet, device, slot and device+slot, updated on every vend and confirm"""
+
+    def __init__(self):
+        self.series = {}     # key -> VendSeries (allocated on first event)
+        self.in_flight = {}  # (device_id, slot) -> deque of dispatch times
+        self.lock = threading.Lock()
+
+    def _keys(self, device_id, slot):
+        return (("all",), ("device", device_id), ("slot", slot), ("device_slot", device_id, slot))
+
+    def _add(self, device_id, slot, field, now, latency=None):
+        for key in self._keys(device_id, slot):
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = VendSeries()
+            series.add(field, now, latency)
+
+    def record_dispatch(self, device_id, slot, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._add(device_id, slot, "dispatched", now)
+            pending = self.in_flight.get((device_id, slot))
+            if pending is None:
+                pending = self.in_flight[(device_id, slot)] = deque(maxlen=MAX_IN_FLIGHT_PER_SLOT)
+            pending.append(now)
+
+    def record_result(self, device_id, slot, success, now=None):
+        """Vend confirmed (or failed) - latency is measured from the oldest matching dispatch"""
+        now = time.time() if now is None else now
+        with self.lock:
+            pending = self.in_flight.get((device_id, slot))
+            latency = now - pending.popleft() if pending else None
+            self._add(device_id, slot, "success" if success else "failure", now, latency)
+
+    def record_rejected(self, device_id, slot, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._add(device_id, slot, "rejected", now)
+
+    def query(self, window="hour", device_id=None, slot=None, include_series=False, now=None):
+        """Windowed totals for the fleet, a device, a slot, or a device+slot"""
+        now = time.time() if now is None else now
+        if device_id is not None and slot is not None:
+            key = ("device_slot", device_id, slot)
+        elif device_id is not None:
+            key = ("device", device_id)
+        elif slot is not None:
+            key = ("slot", slot)
+        else:
+            key = ("all",)
+
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = VendSeries()  # No events yet - report zeros
+            ring = series.windows[window]
+            result = {"totals": ring.totals(now)}
+            if include_series:
+                result["series"] = ring.series(now)
+            return result
+
+    def devices(self):
+        with self.lock:
+            return [key[1] for key in self.series if key[0] == "device"]
@@ -0,0 +1,199 @@
+"""
+Log Archive
+Size-rotated gzip NDJSON segments with a sparse time index, and streaming range exports
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024   # Rotate to a new segment file past this size
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024     # Oldest segments are deleted beyond this per stream
+FLUSH_INTERVAL = 2.0                       # Buffered records are compressed as one block this often...
+BLOCK_RECORDS = 2000                       # ...or once this many are waiting
+MAX_BUFFERED = 20 * BLOCK_RECORDS          # Writer fell behind (or never started) - flush in the caller
+SEGMENT_SUFFIX = ".ndjson.gz"
+INDEX_SUFFIX = ".idx"
+
+class SegmentArchive:
+    """One stream of records (dicts with a "timestamp") spilled to disk
+
+    Every flush appends one gzip member to the current segment and one line to
+    its index: {"offset", "length", "first", "last", "count"}. A multi-member gzip
+    file is still a normal .gz file (zcat works), and the index lets an export
+    jump straight to the first block of a time range.
+    """
+
+    def __init__(self, directory, stream, segment_bytes=DEFAULT_SEGMENT_BYTES, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.stream = stream
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.write_lock = threading.Lock()  # One writer at a time (flusher thread, export, overflow)
+        self.segment_path = None
+        self.segment_size = 0
+        self.stats = {"records": 0, "blocks": 0, "segments": 0, "deleted_segments": 0, "errors": 0}
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()  # Set once a full block is waiting
+
+    def append(self, record):
+        with self.buffer_lock:
+            self.buffer.append(record)
+            waiting = len(self.buffer)
+        if waiting >= MAX_BUFFERED:
+            self.flush()
+        elif waiting >= BLOCK_RECORDS:
+            self._wake.set()
+
+    def start(self):
+        """Compress and write buffered records on a background thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"archive-{self.stream}", daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def flush(self):
+        """Write everything buffered as one block - returns the number of records written"""
+        with self.write_lock:
+            with self.buffer_lock:
+                records, self.buffer = self.buffer, []
+            if not records:
+                return 0
+            try:
+                self._write_block(records)
+            except (OSError, TypeError, ValueError) as e:
+                self.stats["errors"] += 1
+                print(f"⚠️ Archive {self.stream}: dropped {len(records)} records ({e})")
+                return 0
+            return len(records)
+
+    def _write_block(self, records):
+        data = "".join(json.dumps(record, separators=(",", ":"), default=str) + "\n" for record in records)
+        block = gzip.compress(data.encode("utf-8"), compresslevel=6)
+
+        if self.segment_path is None or self.segment_size >= self.segment_bytes:
+            self._rotate(records[0].get("timestamp", time.time()))
+
+        with open(self.segment_path, "ab") as f:
+            f.write(block)
+        timestamps = [record.get("timestamp", 0) for record in records]
+        with open(self.segment_path + INDEX_SUFFIX, "a") as f:
+            f.write(json.dumps({"offset": self.segment_size, "length": len(block), "first": min(timestamps),
+                                "last": max(timestamps), "count": len(records)}) + "\n")
+
+        self.segment_size += len(block)
+        self.stats["records"] += len(records)
+        self.stats["blocks"] += 1
+
+    def _rotate(self, first_timestamp):
+        os.makedirs(self.directory, exist_ok=True)
+        # Start time first so names sort chronologically; the pid keeps workers sharing a directory apart
+        name = f"{self.stream}-{int(first_timestamp * 1000):013d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment_size = 0
+        self.stats["segments"] += 1
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        segments = self.segments()
+        total = sum(size for _path, size in segments)
+        for path, size in segments:
+            if total <= self.max_bytes or path == self.segment_path:
+                break
+            for victim in (path, path + INDEX_SUFFIX):
+                try:
+                    os.unlink(victim)
+                except OSError:
+                    pass
+            total -= size
+            self.stats["deleted_segments"] += 1
+
+    def segments(self):
+        """(path, size) of this stream's segments, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        prefix = f"{self.stream}-"
+        segments = []
+        for name in sorted(names):
+            if name.startswith(prefix) and name.endswith(SEGMENT_SUFFIX):
+                path = os.path.join(self.directory, name)
+                try:
+                    segments.append((path, os.path.getsize(path)))
+                except OSError:
+                    pass
+        return segments
+
+    def _blocks(self, path):
+        try:
+            with open(path + INDEX_SUFFIX) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            return []
+
+    def export(self, since=None, until=None):
+        """Generator of NDJSON byte chunks (one per block) for records in [since, until]
+
+        Whole blocks inside the range are passed through without parsing; only the
+        blocks at the edges are filtered line by line. Memory is one block.
+        """
+        self.flush()
+        for path, _size in self.segments():
+            blocks = self._blocks(path)
+            if not blocks:
+                continue
+            if since is not None and blocks[-1]["last"] < since:
+                continue
+            if until is not None and blocks[0]["first"] > until:
+                continue
+
+            with open(path, "rb") as f:
+                for block in blocks:
+                    if since is not None and block["last"] < since:
+                        continue
+                    if until is not None and block["first"] > until:
+                        break
+                    f.seek(block["offset"])
+                    data = gzip.decompress(f.read(block["length"]))
+
+                    inside = ((since is None or block["first"] >= since) and
+                              (until is None or block["last"] <= until))
+                    if inside:
+                        yield data
+                        continue
+                    lines = [line for line in data.splitlines(keepends=True)
+                             if _in_range(json.loads(line).get("timestamp", 0), since, until)]
+                    if lines:
+                        yield b"".join(lines)
+
+    def describe(self):
+        segments = self.segments()
+        with self.buffer_lock:
+            buffered = len(self.buffer)
+        return dict(self.stats,
+                    stream=self.stream,
+                    directory=self.directory,
+                    buffered=buffered,
+                    segment_count=len(segments),
+                    archived_bytes=sum(size for _path, size in segments),
+                    max_bytes=self.max_bytes)
+
+def _in_range(timestamp, since, until):
+    return (since is None or timestamp >= since) and (until is None or timestamp <= until)
@@ -0,0 +1,162 @@
+"""
+Fleet Broadcasts
+Fan one command out to many devices concurrently and collect per-device results against a single deadline
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+
+DEFAULT_TIMEOUT = 10.0     # WiFi devices pick commands up on their next poll (2-10 s apart)
+MAX_TIMEOUT = 60.0
+DISPATCH_WORKERS = 16      # Pushes block on HTTP and shared-backend queue writes on the database
+DISPATCH_CHUNK = 64        # Devices per pool task - keeps task overhead small on big fleets
+RECENT_BROADCASTS = 20
+
+# Per-device results. Final ones end that device's part of the broadcast
+PENDING = "pending"        # Not dispatched yet
+QUEUED = "queued"          # In the device's poll queue (or the serial queue, waiting on a reply)
+DELIVERED = "delivered"    # Taken by the device's poll
+PUSHED = "pushed"          # POSTed to the device's command endpoint
+SENT = "sent"              # Handed to the serial writer
+REPLIED = "replied"        # Serial device answered (STATUS)
+FAILED = "failed"
+TIMEOUT = "timeout"
+FINAL_STATUSES = {DELIVERED, PUSHED, SENT, REPLIED, FAILED, TIMEOUT}
+
+class Broadcast:
+    """One fan-out: results per device, plus an event queue for streaming them as they change"""
+
+    def __init__(self, command, priority, device_ids, timeout):
+        self.broadcast_id = f"bc-{uuid.uuid4().hex[:12]}"  # Unique across workers sharing a queue
+        self.command = command
+        self.priority = priority
+        self.device_ids = device_ids
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + timeout
+        self.timeout = timeout
+        self.results = {device_id: {"device_id": device_id, "status": PENDING} for device_id in device_ids}
+        self.outstanding = len(device_ids)
+        self.events = Queue()
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        if not device_ids:
+            self.done.set()
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def update(self, device_id, status, **fields):
+        """Record a device's progress - ignored once that device has a final result"""
+        with self.lock:
+            result = self.results.get(device_id)
+            if result is None or result["status"] in FINAL_STATUSES:
+                return False
+            result.update(fields, status=status, elapsed_ms=round((time.time() - self.started_at) * 1000, 1))
+            self.events.put(dict(result))  # Queued before done is set, so stream() never misses the last one
+            if status in FINAL_STATUSES:
+                self.outstanding -= 1
+                if self.outstanding == 0:
+                    self.done.set()
+        return True
+
+    def unfinished(self):
+        """(device_id, result) for every device without a final result yet"""
+        with self.lock:
+            return [(device_id, dict(result)) for device_id, result in self.results.items()
+                    if result["status"] not in FINAL_STATUSES]
+
+    def pending_events(self):
+        """Events queued but not yet streamed"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except Empty:
+                return events
+
+    def wait(self):
+        """Block until every device has a final result or the deadline passes - True if all finished"""
+        return self.done.wait(self.remaining())
+
+    def stream(self):
+        """Result events as they happen, until every device is final or the deadline passes"""
+        while True:
+            if (self.done.is_set() or not self.remaining()) and self.events.empty():
+                return
+            try:
+                yield self.events.get(timeout=max(min(self.remaining(), 0.5), 0.001))
+            except Empty:
+                pass
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for result in self.results.values():
+                counts[result["status"]] = counts.get(result["status"], 0) + 1
+            return counts
+
+    def summary(self):
+        return {
+            "broadcast_id": self.broadcast_id,
+            "command": self.command,
+            "priority": self.priority,
+            "devices": len(self.device_ids),
+            "started_at": self.started_at,
+            "timeout": self.timeout,
+            "complete": self.done.is_set(),
+            "outstanding": self.outstanding,
+            "counts": self.counts()
+        }
+
+class BroadcastTracker:
+    """Runs fan-outs on a shared thread pool and routes poll deliveries back to live broadcasts"""
+
+    def __init__(self, workers=DISPATCH_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="broadcast")
+        self.active = {}  # broadcast_id -> Broadcast
+        self.recent = deque(maxlen=RECENT_BROADCASTS)
+        self.lock = threading.Lock()
+        self.stats = {"broadcasts": 0, "devices": 0}
+
+    def start(self, command, priority, device_ids, dispatch, timeout=DEFAULT_TIMEOUT):
+        """Begin a broadcast - dispatch(broadcast, device_id) runs on the pool and reports through update()"""
+        timeout = min(max(float(timeout), 0.0), MAX_TIMEOUT)
+        broadcast = Broadcast(command, priority, list(device_ids), timeout)
+        with self.lock:
+            self.active[broadcast.broadcast_id] = broadcast
+            self.stats["broadcasts"] += 1
+            self.stats["devices"] += len(broadcast.device_ids)
+        for start in range(0, len(broadcast.device_ids), DISPATCH_CHUNK):
+            self.pool.submit(self._dispatch_chunk, broadcast, broadcast.device_ids[start:start + DISPATCH_CHUNK], dispatch)
+        return broadcast
+
+    def _dispatch_chunk(self, broadcast, device_ids, dispatch):
+        for device_id in device_ids:
+            if not broadcast.remaining():
+                broadcast.update(device_id, TIMEOUT, error="Deadline passed before dispatch")
+                continue
+            try:
+                dispatch(broadcast, device_id)
+            except Exception as e:
+                broadcast.update(device_id, FAILED, error=str(e))
+
+    def delivered(self, device_id, command):
+        """A poll handed out a command - credit it to its broadcast if that is still running here"""
+        broadcast = self.active.get(command.get("broadcast_id"))
+        if broadcast is not None:
+            broadcast.update(device_id, DELIVERED)
+
+    def finish(self, broadcast):
+        with self.lock:
+            self.active.pop(broadcast.broadcast_id, None)
+            self.recent.append(broadcast.summary())
+
+    def describe(self):
+        with self.lock:
+            active = [broadcast.summary() for broadcast in self.active.values()]
+            recent = list(self.recent)
+        return dict(self.stats, active=active, recent=recent[::-1])
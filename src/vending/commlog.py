@@ -0,0 +1,267 @@
+"""
+Communication Log
+Retained ESP32 traffic with per-device, per-type and per-direction sequence indexes for filtered queries
+"""
+
+import bisect
+import threading
+import time
+from array import array
+from datetime import datetime
+
+DEFAULT_RETENTION = 100000        # Entries kept in total
+DEFAULT_DEVICE_RETENTION = 10000  # ...and per device, so one chatty device cannot push the others out
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 5000
+COMPACT_MIN = 1024                # Trimmed index fronts are reclaimed once this many slots are dead
+
+# Entries are stored as tuples (about a third the size of a dict) and turned into dicts on the way out
+SEQ, TIMESTAMP, DIRECTION, MESSAGE, TYPE, DEVICE_ID, DEVICE_TYPE = range(7)
+
+def entry_dict(entry, updated_seq=None):
+    result = {
+        "seq": entry[SEQ],
+        "timestamp": entry[TIMESTAMP],
+        "direction": entry[DIRECTION],
+        "message": entry[MESSAGE],
+        "type": entry[TYPE],
+        "formatted_time": datetime.fromtimestamp(entry[TIMESTAMP]).strftime("%H:%M:%S.%f")[:-3],
+        "device_id": entry[DEVICE_ID],
+        "device_type": entry[DEVICE_TYPE]
+    }
+    if updated_seq is not None:
+        result["updated_seq"] = updated_seq  # Message was rewritten (coalesced line) - newest rewrite
+    return result
+
+class SeqSegment:
+    """Ascending sequence numbers (optionally with their timestamps) - appended at the end, trimmed at the front"""
+
+    __slots__ = ("seqs", "times", "start")
+
+    def __init__(self, with_times=False):
+        self.seqs = array("Q")
+        self.times = array("d") if with_times else None
+        self.start = 0
+
+    def append(self, seq, timestamp=None):
+        self.seqs.append(seq)
+        if self.times is not None:
+            self.times.append(timestamp)
+
+    def __len__(self):
+        return len(self.seqs) - self.start
+
+    def oldest(self):
+        return self.seqs[self.start] if len(self) else None
+
+    def popleft(self):
+        seq = self.seqs[self.start]
+        self.start += 1
+        if self.start >= COMPACT_MIN and self.start * 2 >= len(self.seqs):
+            del self.seqs[:self.start]
+            if self.times is not None:
+                del self.times[:self.start]
+            self.start = 0
+        return seq
+
+    def position(self, seq):
+        """Index of the first stored seq >= seq"""
+        return bisect.bisect_left(self.seqs, seq, self.start)
+
+    def seq_at_time(self, timestamp, after=False):
+        """First seq logged at/after timestamp (after=True: strictly after) - needs times"""
+        search = bisect.bisect_right if after else bisect.bisect_left
+        index = search(self.times, timestamp, self.start)
+        return self.seqs[index] if index < len(self.seqs) else None
+
+    def retain(self, alive):
+        """Drop seqs no longer stored (entries evicted from the middle)"""
+        keep = [index for index in range(self.start, len(self.seqs)) if self.seqs[index] in alive]
+        if self.times is not None:
+            self.times = array("d", [self.times[index] for index in keep])
+        self.seqs = array("Q", [self.seqs[index] for index in keep])
+        self.start = 0
+
+class CommunicationLog:
+    """Global sequence index plus per-device, per-type and per-direction segments
+
+    Filtered reads walk the smallest matching segment from the newest end, so a
+    query costs about what it returns, not the size of the log.
+    """
+
+    def __init__(self, retention=DEFAULT_RETENTION, device_retention=DEFAULT_DEVICE_RETENTION):
+        self.retention = retention
+        self.device_retention = device_retention
+        self.entries = {}  # seq -> entry tuple
+        self.updated = {}  # seq -> updated_seq, for entries whose message was rewritten
+        self.order = SeqSegment(with_times=True)
+        self.by_device = {}
+        self.by_type = {}
+        self.by_direction = {}
+        self.next_seq = 1
+        self.appends_since_compact = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, direction, message, msg_type, device_id, device_type, timestamp=None):
+        """Log one entry - returns its sequence number"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            entry = (seq, timestamp, direction, message, msg_type, device_id, device_type)
+            self.entries[seq] = entry
+            self.order.append(seq, timestamp)
+            for index, key in ((self.by_device, device_id), (self.by_type, msg_type), (self.by_direction, direction)):
+                segment = index.get(key)
+                if segment is None:
+                    segment = index[key] = SeqSegment()
+                segment.append(seq)
+
+            device_segment = self.by_device[device_id]
+            if len(device_segment) > self.device_retention:
+                self._evict(self.entries[device_segment.oldest()])
+            if len(self.entries) > self.retention:
+                self._evict_oldest()
+            self.appends_since_compact += 1
+            if self.appends_since_compact >= self.retention:
+                self._compact()
+            return seq
+
+    def _evict_oldest(self):
+        while len(self.order):
+            entry = self.entries.get(self.order.popleft())
+            if entry is not None:
+                self._evict(entry)
+                return
+
+    def _evict(self, entry):
+        """Drop an entry - it is always the oldest of its device, so that segment is trimmed at the front"""
+        seq = entry[SEQ]
+        del self.entries[seq]
+        self.updated.pop(seq, None)
+        device_segment = self.by_device[entry[DEVICE_ID]]
+        device_segment.popleft()
+        if not len(device_segment):
+            del self.by_device[entry[DEVICE_ID]]
+        for index, key in ((self.by_type, entry[TYPE]), (self.by_direction, entry[DIRECTION])):
+            segment = index[key]
+            if segment.oldest() == seq:
+                segment.popleft()
+
+    def _compact(self):
+        """Evictions leave dead seqs inside the shared indexes - rebuild them once per `retention` appends"""
+        self.appends_since_compact = 0
+        alive = self.entries
+        self.order.retain(alive)
+        for index in (self.by_type, self.by_direction):
+            for key in list(index):
+                index[key].retain(alive)
+                if not len(index[key]):
+                    del index[key]
+
+    def update_message(self, seq, message):
+        """Rewrite a retained entry's message (coalesced log lines) - returns its updated_seq, or None
+
+        The entry keeps its place, and the rewrite takes the next sequence number
+        as its updated_seq, so readers polling with after_seq see it again (changed()).
+        """
+        with self.lock:
+            entry = self.entries.get(seq)
+            if entry is None:
+                return None
+            self.entries[seq] = entry[:MESSAGE] + (message,) + entry[MESSAGE + 1:]
+            updated_seq = self.updated[seq] = self.next_seq
+            self.next_seq += 1
+            return updated_seq
+
+    def changed(self, after_seq, device_id=None, msg_type=None, direction=None):
+        """Entries up to after_seq whose message was rewritten after it - what a poller already showed, now stale"""
+        with self.lock:
+            found = []
+            for seq, updated_seq in self.updated.items():
+                if seq > after_seq or updated_seq <= after_seq:
+                    continue
+                entry = self.entries[seq]
+                if ((device_id is None or entry[DEVICE_ID] == device_id) and
+                        (msg_type is None or entry[TYPE] == msg_type) and
+                        (direction is None or entry[DIRECTION] == direction)):
+                    found.append((entry, updated_seq))
+        found.sort(key=lambda item: item[0][SEQ])
+        return [entry_dict(entry, updated_seq) for entry, updated_seq in found]
+
+    def query(self, device_id=None, msg_type=None, direction=None, since=None, until=None, after_seq=None,
+              limit=DEFAULT_LIMIT):
+        """Newest `limit` entries matching every filter, oldest first
+
+        With after_seq it pages forward instead: the `limit` entries right after
+        after_seq. A full page means there may be more - ask again from its last seq.
+        """
+        limit = max(0, min(int(limit), MAX_LIMIT))
+        with self.lock:
+            low = (after_seq or 0) + 1
+            high = self.next_seq
+            if since is not None:
+                low = max(low, self.order.seq_at_time(since) or high)
+            if until is not None:
+                high = min(high, self.order.seq_at_time(until, after=True) or high)
+
+            # Walk the smallest matching segment, check the remaining filters per entry
+            candidates = []
+            for index, value, field in ((self.by_device, device_id, DEVICE_ID), (self.by_type, msg_type, TYPE),
+                                        (self.by_direction, direction, DIRECTION)):
+                if value is None:
+                    continue
+                if value not in index:
+                    return []
+                candidates.append((index[value], field, value))
+            candidates.sort(key=lambda candidate: len(candidate[0]))
+            segment = candidates[0][0] if candidates else self.order
+            checks = [(field, value) for _segment, field, value in candidates[1:]]
+
+            found = []
+            if after_seq is not None:
+                position = segment.position(low)
+                stop = segment.position(high)
+                step = 1
+            else:
+                position = segment.position(high) - 1
+                stop = segment.position(low) - 1
+                step = -1
+            while (position < stop if step > 0 else position > stop) and len(found) < limit:
+                seq = segment.seqs[position]
+                entry = self.entries.get(seq)
+                position += step
+                if entry is None or any(entry[field] != value for field, value in checks):
+                    continue
+                found.append((entry, self.updated.get(seq)))
+            if step < 0:
+                found.reverse()
+        return [entry_dict(entry, updated_seq) for entry, updated_seq in found]
+
+    def recent(self, limit=DEFAULT_LIMIT):
+        return self.query(limit=limit)
+
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.updated = {}
+            self.order = SeqSegment(with_times=True)
+            self.by_device = {}
+            self.by_type = {}
+            self.by_direction = {}
+
+    def describe(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "retention": self.retention,
+                "device_retention": self.device_retention,
+                "devices": len(self.by_device),
+                "last_seq": self.next_seq - 1
+            }
@@ -0,0 +1,313 @@
+"""
+UDP Discovery Service
+Answers ESP32 broadcast discovery requests from an asyncio datagram endpoint
+"""
+
+import asyncio
+import ipaddress
+import socket
+import struct
+import sys
+import threading
+import time
+
+DISCOVERY_PORT = 12346
+DISCOVERY_REQUEST = b"ESP32_DISCOVERY_REQUEST"
+DISCOVERY_RESPONSE_PREFIX = "FLASK_SERVER:"
+
+class InterfaceAddressCache:
+    """Local IPv4 interface addresses, computed once and refreshed when interfaces change"""
+
+    def __init__(self, refresh_interval=30.0, miss_refresh_interval=5.0, check_interval=2.0):
+        self.check_interval = check_interval
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self.interfaces = []  # [(IPv4Network, "192.168.1.10"), ...]
+        self.signature = None
+        self.last_refresh = 0.0
+        self.refresh()
+
+    def refresh(self):
+        """Re-read interface addresses"""
+        interfaces = []
+        for address, netmask in self._read_interfaces():
+            try:
+                network = ipaddress.IPv4Network(f"{address}/{netmask}", strict=False)
+            except ValueError:
+                continue
+            interfaces.append((network, address))
+
+        # Most specific subnet first so overlapping networks resolve correctly
+        interfaces.sort(key=lambda item: item[0].prefixlen, reverse=True)
+
+        changed = interfaces != self.interfaces
+        self.interfaces = interfaces
+        self.signature = self._interface_signature()
+        self.last_refresh = time.monotonic()
+        return changed
+
+    def maybe_refresh(self):
+        """Cheap periodic check - re-reads addresses when the interface set changes or the cache is old"""
+        if (self._interface_signature() != self.signature or
+                time.monotonic() - self.last_refresh > self.refresh_interval):
+            return self.refresh()
+        return False
+
+    def address_for(self, requester_ip):
+        """Pick the local address on the requester's subnet"""
+        try:
+            requester = ipaddress.IPv4Address(requester_ip)
+        except ValueError:
+            return self.primary_address()
+
+        for network, address in self.interfaces:
+            if requester in network:
+                return address
+
+        # Unknown subnet - interfaces may have changed since the last refresh
+        if time.monotonic() - self.last_refresh > self.miss_refresh_interval:
+            self.refresh()
+            for network, address in self.interfaces:
+                if requester in network:
+                    return address
+
+        return self._route_address(requester_ip) or self.primary_address()
+
+    def primary_address(self):
+        """First non-loopback address (or loopback if that's all there is)"""
+        for network, address in self.interfaces:
+            if not network.is_loopback:
+                return address
+        return "127.0.0.1"
+
+    def _route_address(self, requester_ip):
+        """Ask the kernel which source address routes to the requester (no packets are sent)"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect((requester_ip, DISCOVERY_PORT))
+            return s.getsockname()[0]
+        except OSError:
+            return None
+        finally:
+            s.close()
+
+    def _interface_signature(self):
+        try:
+            return tuple(socket.if_nameindex())
+        except (AttributeError, OSError):
+            return None
+
+    def _read_interfaces(self):
+        """Return [(address, netmask)] using the best method available on this platform"""
+        try:
+            import psutil
+            results = []
+            for addrs in psutil.net_if_addrs().values():
+                for addr in addrs:
+                    if addr.family == socket.AF_INET and addr.netmask:
+                        results.append((addr.address, addr.netmask))
+            if results:
+                return results
+        except ImportError:
+            pass
+
+        if sys.platform.startswith("linux"):
+            results = self._read_interfaces_ioctl()
+            if results:
+                return results
+
+        # Portable fallback: hostname addresses, assuming /24 networks
+        results = [("127.0.0.1", "255.0.0.0")]
+        try:
+            for address in socket.gethostbyname_ex(socket.gethostname())[2]:
+                if not address.startswith("127."):
+                    results.append((address, "255.255.255.0"))
+        except OSError:
+            pass
+        return results
+
+    def _read_interfaces_ioctl(self):
+        import fcntl
+        SIOCGIFADDR = 0x8915
+        SIOCGIFNETMASK = 0x891B
+
+        results = []
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for _index, name in socket.if_nameindex():
+                packed = struct.pack("256s", name[:15].encode())
+                try:
+                    address = socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFADDR, packed)[20:24])
+                    netmask = socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFNETMASK, packed)[20:24])
+                except OSError:
+                    continue  # Interface has no IPv4 address
+                results.append((address, netmask))
+        finally:
+            s.close()
+        return results
+
+class SourceRateLimiter:
+    """Token bucket per source IP so a misbehaving device can't monopolise the responder"""
+
+    def __init__(self, rate=2.0, burst=5, max_sources=65536):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self.buckets = {}  # ip -> [tokens, last_update]
+
+    def allow(self, source_ip, now=None):
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(source_ip)
+
+        if bucket is None:
+            if len(self.buckets) >= self.max_sources:
+                self._prune(now)
+            self.buckets[source_ip] = [self.burst - 1.0, now]
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1.0:
+            bucket[0] = tokens - 1.0
+            return True
+        bucket[0] = tokens
+        return False
+
+    def _prune(self, now):
+        """Drop buckets that have fully refilled - they behave exactly like new sources"""
+        full_after = self.burst / self.rate
+        stale = [ip for ip, (_t, last) in self.buckets.items() if now - last >= full_after]
+        for ip in stale:
+            del self.buckets[ip]
+        if len(self.buckets) >= self.max_sources:
+            self.buckets.clear()
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    """Replies FLASK_SERVER:<ip> to ESP32_DISCOVERY_REQUEST, picking the requester's subnet"""
+
+    def __init__(self, addresses, rate_limiter, log_callback=None):
+        self.addresses = addresses
+        self.rate_limiter = rate_limiter
+        self.log_callback = log_callback
+        self.transport = None
+        self.responses_cache = {}  # local ip -> encoded response
+        self.stats = {"requests": 0, "responses": 0, "rate_limited": 0, "ignored": 0}
+        self.known_sources = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data.strip() != DISCOVERY_REQUEST:
+            self.stats["ignored"] += 1
+            return
+
+        self.stats["requests"] += 1
+        source_ip = addr[0]
+        if not self.rate_limiter.allow(source_ip):
+            self.stats["rate_limited"] += 1
+            return
+
+        local_ip = self.addresses.address_for(source_ip)
+        response = self.responses_cache.get(local_ip)
+        if response is None:
+            response = f"{DISCOVERY_RESPONSE_PREFIX}{local_ip}".encode()
+            self.responses_cache[local_ip] = response
+
+        self.transport.sendto(response, addr)
+        self.stats["responses"] += 1
+
+        # Only announce new sources - printing every reply would throttle a boot storm
+        if source_ip not in self.known_sources and len(self.known_sources) < 4096:
+            self.known_sources.add(source_ip)
+            print(f"📡 Sent discovery response to {source_ip}: {local_ip}")
+            if self.log_callback:
+                self.log_callback("sent", f"Discovery response to {source_ip}: {local_ip}",
+                                  "discovery", device_type="wifi")
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) must not stop the responder
+        print(f"⚠️ UDP discovery error: {exc}")
+
+class UDPServiceThread:
+    """Runs asyncio datagram endpoints on a dedicated event loop thread"""
+
+    def __init__(self, name="udp-services"):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.endpoints = {}  # name -> (transport, protocol)
+        self.periodic_tasks = []
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add_endpoint(self, name, protocol_factory, port, host="0.0.0.0", allow_broadcast=True,
+                     recv_buffer=4 * 1024 * 1024):
+        """Bind a datagram endpoint on the service loop (blocks until bound)"""
+        async def create():
+            return await self.loop.create_datagram_endpoint(
+                protocol_factory, local_addr=(host, port), allow_broadcast=allow_broadcast
+            )
+
+        transport, protocol = asyncio.run_coroutine_threadsafe(create(), self.loop).result(timeout=5)
+
+        # Large receive buffer so bursts (reboot storms) queue in the kernel instead of dropping
+        sock = transport.get_extra_info("socket")
+        if sock is not None and recv_buffer:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+            except OSError:
+                pass
+        self.endpoints[name] = (transport, protocol)
+        return protocol
+
+    def call_every(self, interval, func):
+        """Run func on the loop thread every interval seconds"""
+        def tick():
+            try:
+                func()
+            except Exception as e:
+                print(f"⚠️ UDP service task error: {e}")
+            self.loop.call_later(interval, tick)
+
+        self.loop.call_soon_threadsafe(self.loop.call_later, interval, tick)
+
+    def protocol(self, name):
+        endpoint = self.endpoints.get(name)
+        return endpoint[1] if endpoint else None
+
+    def stop(self):
+        def close_all():
+            for transport, _protocol in self.endpoints.values():
+                transport.close()
+            self.loop.stop()
+
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(close_all)
+            self.thread.join(timeout=2)
+            self.thread = None
+
+def start_discovery_service(port=DISCOVERY_PORT, log_callback=None, services=None):
+    """Start (or attach to) the UDP service loop and bind the discovery responder"""
+    services = (services or UDPServiceThread()).start()
+    addresses = InterfaceAddressCache()
+    rate_limiter = SourceRateLimiter()
+
+    services.add_endpoint(
+        "discovery",
+        lambda: DiscoveryProtocol(addresses, rate_limiter, log_callback),
+        port
+    )
+    services.call_every(addresses.check_interval, addresses.maybe_refresh)
+
+    local = ", ".join(address for _network, address in addresses.interfaces) or "none"
+    print(f"📻 UDP discovery service started on port {port} (interfaces: {local})")
+    return services
@@ -0,0 +1,63 @@
+"""
+Fast JSON
+Flask JSON provider backed by orjson when it is installed - jsonify() and request.get_json() use it everywhere
+"""
+
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson  # Optional - the standard library encoder is used without it
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Same output as Flask's default provider (sorted keys, compact, HTTP dates), encoded by orjson
+
+    Anything orjson refuses (ints beyond 64 bits, NaN literals in a request body)
+    falls back to the standard library. Differences on the wire: non-ASCII text is
+    sent as UTF-8 rather than \\u escapes, and a float NaN/Infinity becomes null
+    instead of the non-standard NaN token.
+    """
+
+    def _options(self):
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME  # Dates via Flask's default()
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def _pretty(self):
+        return (self.compact is None and self._app.debug) or self.compact is False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get("indent") or kwargs.get("cls"):
+            return super().dumps(obj, **kwargs)
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._options()).decode("utf-8")
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return json.loads(s, **kwargs)  # Raises the usual error for really invalid JSON
+
+    def response(self, *args, **kwargs):
+        if self._pretty():
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self._options() | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        # Bytes straight into the response - no str round trip
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+def init_fast_json(app):
+    """Install the orjson provider on the app - returns the encoder name in use"""
+    if orjson is None:
+        return "json"
+    app.json = OrjsonProvider(app)
+    return "orjson"
@@ -0,0 +1,166 @@
+"""
+Device Health
+Rolling success rate, confirm latency and timeouts per device, with a circuit breaker for dispatch
+"""
+
+import threading
+import time
+
+CLOSED = "closed"        # Healthy - takes traffic
+OPEN = "open"            # Degraded - skipped by vend routing
+HALF_OPEN = "half_open"  # Cooling off is over - one probe vend at a time decides
+
+EWMA_ALPHA = 0.2                 # Weight of the newest result in the rolling averages
+CONSECUTIVE_FAILURE_LIMIT = 3    # Open after this many failures/timeouts in a row
+MIN_SUCCESS_RATE = 0.5           # ...or when the rolling success rate drops below this
+MIN_SAMPLES = 5                  # ...once there are enough results to trust it
+OPEN_SECONDS = 30.0              # First cool-off; doubles after each failed probe
+MAX_OPEN_SECONDS = 300.0
+PROBE_TIMEOUT = 60.0             # A probe with no result by then frees the slot for another
+
+class DeviceHealth:
+    """Rolling counters and breaker state for one device"""
+
+    __slots__ = ("state", "success_rate", "latency", "samples", "successes", "failures", "timeouts",
+                 "consecutive_failures", "open_until", "open_seconds", "probe_started", "last_result",
+                 "last_change")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.success_rate = 1.0
+        self.latency = None          # EWMA confirm latency in seconds
+        self.samples = 0
+        self.successes = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_seconds = OPEN_SECONDS
+        self.probe_started = None    # Set while a half-open probe is in flight
+        self.last_result = None
+        self.last_change = time.time()
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "success_rate": round(self.success_rate, 3),
+            "avg_confirm_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "samples": self.samples,
+            "successes": self.successes,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "consecutive_failures": self.consecutive_failures,
+            "reopens_in": round(self.open_until - time.time(), 1) if self.state == OPEN else None,
+            "last_result": self.last_result,
+            "last_change": self.last_change
+        }
+
+class HealthTracker:
+    """Per-device health scores; allow() is the hot-path check used by vend routing"""
+
+    def __init__(self):
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "closed": 0, "probes": 0, "skipped": 0}
+
+    def _get(self, device_id):
+        health = self.devices.get(device_id)
+        if health is None:
+            health = self.devices[device_id] = DeviceHealth()
+        return health
+
+    def _set_state(self, health, state):
+        health.state = state
+        health.last_change = time.time()
+
+    def allow(self, device_id, now=None):
+        """Can this device take a vend right now? (dict lookup for healthy devices)"""
+        health = self.devices.get(device_id)
+        if health is None or health.state == CLOSED:
+            return True
+
+        now = time.time() if now is None else now
+        with self.lock:
+            if health.state == OPEN:
+                if now < health.open_until:
+                    self.stats["skipped"] += 1
+                    return False
+                self._set_state(health, HALF_OPEN)
+                health.probe_started = None
+
+            # Half-open: a trickle of one probe at a time
+            if health.probe_started is not None and now - health.probe_started < PROBE_TIMEOUT:
+                self.stats["skipped"] += 1
+                return False
+            return True
+
+    def record_dispatch(self, device_id, now=None):
+        """A vend went out - in half-open state it is the probe"""
+        health = self.devices.get(device_id)
+        if health is not None and health.state == HALF_OPEN:
+            with self.lock:
+                health.probe_started = time.time() if now is None else now
+                self.stats["probes"] += 1
+
+    def record_success(self, device_id, latency=None):
+        with self.lock:
+            health = self._get(device_id)
+            health.samples += 1
+            health.successes += 1
+            health.consecutive_failures = 0
+            health.success_rate += EWMA_ALPHA * (1.0 - health.success_rate)
+            if latency is not None:
+                health.latency = latency if health.latency is None else health.latency + EWMA_ALPHA * (latency - health.latency)
+            health.last_result = "success"
+
+            if health.state != CLOSED:
+                # Probe came back fine - full traffic again
+                self._set_state(health, CLOSED)
+                health.open_seconds = OPEN_SECONDS
+                health.probe_started = None
+                self.stats["closed"] += 1
+                print(f"💚 Device {device_id} healthy again - circuit closed")
+
+    def record_failure(self, device_id, reason="failure", now=None):
+        """A vend failed or timed out (reason "timeout")"""
+        now = time.time() if now is None else now
+        with self.lock:
+            health = self._get(device_id)
+            health.samples += 1
+            health.consecutive_failures += 1
+            if reason == "timeout":
+                health.timeouts += 1
+            else:
+                health.failures += 1
+            health.success_rate -= EWMA_ALPHA * health.success_rate
+            health.last_result = reason
+
+            if health.state == HALF_OPEN:
+                # Probe failed - back off for longer
+                health.open_seconds = min(health.open_seconds * 2, MAX_OPEN_SECONDS)
+                self._open(device_id, health, now, "probe failed")
+            elif health.state == CLOSED and (
+                    health.consecutive_failures >= CONSECUTIVE_FAILURE_LIMIT or
+                    (health.samples >= MIN_SAMPLES and health.success_rate < MIN_SUCCESS_RATE)):
+                self._open(device_id, health, now, f"{health.consecutive_failures} failures in a row, "
+                                                   f"success rate {health.success_rate:.0%}")
+
+    def _open(self, device_id, health, now, why):
+        self._set_state(health, OPEN)
+        health.open_until = now + health.open_seconds
+        health.probe_started = None
+        self.stats["opened"] += 1
+        print(f"🧯 Device {device_id} taken out of dispatch for {health.open_seconds:.0f}s ({why})")
+
+    def reset(self, device_id):
+        """Operator override - forget the history and close the circuit"""
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+    def get(self, device_id):
+        health = self.devices.get(device_id)
+        return health.to_dict() if health is not None else DeviceHealth().to_dict()
+
+    def snapshot(self):
+        with self.lock:
+            return {device_id: health.to_dict() for device_id, health in self.devices.items()}
@@ -0,0 +1,149 @@
+"""
+UDP Heartbeat Channel
+Compact liveness datagrams from WiFi ESP32s, applied to the device registry in bulk
+
+Packet layout (network byte order):
+    magic      2 bytes   b"HB"
+    version    1 byte    1
+    flags      1 byte    bit 0 = status byte present
+    sequence   4 bytes   unsigned, wraps around
+    id_length  1 byte
+    device_id  id_length bytes (UTF-8)
+    status     1 byte    optional (see HEARTBEAT_STATUS)
+"""
+
+import asyncio
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HEARTBEAT_PORT = 12347
+HEARTBEAT_MAGIC = b"HB"
+HEARTBEAT_VERSION = 1
+FLAG_HAS_STATUS = 0x01
+
+_HEADER = struct.Struct("!2sBBIB")
+
+REBOOT_SEQUENCE_WINDOW = 16  # A counter this low after a higher one means the device restarted
+
+HEARTBEAT_STATUS = {
+    0: "ready",
+    1: "busy",
+    2: "error",
+    3: "maintenance"
+}
+
+def encode_heartbeat(device_id, sequence, status=None):
+    """Build a heartbeat datagram"""
+    device_bytes = device_id.encode("utf-8")[:255]
+    flags = FLAG_HAS_STATUS if status is not None else 0
+    packet = _HEADER.pack(HEARTBEAT_MAGIC, HEARTBEAT_VERSION, flags,
+                          sequence & 0xFFFFFFFF, len(device_bytes)) + device_bytes
+    if status is not None:
+        packet += bytes((status & 0xFF,))
+    return packet
+
+def decode_heartbeat(data):
+    """Parse a heartbeat datagram - returns (device_id, sequence, status) or None if malformed"""
+    if len(data) < _HEADER.size:
+        return None
+
+    magic, version, flags, sequence, id_length = _HEADER.unpack_from(data)
+    if magic != HEARTBEAT_MAGIC or version != HEARTBEAT_VERSION or id_length == 0:
+        return None
+
+    end = _HEADER.size + id_length
+    expected = end + (1 if flags & FLAG_HAS_STATUS else 0)
+    if len(data) != expected:
+        return None
+
+    try:
+        device_id = data[_HEADER.size:end].decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+    status = data[end] if flags & FLAG_HAS_STATUS else None
+    return device_id, sequence, status
+
+def sequence_is_newer(sequence, last_sequence):
+    """Serial-number comparison so the 32-bit counter can wrap (RFC 1982 style)"""
+    return 0 < ((sequence - last_sequence) & 0xFFFFFFFF) < 0x80000000
+
+class HeartbeatProtocol(asyncio.DatagramProtocol):
+    """Collects heartbeats between flushes; the flush hands one batch to the device registry
+
+    Batches are applied on a single worker thread, in order, so a slow registry write (a shared
+    backend's transaction) never stalls the UDP loop. While one batch is being applied, new
+    heartbeats keep collecting for the next flush.
+    """
+
+    def __init__(self, apply_batch, max_pending=100000):
+        self.apply_batch = apply_batch  # callable({device_id: (sequence, status, received_at, ip)}) -> unknown ids
+        self.max_pending = max_pending
+        self.pending = {}
+        self.last_sequence = {}  # device_id -> last accepted sequence
+        self.applying = None     # Future of the batch on the worker, None when idle
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="heartbeat-apply")
+        self.stats = {"received": 0, "accepted": 0, "stale": 0, "malformed": 0, "unknown": 0,
+                      "flushes": 0, "last_batch_size": 0}
+
+    def datagram_received(self, data, addr):
+        self.stats["received"] += 1
+        decoded = decode_heartbeat(data)
+        if decoded is None:
+            self.stats["malformed"] += 1
+            return
+
+        device_id, sequence, status = decoded
+        last = self.last_sequence.get(device_id)
+        if (last is not None and not sequence_is_newer(sequence, last)
+                and sequence >= REBOOT_SEQUENCE_WINDOW):
+            # Duplicate or reordered datagram - liveness is already recorded
+            self.stats["stale"] += 1
+            return
+
+        self.last_sequence[device_id] = sequence
+        self.pending[device_id] = (sequence, status, time.time(), addr[0])
+        self.stats["accepted"] += 1
+
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def error_received(self, exc):
+        print(f"⚠️ UDP heartbeat error: {exc}")
+
+    def forget(self, device_id):
+        """Reset sequence tracking (e.g. after a device re-registers with a fresh counter)"""
+        self.last_sequence.pop(device_id, None)
+
+    def flush(self):
+        """Hand everything received since the last flush to the worker as one batch (runs on the loop)"""
+        if not self.pending or self.applying is not None:
+            return 0
+
+        batch, self.pending = self.pending, {}
+        self.stats["flushes"] += 1
+        self.stats["last_batch_size"] = len(batch)
+        self.applying = asyncio.get_running_loop().run_in_executor(self.executor, self.apply_batch, batch)
+        self.applying.add_done_callback(self._applied)
+        return len(batch)
+
+    def _applied(self, future):
+        # Done callbacks run on the loop, so the protocol's state is only ever touched from there
+        self.applying = None
+        try:
+            unknown = future.result()
+        except Exception as e:
+            print(f"⚠️ Heartbeat batch failed: {e}")
+            return
+        for device_id in unknown or ():
+            # Not registered - drop it so the device starts clean once it registers
+            self.last_sequence.pop(device_id, None)
+        self.stats["unknown"] += len(unknown or ())
+
+def start_heartbeat_service(services, apply_batch, port=HEARTBEAT_PORT, flush_interval=0.5):
+    """Bind the heartbeat endpoint on the shared UDP service loop"""
+    protocol = services.add_endpoint("heartbeat", lambda: HeartbeatProtocol(apply_batch), port)
+    services.call_every(flush_interval, protocol.flush)
+    print(f"💓 UDP heartbeat service started on port {port}")
+    return protocol
@@ -1,3 +1,108 @@
-# File: /flask-vending-machine/flask-vending-machine/src/vending/models.py
+"""
+Vending Data Models
+In-memory slot inventory with atomic reserve/restore around dispatch
+"""
 
-# This file is intentionally left blank.
\ No newline at end of file
+import threading
+import time
+
+SLOT_COUNT = 5
+LOCK_STRIPES = 64  # Devices hash onto a fixed set of locks - no global lock on the vend path
+
+class SlotInventory:
+    """Per-device, per-slot stock levels
+
+    Devices that have never been stocked are untracked: vends to them are always
+    allowed, so fleets without inventory data behave exactly as before.
+    """
+
+    def __init__(self, slot_count=SLOT_COUNT):
+        self.slot_count = slot_count
+        self.stock = {}       # (device_id, slot) -> units on hand
+        self.capacity = {}    # (device_id, slot) -> max units (optional)
+        self.tracked = set()  # device_ids with inventory data
+        self.updated_at = {}  # device_id -> last restock/dispatch time
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _lock_for(self, device_id):
+        return self._locks[hash(device_id) % LOCK_STRIPES]
+
+    def is_tracked(self, device_id):
+        return device_id in self.tracked
+
+    def available(self, device_id, slot):
+        """Units on hand (None if the device is untracked)"""
+        if device_id not in self.tracked:
+            return None
+        return self.stock.get((device_id, slot), 0)
+
+    def reserve(self, device_id, slot):
+        """Take one unit before dispatch - False if the slot is empty (True for untracked devices)"""
+        if device_id not in self.tracked:
+            return True
+
+        key = (device_id, slot)
+        with self._lock_for(device_id):
+            units = self.stock.get(key, 0)
+            if units <= 0:
+                return False
+            self.stock[key] = units - 1
+            self.updated_at[device_id] = time.time()
+            return True
+
+    def restore(self, device_id, slot):
+        """Give back a unit reserved for a dispatch that failed"""
+        if device_id not in self.tracked:
+            return
+
+        key = (device_id, slot)
+        with self._lock_for(device_id):
+            units = self.stock.get(key, 0) + 1
+            cap = self.capacity.get(key)
+            self.stock[key] = min(units, cap) if cap is not None else units
+            self.updated_at[device_id] = time.time()
+
+    def restock(self, device_id, levels, mode="set", capacities=None):
+        """Set (or add to) stock levels - levels is {slot: units}"""
+        with self._lock_for(device_id):
+            for slot, units in levels.items():
+                key = (device_id, slot)
+                units = units + self.stock.get(key, 0) if mode == "add" else units
+                if capacities and slot in capacities:
+                    self.capacity[key] = capacities[slot]
+                cap = self.capacity.get(key)
+                self.stock[key] = max(0, min(units, cap) if cap is not None else units)
+            self.tracked.add(device_id)
+            self.updated_at[device_id] = time.time()
+
+    def clear(self, device_id):
+        """Stop tracking a device (vends are allowed again)"""
+        with self._lock_for(device_id):
+            self.tracked.discard(device_id)
+            self.updated_at.pop(device_id, None)
+            for slot in range(1, self.slot_count + 1):
+                self.stock.pop((device_id, slot), None)
+                self.capacity.pop((device_id, slot), None)
+
+    def snapshot(self, device_id):
+        """Stock levels for one device"""
+        if device_id not in self.tracked:
+            return {"device_id": device_id, "tracked": False, "slots": {}}
+
+        slots = {}
+        for slot in range(1, self.slot_count + 1):
+            key = (device_id, slot)
+            slots[str(slot)] = {
+                "available": self.stock.get(key, 0),
+                "capacity": self.capacity.get(key)
+            }
+        return {
+            "device_id": device_id,
+            "tracked": True,
+            "slots": slots,
+            "empty_slots": [int(s) for s, info in slots.items() if info["available"] <= 0],
+            "updated_at": self.updated_at.get(device_id)
+        }
+
+    def snapshot_all(self):
+        return {device_id: self.snapshot(device_id) for device_id in list(self.tracked)}
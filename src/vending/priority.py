@@ -0,0 +1,122 @@
+"""
+Command Priority Classes
+Per-device queues that hand out customer vends before operator and diagnostic traffic
+"""
+
+import itertools
+import threading
+import time
+from queue import Empty
+
+VEND = "vend"              # Customer-facing - always first
+OPERATOR = "operator"      # Maintenance / manual commands
+DIAGNOSTIC = "diagnostic"  # STATUS, PING, DISCOVER sweeps
+
+PRIORITY_CLASSES = (VEND, OPERATOR, DIAGNOSTIC)
+PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITY_CLASSES)}
+
+# Starvation protection: a queued command moves up one class for every
+# AGE_PROMOTE_SECONDS it has waited. Within a class everything goes out in
+# enqueue order, so a diagnostic aged up to the vend class goes ahead of any
+# vend queued after it - under a steady vend stream it waits at most
+# 2 * AGE_PROMOTE_SECONDS plus the vends that were already queued.
+AGE_PROMOTE_SECONDS = 5.0
+
+DIAGNOSTIC_COMMANDS = {"STATUS", "PING", "DISCOVER"}
+
+def classify(command_name):
+    """Default class for a command name (VEND:3 -> vend, STATUS -> diagnostic, others -> operator)"""
+    name = str(command_name or "").strip().upper().split(":", 1)[0]
+    if name == "VEND":
+        return VEND
+    if name in DIAGNOSTIC_COMMANDS:
+        return DIAGNOSTIC
+    return OPERATOR
+
+def priority_rank(priority):
+    if priority not in PRIORITY_RANK:
+        raise ValueError(f"Unknown priority class: {priority} (use one of {', '.join(PRIORITY_CLASSES)})")
+    return PRIORITY_RANK[priority]
+
+def dispatch_key(rank, enqueued_at, seq, now):
+    """Sort key - lowest goes out next (effective class, then oldest first)"""
+    promoted = max(rank - int((now - enqueued_at) // AGE_PROMOTE_SECONDS), 0)
+    return (promoted, enqueued_at, seq)
+
+class CommandPriorityQueue:
+    """Thread-safe queue with priority classes - a drop-in for queue.Queue's put/get/empty"""
+
+    def __init__(self):
+        self.entries = []  # (rank, enqueued_at, seq, item) - short, so selection is a scan
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self._seq = itertools.count()
+
+    def put(self, item, priority=OPERATOR):
+        rank = priority_rank(priority)
+        with self.not_empty:
+            self.entries.append((rank, time.monotonic(), next(self._seq), item))
+            self.not_empty.notify()
+
+    def _pop_next(self):
+        now = time.monotonic()
+        best = min(range(len(self.entries)), key=lambda i: dispatch_key(*self.entries[i][:3], now))
+        return self.entries.pop(best)[3]
+
+    def get(self, block=True, timeout=None):
+        """Next command in priority order - raises queue.Empty like Queue.get"""
+        with self.not_empty:
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self.entries:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.not_empty.wait(remaining)
+            if not self.entries:
+                raise Empty
+            return self._pop_next()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def remove(self, predicate):
+        """Drop queued items matching predicate(item) - returns how many were removed"""
+        with self.lock:
+            before = len(self.entries)
+            self.entries = [entry for entry in self.entries if not predicate(entry[3])]
+            return before - len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries = []
+
+    def drain(self):
+        """Take every queued item at once - (priority, item) pairs in dispatch order"""
+        with self.lock:
+            now = time.monotonic()
+            ordered = sorted(self.entries, key=lambda entry: dispatch_key(*entry[:3], now))
+            self.entries = []
+            return [(PRIORITY_CLASSES[entry[0]], entry[3]) for entry in ordered]
+
+    def items(self):
+        """(priority, item) pairs in the order they would be dispatched now"""
+        with self.lock:
+            now = time.monotonic()
+            ordered = sorted(self.entries, key=lambda entry: dispatch_key(*entry[:3], now))
+            return [(PRIORITY_CLASSES[entry[0]], entry[3]) for entry in ordered]
+
+    def counts(self):
+        with self.lock:
+            counts = {name: 0 for name in PRIORITY_CLASSES}
+            for entry in self.entries:
+                counts[PRIORITY_CLASSES[entry[0]]] += 1
+            return counts
+
+    def empty(self):
+        return not self.entries
+
+    def qsize(self):
+        return len(self.entries)
+
+    __len__ = qsize
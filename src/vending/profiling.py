@@ -0,0 +1,198 @@
+"""
+Request Timing and Sampling Profiler
+Per-route latency histograms and on-demand stack sampling of every thread
+"""
+
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+ENDPOINT_KEY = "vending.endpoint"
+
+# Histogram bucket upper bounds in seconds: 16 us doubling up to ~34 s
+BUCKET_BOUNDS = [0.000016 * (2 ** i) for i in range(22)]
+
+MAX_PROFILE_SECONDS = 60
+MIN_SAMPLE_INTERVAL = 0.001
+
+class LatencyHistogram:
+    """Log-spaced latency buckets - constant memory, percentiles accurate to one bucket"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)  # Last bucket catches everything slower
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of requests"""
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def summary(self, include_buckets=False):
+        def ms(seconds):
+            return round(seconds * 1000, 3) if seconds is not None else None
+
+        result = {
+            "count": self.count,
+            "total_ms": ms(self.total),
+            "mean_ms": ms(self.total / self.count) if self.count else None,
+            "p50_ms": ms(self.percentile(0.5)),
+            "p90_ms": ms(self.percentile(0.9)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "max_ms": ms(self.max)
+        }
+        if include_buckets:
+            result["buckets"] = [
+                {"le_ms": ms(BUCKET_BOUNDS[index]) if index < len(BUCKET_BOUNDS) else None, "count": bucket_count}
+                for index, bucket_count in enumerate(self.counts) if bucket_count
+            ]
+        return result
+
+class RouteTimings:
+    """Latency histogram per (method, endpoint)"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.since = time.time()
+
+    def observe(self, method, endpoint, seconds):
+        key = (method, endpoint)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.since = time.time()
+
+    def summary(self, include_buckets=False):
+        """Routes ordered by total time spent in them"""
+        with self.lock:
+            routes = [
+                dict(histogram.summary(include_buckets), method=method, endpoint=endpoint)
+                for (method, endpoint), histogram in self.histograms.items()
+            ]
+        routes.sort(key=lambda route: route["total_ms"], reverse=True)
+        return {"since": self.since, "routes": routes}
+
+class TimingMiddleware:
+    """WSGI wrapper timing every request, hooks and view included"""
+
+    def __init__(self, wsgi_app, timings):
+        self.wsgi_app = wsgi_app
+        self.timings = timings
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, start_response)
+        finally:
+            self.timings.observe(environ.get("REQUEST_METHOD", "GET"), environ.get(ENDPOINT_KEY) or "unmatched",
+                                 time.perf_counter() - started)
+
+def init_request_timing(app):
+    """Wrap the app in TimingMiddleware - call before registering other before_request hooks"""
+    from flask import request
+    timings = RouteTimings()
+
+    @app.before_request
+    def _tag_endpoint():
+        request.environ[ENDPOINT_KEY] = request.endpoint
+
+    app.wsgi_app = TimingMiddleware(app.wsgi_app, timings)
+    return timings
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed interval
+
+    Stacks are aggregated as collapsed ("folded") lines - thread;outer;...;inner count -
+    which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()  # One profile at a time
+
+    def run(self, seconds, interval=0.005):
+        """Sample for seconds - returns (Counter of folded stacks, sample rounds)"""
+        seconds = max(0.0, min(float(seconds), MAX_PROFILE_SECONDS))
+        interval = max(float(interval), MIN_SAMPLE_INTERVAL)
+
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("A profile is already running")
+        try:
+            stacks = Counter()
+            own_ident = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            rounds = 0
+
+            while True:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame))
+                        frame = frame.f_back
+                    labels.append(names.get(ident, f"thread-{ident}"))
+                    stacks[";".join(reversed(labels))] += 1
+                rounds += 1
+
+                if time.perf_counter() >= deadline:
+                    break
+                time.sleep(interval)
+            return stacks, rounds
+        finally:
+            self.lock.release()
+
+def collapsed_text(stacks):
+    """Folded stack lines, heaviest first"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def profile_summary(stacks, rounds, interval, top=30):
+    """Per-thread sample counts plus the functions with the most self and total samples"""
+    threads = Counter()
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        threads[frames[0]] += count
+        if len(frames) > 1:
+            self_counts[frames[-1]] += count
+        for frame in set(frames[1:]):
+            total_counts[frame] += count
+
+    return {
+        "rounds": rounds,
+        "interval_ms": round(interval * 1000, 3),
+        "threads": dict(threads.most_common()),
+        "top_self": [{"frame": frame, "samples": count} for frame, count in self_counts.most_common(top)],
+        "top_total": [{"frame": frame, "samples": count} for frame, count in total_counts.most_common(top)],
+        "distinct_stacks": len(stacks)
+    }
@@ -0,0 +1,109 @@
+"""
+Server-Push Command Delivery
+POSTs commands straight to WiFi ESP32s that expose a command endpoint
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_COMMAND_PATH = "/command"
+
+PUSHED = "pushed"        # Device answered 2xx
+UNREACHED = "unreached"  # Connection never opened - the device did not get it, safe to queue for a poll
+UNKNOWN = "unknown"      # Sent, but no 2xx came back (read timeout, dropped connection, error status) - it may have run
+
+def build_command_url(ip_address, command_port, command_path=None):
+    """Device command endpoint from registration data (None if the device doesn't expose one)"""
+    if not ip_address or not command_port:
+        return None
+    try:
+        port = int(command_port)
+    except (TypeError, ValueError):
+        return None
+    if not 0 < port < 65536:
+        return None
+
+    path = command_path or DEFAULT_COMMAND_PATH
+    if not path.startswith("/"):
+        path = "/" + path
+    return f"http://{ip_address}:{port}{path}"
+
+class PushDelivery:
+    """Per-device keep-alive connection pools with short timeouts"""
+
+    def __init__(self, connect_timeout=0.5, read_timeout=2.0, max_devices=1024):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_devices = max_devices
+        self.sessions = OrderedDict()  # device_id -> (command_url, Session), LRU order
+        self.lock = threading.Lock()
+        self.stats = {PUSHED: 0, UNREACHED: 0, UNKNOWN: 0, "pools_opened": 0, "pools_evicted": 0}
+
+    def _session_for(self, device_id, command_url):
+        with self.lock:
+            entry = self.sessions.get(device_id)
+            if entry is not None and entry[0] == command_url:
+                self.sessions.move_to_end(device_id)
+                return entry[1]
+
+            if entry is not None:
+                # Device moved (new IP/port) - its old connections are useless
+                entry[1].close()
+
+            # requests is imported on first push so importing the app stays fast
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0)
+            session.mount("http://", adapter)
+            self.sessions[device_id] = (command_url, session)
+            self.stats["pools_opened"] += 1
+
+            while len(self.sessions) > self.max_devices:
+                _evicted_id, (_url, evicted) = self.sessions.popitem(last=False)
+                evicted.close()
+                self.stats["pools_evicted"] += 1
+
+            return session
+
+    def push(self, device_id, command_url, command):
+        """POST the command - returns (PUSHED | UNREACHED | UNKNOWN, detail)"""
+        import requests
+        from urllib3.exceptions import NewConnectionError
+        session = self._session_for(device_id, command_url)
+        started = time.perf_counter()
+
+        try:
+            response = session.post(command_url, json=command,
+                                    timeout=(self.connect_timeout, self.read_timeout))
+        except requests.exceptions.RequestException as e:
+            # Only a failed connect proves the device never saw the command
+            reason = getattr(e.args[0], "reason", None) if e.args else None
+            unreached = (isinstance(e, requests.exceptions.ConnectTimeout) or
+                         (isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)))
+            outcome = UNREACHED if unreached else UNKNOWN
+            self.stats[outcome] += 1
+            self.drop(device_id)  # Don't reuse a connection in an unknown state
+            return outcome, type(e).__name__
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if 200 <= response.status_code < 300:
+            self.stats[PUSHED] += 1
+            return PUSHED, f"HTTP {response.status_code} in {elapsed_ms:.1f} ms"
+
+        self.stats[UNKNOWN] += 1
+        return UNKNOWN, f"HTTP {response.status_code}"
+
+    def drop(self, device_id):
+        with self.lock:
+            entry = self.sessions.pop(device_id, None)
+        if entry is not None:
+            entry[1].close()
+
+    def close(self):
+        with self.lock:
+            entries = list(self.sessions.values())
+            self.sessions.clear()
+        for _url, session in entries:
+            session.close()
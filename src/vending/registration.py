@@ -0,0 +1,68 @@
+"""
+Registration Storms
+Registration rate tracking and poll-schedule hints that spread a fleet's first polls after a power blip
+"""
+
+import threading
+import time
+import zlib
+from collections import deque
+
+BASE_POLL_INTERVAL = 2.0        # Firmware default between command polls
+MAX_POLL_INTERVAL = 10.0
+RATE_WINDOW = 10.0              # Registrations in the last RATE_WINDOW seconds make up a storm
+TARGET_POLL_RATE = 200.0        # Polls per second the server should see from a freshly booted fleet
+MAX_POLL_JITTER = 30.0
+
+def _slot_fraction(device_id):
+    """Stable 0..1 position for a device - a retried registration gets the same slot"""
+    return (zlib.crc32(device_id.encode("utf-8")) & 0xFFFFFFFF) / 0x100000000
+
+class RegistrationMonitor:
+    """Counts recent registrations and turns the storm size into per-device poll hints"""
+
+    def __init__(self):
+        self.recent = deque()  # (timestamp, count) per registration call
+        self.recent_total = 0
+        self.lock = threading.Lock()
+        self.stats = {"registered": 0, "batches": 0, "rejected": 0}
+
+    def observe(self, count=1, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.recent.append((now, count))
+            self.recent_total += count
+            self.stats["registered"] += count
+            self._expire(now)
+
+    def _expire(self, now):
+        cutoff = now - RATE_WINDOW
+        while self.recent and self.recent[0][0] < cutoff:
+            self.recent_total -= self.recent.popleft()[1]
+
+    def rate(self, now=None):
+        """Registrations per second over the window"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self._expire(now)
+            return self.recent_total / RATE_WINDOW
+
+    def hint(self, device_id, fleet_size, now=None):
+        """Poll schedule for a device that just registered
+
+        The first poll is delayed by a slot in a window sized so the whole storm's
+        first polls arrive at about TARGET_POLL_RATE, and big fleets poll less often.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            self._expire(now)
+            storm = self.recent_total
+        jitter = min(MAX_POLL_JITTER, storm / TARGET_POLL_RATE)
+        interval = min(MAX_POLL_INTERVAL, max(BASE_POLL_INTERVAL, fleet_size / TARGET_POLL_RATE))
+        return {
+            "poll_delay_ms": int(jitter * _slot_fraction(device_id) * 1000),
+            "poll_interval_ms": int(interval * 1000)
+        }
+
+    def describe(self):
+        return dict(self.stats, rate_per_second=round(self.rate(), 2), window_seconds=RATE_WINDOW)
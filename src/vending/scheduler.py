@@ -0,0 +1,313 @@
+"""
+Command Deadline Scheduling
+Hashed timer wheel and timer heap, plus an acknowledgement tracker for in-flight commands
+"""
+
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+
+class HashedTimerWheel:
+    """Timers hashed into fixed buckets by expiry tick - O(1) schedule and cancel
+
+    Each bucket is a dict, so cancelling is a single delete. Advancing the wheel
+    only looks at the buckets for the ticks that have passed; timers further than
+    one revolution away stay in their bucket until their tick comes round.
+    """
+
+    def __init__(self, tick=0.1, wheel_size=512, clock=time.monotonic):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.clock = clock
+        self.buckets = [dict() for _ in range(wheel_size)]
+        self.timers = {}  # timer_id -> (target_tick, callback, args)
+        self.current_tick = int(clock() / tick)
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._thread = None
+        self._running = False
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds - returns a timer id for cancel()"""
+        with self.lock:
+            target = max(int(math.ceil((self.clock() + delay) / self.tick)), self.current_tick + 1)
+            timer_id = next(self._ids)
+            self.buckets[target % self.wheel_size][timer_id] = target
+            self.timers[timer_id] = (target, callback, args)
+            return timer_id
+
+    def cancel(self, timer_id):
+        """Cancel a pending timer - returns False if it already fired or never existed"""
+        with self.lock:
+            entry = self.timers.pop(timer_id, None)
+            if entry is None:
+                return False
+            self.buckets[entry[0] % self.wheel_size].pop(timer_id, None)
+            return True
+
+    def advance(self, now=None):
+        """Fire every timer due up to now - returns the number fired"""
+        now = self.clock() if now is None else now
+        due = []
+
+        with self.lock:
+            target_tick = int(now / self.tick)
+            if target_tick - self.current_tick >= self.wheel_size:
+                # Fell more than a revolution behind - every bucket is due for a check
+                ticks = range(target_tick - self.wheel_size + 1, target_tick + 1)
+            else:
+                ticks = range(self.current_tick + 1, target_tick + 1)
+
+            for tick in ticks:
+                bucket = self.buckets[tick % self.wheel_size]
+                if not bucket:
+                    continue
+                expired = [timer_id for timer_id, target in bucket.items() if target <= target_tick]
+                for timer_id in expired:
+                    del bucket[timer_id]
+                    due.append(self.timers.pop(timer_id))
+
+            self.current_tick = max(self.current_tick, target_tick)
+
+        # Callbacks run outside the lock so they can schedule follow-up timers
+        due.sort(key=lambda entry: entry[0])
+        for _target, callback, args in due:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"⚠️ Timer callback error: {e}")
+        return len(due)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def start(self, name="timer-wheel"):
+        """Advance the wheel from a background thread"""
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.tick)
+            self.advance()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=self.tick * 5)
+            self._thread = None
+
+HEAP_COMPACT_MIN = 1024  # Cancelled heap entries are purged once there are this many and they outnumber live ones
+
+class TimerHeap:
+    """Timers in a binary heap ordered by due time - the thread sleeps until the earliest one is due
+
+    For timers that are far apart or far ahead (hours rather than seconds), which a
+    wheel would keep revisiting every revolution. Schedule and fire are O(log n) and
+    nothing is scanned while waiting. Cancelling marks the entry dead; it is dropped
+    when it reaches the top, or in one rebuild once dead entries outnumber live ones.
+    Due times are on the wall clock, so "release at 17:30" means what it says.
+    """
+
+    def __init__(self, clock=time.time, max_wait=1.0):
+        self.clock = clock
+        self.max_wait = max_wait  # Longest sleep - a wall-clock step is noticed within this
+        self.heap = []            # [due, timer_id, callback, args] - callback is None once cancelled
+        self.timers = {}          # timer_id -> heap entry
+        self.cancelled = 0
+        self.wakeup = threading.Condition()
+        self._ids = itertools.count(1)
+        self._thread = None
+        self._running = False
+
+    def schedule_at(self, due, callback, *args):
+        """Run callback(*args) at wall-clock time due - returns a timer id for cancel()"""
+        with self.wakeup:
+            timer_id = next(self._ids)
+            entry = [due, timer_id, callback, args]
+            heapq.heappush(self.heap, entry)
+            self.timers[timer_id] = entry
+            if self.heap[0] is entry:
+                self.wakeup.notify()  # New earliest timer - shorten the current sleep
+            return timer_id
+
+    def schedule(self, delay, callback, *args):
+        return self.schedule_at(self.clock() + delay, callback, *args)
+
+    def cancel(self, timer_id):
+        """Cancel a pending timer - returns False if it already fired or never existed"""
+        with self.wakeup:
+            entry = self.timers.pop(timer_id, None)
+            if entry is None:
+                return False
+            entry[2] = entry[3] = None
+            self.cancelled += 1
+            if self.cancelled >= HEAP_COMPACT_MIN and self.cancelled * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if entry[2] is not None]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+            return True
+
+    def _drop_cancelled_top(self):
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+    def next_due(self):
+        """Due time of the earliest pending timer, or None"""
+        with self.wakeup:
+            self._drop_cancelled_top()
+            return self.heap[0][0] if self.heap else None
+
+    def advance(self, now=None):
+        """Fire every timer due up to now - returns the number fired"""
+        now = self.clock() if now is None else now
+        due = []
+
+        with self.wakeup:
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if entry[2] is None:
+                    self.cancelled -= 1
+                    continue
+                del self.timers[entry[1]]
+                due.append(entry)
+
+        # Callbacks run outside the lock so they can schedule follow-up timers
+        for _due, _timer_id, callback, args in due:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"⚠️ Timer callback error: {e}")
+        return len(due)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def start(self, name="timer-heap"):
+        """Fire timers from a background thread"""
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while self._running:
+            with self.wakeup:
+                self._drop_cancelled_top()
+                wait = self.max_wait
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - self.clock())
+                if wait > 0:
+                    self.wakeup.wait(wait)
+            self.advance()
+
+    def stop(self):
+        self._running = False
+        with self.wakeup:
+            self.wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=self.max_wait * 5)
+            self._thread = None
+
+class CommandAckTracker:
+    """Tracks every in-flight command until it is confirmed or its deadline passes"""
+
+    def __init__(self, on_expire, wheel=None):
+        self.on_expire = on_expire  # callable(record) - runs on the wheel thread
+        self.wheel = wheel or HashedTimerWheel()
+        self.records = {}           # command_id -> record
+        self.by_device_slot = {}    # (device_id, slot) -> deque of command_ids, oldest first
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.stats = {"tracked": 0, "acked": 0, "expired": 0}
+
+    def new_command_id(self):
+        # The pid keeps ids unique when several worker processes share one command history
+        return f"cmd-{int(time.time())}-{os.getpid()}-{next(self._ids)}"
+
+    def track(self, record, timeout):
+        """Start the ack deadline for a dispatched command (record needs command_id, device_id, slot)"""
+        command_id = record["command_id"]
+        key = (record["device_id"], record["slot"])
+
+        with self.lock:
+            self.records[command_id] = record
+            queue = self.by_device_slot.get(key)
+            if queue is None:
+                queue = self.by_device_slot[key] = deque()
+            queue.append(command_id)
+            self.stats["tracked"] += 1
+
+        record["deadline"] = time.time() + timeout
+        record["timer_id"] = self.wheel.schedule(timeout, self._expire, command_id)
+        return command_id
+
+    def _detach(self, command_id):
+        record = self.records.pop(command_id, None)
+        if record is None:
+            return None
+        key = (record["device_id"], record["slot"])
+        queue = self.by_device_slot.get(key)
+        if queue is not None:
+            if queue and queue[0] == command_id:
+                queue.popleft()
+            else:
+                try:
+                    queue.remove(command_id)
+                except ValueError:
+                    pass
+            if not queue:
+                del self.by_device_slot[key]
+        return record
+
+    def ack(self, device_id, slot, command_id=None):
+        """Confirmation arrived - cancel the deadline and return the tracked record (or None)
+
+        Without a command_id (older firmware) the oldest command for the device and slot is taken.
+        An unknown command_id returns None - it was settled already, and must not ack a retry.
+        """
+        with self.lock:
+            if command_id is None:
+                queue = self.by_device_slot.get((device_id, slot))
+                if not queue:
+                    return None
+                command_id = queue[0]
+            record = self._detach(command_id)
+            if record is None:
+                return None
+            self.stats["acked"] += 1
+
+        self.wheel.cancel(record.get("timer_id"))
+        return record
+
+    def discard(self, command_id):
+        """Stop tracking a command that never left (dispatch failed) - returns its record or None"""
+        with self.lock:
+            record = self._detach(command_id)
+        if record is not None:
+            self.wheel.cancel(record.get("timer_id"))
+        return record
+
+    def _expire(self, command_id):
+        with self.lock:
+            record = self._detach(command_id)
+            if record is None:
+                return
+            self.stats["expired"] += 1
+        self.on_expire(record)
+
+    def in_flight(self):
+        with self.lock:
+            return list(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
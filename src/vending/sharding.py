@@ -0,0 +1,186 @@
+"""
+Device Sharding
+Consistent-hash ring that assigns each device_id to one server node, plus request forwarding
+"""
+
+import bisect
+import hashlib
+import json
+import socket
+import threading
+from urllib.parse import urlsplit
+
+DEFAULT_VNODES = 100  # Points per node on the ring - more points, more even shards
+FORWARDED_HEADER = "X-Vending-Forwarded-By"
+CLIENT_ADDR_HEADER = "X-Vending-Client-Addr"  # Original client address on a forwarded request (trusted from peers only)
+NODE_HEADER = "X-Vending-Node"
+FORWARD_MODES = ("proxy", "redirect")
+DEFAULT_FORWARD_TIMEOUT = 5.0   # Owner's own processing time - long-polls add their ?wait= on top
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+# Response headers worth passing back from the owning node
+PASSTHROUGH_HEADERS = ("Content-Type", "Location", "Cache-Control", "ETag", "Retry-After")
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hashing - adding or removing a node only moves the devices on its arcs"""
+
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self.points = []  # Sorted hashes
+        self.owners = []  # Node at each point
+        self.nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.vnodes):
+            point = _hash(f"{node}#{replica}")
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove_node(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        keep = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _owner in keep]
+        self.owners = [owner for _point, owner in keep]
+
+    def node_for(self, key):
+        """Owning node: the first point clockwise from the key's hash"""
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[index]
+
+class ClusterRouter:
+    """This node's view of the cluster: who owns a device, and how to reach them"""
+
+    def __init__(self, node_id, nodes, mode="proxy", vnodes=DEFAULT_VNODES, timeout=DEFAULT_FORWARD_TIMEOUT):
+        if node_id not in nodes:
+            raise ValueError(f"Node {node_id} is not in the cluster node list")
+        if mode not in FORWARD_MODES:
+            raise ValueError(f"Unknown forward mode: {mode}")
+        self.node_id = node_id
+        self.nodes = dict(nodes)  # node_id -> base URL
+        self.mode = mode
+        self.timeout = timeout
+        self.ring = HashRing(self.nodes, vnodes)
+        self.lock = threading.Lock()
+        self._session = None
+        self._peer_addresses = None  # Resolved on first use, reset when membership changes
+        self.stats = {"local": 0, "proxied": 0, "redirected": 0, "proxy_errors": 0, "proxy_timeouts": 0}
+
+    @classmethod
+    def from_config(cls, node_id, nodes_spec, mode="proxy"):
+        """Build from "a=http://10.0.0.5:5000,b=http://10.0.0.6:5000" - None when sharding is off"""
+        if not node_id or not nodes_spec:
+            return None
+        nodes = {}
+        for item in nodes_spec.split(","):
+            name, _, url = item.strip().partition("=")
+            if name and url:
+                nodes[name.strip()] = url.strip().rstrip("/")
+        return cls(node_id, nodes, mode)
+
+    def owner(self, device_id):
+        with self.lock:
+            return self.ring.node_for(device_id)
+
+    def is_local(self, device_id):
+        return self.owner(device_id) == self.node_id
+
+    def set_nodes(self, nodes):
+        """Replace the membership - returns (added, removed) node ids"""
+        with self.lock:
+            added = [node for node in nodes if node not in self.nodes]
+            removed = [node for node in self.nodes if node not in nodes]
+            if self.node_id in removed:
+                raise ValueError("A node cannot remove itself - drain it and update the other nodes")
+            for node in removed:
+                self.ring.remove_node(node)
+            for node in added:
+                self.ring.add_node(node)
+            self.nodes = dict(nodes)
+            self._peer_addresses = None
+            return added, removed
+
+    def is_peer(self, address):
+        """Whether a request came from another node of the cluster (so its CLIENT_ADDR_HEADER can be trusted)"""
+        with self.lock:
+            if self._peer_addresses is None:
+                peers = set()
+                for node, url in self.nodes.items():
+                    host = urlsplit(url).hostname
+                    if node == self.node_id or not host:
+                        continue
+                    peers.add(host)
+                    try:
+                        peers.add(socket.gethostbyname(host))
+                    except OSError:
+                        pass
+                self._peer_addresses = peers
+            return address in self._peer_addresses
+
+    def url_for(self, node, path):
+        return self.nodes[node] + path
+
+    def forward(self, node, method, path, body=None, headers=None, timeout=None, client_addr=None):
+        """Send the request on to the owning node - returns (status, headers, body)
+
+        An unreachable owner is a 502. An owner that took the request but did not
+        answer within timeout is a 504: for a POST (a vend) it may have acted on
+        it, so the client is told the outcome is unknown rather than to retry.
+        """
+        import requests  # Imported on first forward so single-node servers never pay for it
+        if self._session is None:
+            self._session = requests.Session()
+
+        forward_headers = {key: value for key, value in (headers or {}).items()
+                           if key in ("Content-Type", "Accept")}
+        forward_headers[FORWARDED_HEADER] = self.node_id
+        if client_addr:
+            forward_headers[CLIENT_ADDR_HEADER] = client_addr
+        try:
+            response = self._session.request(method, self.url_for(node, path), data=body,
+                                             headers=forward_headers, timeout=timeout or self.timeout,
+                                             allow_redirects=False)
+        except requests.exceptions.ReadTimeout:
+            self.stats["proxy_timeouts"] += 1
+            if method.upper() in IDEMPOTENT_METHODS:
+                message, reason = f"Owning node {node} did not answer in time", "timeout"
+            else:
+                message, reason = (f"Owning node {node} did not answer in time - outcome unknown, check before "
+                                   "retrying (the request may have been applied)"), "outcome_unknown"
+            return 504, {"Content-Type": "application/json"}, json.dumps({
+                "status": "error",
+                "message": message,
+                "reason": reason
+            })
+        except requests.exceptions.RequestException as e:
+            self.stats["proxy_errors"] += 1
+            return 502, {"Content-Type": "application/json"}, json.dumps({
+                "status": "error",
+                "message": f"Owning node {node} unreachable ({type(e).__name__})"
+            })
+
+        self.stats["proxied"] += 1
+        passthrough = {key: response.headers[key] for key in PASSTHROUGH_HEADERS if key in response.headers}
+        return response.status_code, passthrough, response.content
+
+    def describe(self):
+        with self.lock:
+            return {
+                "node_id": self.node_id,
+                "nodes": dict(self.nodes),
+                "mode": self.mode,
+                "vnodes": self.ring.vnodes,
+                "stats": dict(self.stats)
+            }
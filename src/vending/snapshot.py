@@ -0,0 +1,92 @@
+"""
+Warm-Restart Snapshots
+Gzipped JSON of the fleet state, written on drain and loaded once at startup
+"""
+
+import gzip
+import json
+import os
+import time
+
+SNAPSHOT_VERSION = 1
+
+def write_snapshot(path, payload):
+    """Write atomically (temp file + rename) - returns the compressed size in bytes"""
+    payload = dict(payload, version=SNAPSHOT_VERSION, written_at=time.time())
+    data = gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"), compresslevel=6)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(data)
+
+def read_snapshot(path, max_age=None, consume=True):
+    """Load a snapshot - None if missing, unreadable, from another version, or older than max_age
+
+    With consume=True the file is removed once loaded, so a later crash never
+    replays the same queued commands twice; with consume=False the caller removes
+    it once the restore has worked. A snapshot that cannot be loaded (truncated by
+    a crash mid-drain, or from another version) is renamed aside either way, so
+    the commands and scheduled vends in it can still be recovered. One older than
+    max_age is removed.
+    """
+    try:
+        with open(path, "rb") as f:
+            payload = json.loads(gzip.decompress(f.read()).decode("utf-8"))
+        if not isinstance(payload, dict):
+            raise ValueError("not a snapshot object")
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError) as e:
+        print(f"⚠️ Ignoring unreadable snapshot {path}: {e}")
+        set_aside_snapshot(path)
+        return None
+
+    if payload.get("version") != SNAPSHOT_VERSION:
+        print(f"⚠️ Ignoring snapshot {path} (version {payload.get('version')})")
+        set_aside_snapshot(path)
+        return None
+    age = time.time() - payload.get("written_at", 0)
+    if max_age is not None and age > max_age:
+        print(f"⚠️ Ignoring snapshot {path} ({age / 3600:.1f} h old)")
+        remove_snapshot(path)
+        return None
+    if consume:
+        remove_snapshot(path)
+    return payload
+
+def claim_snapshot(path):
+    """Take the snapshot for this process - returns the path it now has, or None if there is none
+
+    Workers sharing a state backend all start against the same file; the rename
+    lets exactly one of them restore it (the per-process parts, like scheduled
+    vends, would otherwise run once per worker or not at all). If that worker dies
+    mid-restore the file stays under the claimed name for recovery.
+    """
+    claimed_path = f"{path}.restoring-{os.getpid()}"
+    try:
+        os.replace(path, claimed_path)
+    except FileNotFoundError:
+        return None
+    return claimed_path
+
+def remove_snapshot(path):
+    """Delete a snapshot whose contents are live again (restored, or a drain that was called off)"""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def set_aside_snapshot(path):
+    """Rename a snapshot that could not be loaded (or restored) so the next start does not trip over it again"""
+    corrupt_path = f"{path}.corrupt-{int(time.time() * 1000)}"
+    try:
+        os.replace(path, corrupt_path)
+        print(f"⚠️ Snapshot kept as {corrupt_path} for recovery")
+    except OSError as e:
+        print(f"⚠️ Could not move snapshot {path} aside: {e}")
@@ -0,0 +1,768 @@
+"""
+Shared State Backends
+Device registry, poll queue, command history and settings - per process or shared between workers
+"""
+
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from array import array
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from queue import Empty
+
+from . import commlog
+from .commlog import CommunicationLog, DEFAULT_RETENTION, DEFAULT_DEVICE_RETENTION, entry_dict
+from .models import SlotInventory, SLOT_COUNT
+from .priority import CommandPriorityQueue, PRIORITY_CLASSES, classify, dispatch_key, priority_rank
+
+OPEN_COMMAND_STATUSES = ("sent", "retrying")
+WAKEUP_RECHECK_INTERVAL = 0.5  # Waiters re-check the store this often in case a wakeup is lost
+LOG_TRIM_INTERVAL = 500  # Shared comm log: trim back to retention once per this many appends of a process
+LOG_COLUMNS = "seq, timestamp, direction, message, type, device_id, device_type, updated_seq"
+
+class CommandWakeups:
+    """Per-device events that wake long-polls when a command is queued"""
+
+    def __init__(self):
+        self.waiters = {}  # device_id -> set of threading.Event
+        self.lock = threading.Lock()
+
+    def wake(self, device_id):
+        with self.lock:
+            events = list(self.waiters.get(device_id, ()))
+        for event in events:
+            event.set()
+
+    def wait(self, device_id, timeout, has_command, recheck=None):
+        """Block until has_command() is true or timeout passes - returns the last check"""
+        deadline = time.monotonic() + timeout
+        event = threading.Event()
+        with self.lock:
+            self.waiters.setdefault(device_id, set()).add(event)
+
+        try:
+            while True:
+                if has_command():
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                event.wait(min(remaining, recheck) if recheck else remaining)
+                event.clear()
+        finally:
+            with self.lock:
+                events = self.waiters.get(device_id)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self.waiters[device_id]
+
+class PresenceSlots:
+    """Last-seen times of online WiFi devices in one flat array - a poll's liveness update is a slot store
+
+    A device holds a slot while it is registered and online; polls from devices
+    without one take the full registry update instead.
+    """
+
+    def __init__(self):
+        self.slots = {}  # device_id -> index into times
+        self.times = array("d")
+        self.free = []
+        self.lock = threading.Lock()
+
+    def touch(self, device_id, now):
+        """Record a sighting - False if the device holds no slot"""
+        with self.lock:
+            slot = self.slots.get(device_id)
+            if slot is None:
+                return False
+            self.times[slot] = now
+            return True
+
+    def assign(self, device_id, now):
+        with self.lock:
+            slot = self.slots.get(device_id)
+            if slot is None:
+                if self.free:
+                    slot = self.free.pop()
+                else:
+                    slot = len(self.times)
+                    self.times.append(0.0)
+                self.slots[device_id] = slot
+            self.times[slot] = now
+
+    def release(self, device_id):
+        with self.lock:
+            slot = self.slots.pop(device_id, None)
+            if slot is not None:
+                self.free.append(slot)
+
+    def last_seen(self, device_id):
+        with self.lock:
+            slot = self.slots.get(device_id)
+            return None if slot is None else self.times[slot]
+
+    def snapshot(self):
+        """{device_id: last_seen} for every slot"""
+        with self.lock:
+            return {device_id: self.times[slot] for device_id, slot in self.slots.items()}
+
+    def __len__(self):
+        return len(self.slots)
+
+class CommandHistory:
+    """Append-only vend history with lookup by command_id"""
+
+    def __init__(self):
+        self.entries = []
+        self.by_id = {}
+
+    def append(self, entry):
+        self.entries.append(entry)
+        if entry.get("command_id"):
+            self.by_id[entry["command_id"]] = entry
+
+    def update(self, entry, **fields):
+        """Change fields of an entry previously returned by append/get/find_open"""
+        entry.update(fields)
+
+    def get(self, command_id):
+        return self.by_id.get(command_id)
+
+    def find_open(self, device_id, slot):
+        """Oldest entry for device+slot still waiting for a result"""
+        for entry in self.entries:
+            if entry.get("device_id") == device_id and entry.get("slot") == slot and entry.get("status") in OPEN_COMMAND_STATUSES:
+                return entry
+        return None
+
+    def recent(self, limit):
+        return self.entries[-limit:]
+
+    def __len__(self):
+        return len(self.entries)
+
+class InProcessState:
+    """Default backend - plain dicts in this process (one server process only)"""
+
+    name = "memory"
+    shared = False
+
+    def __init__(self, log_retention=DEFAULT_RETENTION, log_device_retention=DEFAULT_DEVICE_RETENTION):
+        self.devices = {}
+        self.network_devices = {}
+        self.presence = PresenceSlots()
+        self.command_queues = {}  # device_id -> CommandPriorityQueue
+        self.command_history = CommandHistory()
+        self.comm_log = CommunicationLog(log_retention, log_device_retention)
+        self.inventory = SlotInventory()
+        self.settings = {}
+        self.wakeups = CommandWakeups()
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def queue_command(self, device_id, command, priority=None):
+        """Queue a command for the device's polls - priority class defaults from the command name"""
+        queue = self.command_queues.get(device_id)
+        if queue is None:
+            queue = self.command_queues.setdefault(device_id, CommandPriorityQueue())
+        queue.put(command, priority or classify(command.get("command")))
+        self.wakeups.wake(device_id)
+
+    def take_command(self, device_id):
+        """Next command for the device in priority order (None if nothing is queued)"""
+        queue = self.command_queues.get(device_id)
+        if queue is None:
+            return None
+        try:
+            return queue.get_nowait()
+        except Empty:
+            return None
+
+    def has_command(self, device_id):
+        queue = self.command_queues.get(device_id)
+        return queue is not None and not queue.empty()
+
+    def withdraw_command(self, device_id, command_id):
+        """Remove a queued command the device never picked up - True if it was still queued"""
+        queue = self.command_queues.get(device_id)
+        return bool(queue and queue.remove(lambda command: command.get("command_id") == command_id))
+
+    def drop_commands(self, device_id):
+        self.command_queues.pop(device_id, None)
+
+    def pending_commands(self, device_id=None):
+        """{device_id: [{"priority", "command"}, ...]} in dispatch order"""
+        device_ids = [device_id] if device_id is not None else list(self.command_queues)
+        pending = {}
+        for queued_device in device_ids:
+            queue = self.command_queues.get(queued_device)
+            if queue:
+                pending[queued_device] = [{"priority": priority, "command": command}
+                                          for priority, command in queue.items()]
+        return pending
+
+    def take_all_commands(self):
+        """Empty every queue - pending_commands() form; a command goes either to a poll or here, never both"""
+        taken = {}
+        for device_id, queue in list(self.command_queues.items()):
+            queued = queue.drain()
+            if queued:
+                taken[device_id] = [{"priority": priority, "command": command} for priority, command in queued]
+        return taken
+
+    def wait_for_command(self, device_id, timeout):
+        return self.wakeups.wait(device_id, timeout, lambda: self.has_command(device_id))
+
+    def close(self):
+        pass
+
+class SQLiteTable(MutableMapping):
+    """Dict-like view of a key/JSON-value table - every read and write goes to the database
+
+    Values are copies: after changing a value, assign it back to persist it.
+    """
+
+    def __init__(self, state, table, scope=None):
+        self.state = state
+        self.table = table
+        self.scope = scope  # Several mappings can share one table, separated by scope
+        self.where = "scope = ? AND key = ?"
+
+    def _params(self, key):
+        return (self.scope, key)
+
+    def __getitem__(self, key):
+        row = self.state.execute(f"SELECT value FROM {self.table} WHERE {self.where}", self._params(key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.state.execute(f"INSERT OR REPLACE INTO {self.table} (scope, key, value) VALUES (?, ?, ?)",
+                           (self.scope, key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        if self.state.execute(f"DELETE FROM {self.table} WHERE {self.where}", self._params(key)).rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.state.execute(f"SELECT 1 FROM {self.table} WHERE {self.where}", self._params(key)).fetchone() is not None
+
+    def __iter__(self):
+        rows = self.state.execute(f"SELECT key FROM {self.table} WHERE scope = ?", (self.scope,)).fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.state.execute(f"SELECT COUNT(*) FROM {self.table} WHERE scope = ?", (self.scope,)).fetchone()[0]
+
+    def items(self):
+        rows = self.state.execute(f"SELECT key, value FROM {self.table} WHERE scope = ?", (self.scope,)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def values(self):
+        return [value for _key, value in self.items()]
+
+    def pop(self, key, *default):
+        """Atomic take - two workers popping the same key never both get the value"""
+        with self.state.transaction():
+            row = self.state.execute(f"SELECT value FROM {self.table} WHERE {self.where}", self._params(key)).fetchone()
+            if row is not None:
+                self.state.execute(f"DELETE FROM {self.table} WHERE {self.where}", self._params(key))
+        if row is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return json.loads(row[0])
+
+class SQLiteCommandHistory:
+    """CommandHistory stored in the shared database"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def append(self, entry):
+        self.state.execute(
+            "INSERT OR REPLACE INTO command_history (command_id, device_id, slot, status, entry) VALUES (?, ?, ?, ?, ?)",
+            (entry.get("command_id"), entry.get("device_id"), entry.get("slot"), entry.get("status"), json.dumps(entry)))
+
+    def update(self, entry, **fields):
+        entry.update(fields)
+        self.state.execute("UPDATE command_history SET status = ?, entry = ? WHERE command_id = ?",
+                           (entry.get("status"), json.dumps(entry), entry.get("command_id")))
+
+    def get(self, command_id):
+        row = self.state.execute("SELECT entry FROM command_history WHERE command_id = ?", (command_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_open(self, device_id, slot):
+        placeholders = ", ".join("?" * len(OPEN_COMMAND_STATUSES))
+        row = self.state.execute(
+            f"SELECT entry FROM command_history WHERE device_id = ? AND slot = ? AND status IN ({placeholders}) "
+            "ORDER BY seq LIMIT 1", (device_id, slot) + OPEN_COMMAND_STATUSES).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def recent(self, limit):
+        rows = self.state.execute("SELECT entry FROM command_history ORDER BY seq DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    def __len__(self):
+        return self.state.execute("SELECT COUNT(*) FROM command_history").fetchone()[0]
+
+class SQLiteCommunicationLog:
+    """CommunicationLog stored in the shared database - one sequence for every worker, so after_seq cursors hold
+
+    Retention is trimmed every LOG_TRIM_INTERVAL appends of a process, so the log can run that far over it.
+    """
+
+    def __init__(self, state, retention=DEFAULT_RETENTION, device_retention=DEFAULT_DEVICE_RETENTION):
+        self.state = state
+        self.retention = retention
+        self.device_retention = device_retention
+        self.appends_since_trim = 0
+
+    def _next_seq(self):
+        # Appends and rewrites draw from one counter, like CommunicationLog.next_seq
+        return self.state.execute("INSERT INTO counters (name, value) VALUES ('comm_log', 1) "
+                                  "ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value").fetchall()[0][0]
+
+    def __len__(self):
+        return self.state.execute("SELECT COUNT(*) FROM comm_log").fetchone()[0]
+
+    def append(self, direction, message, msg_type, device_id, device_type, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.state.transaction():
+            seq = self._next_seq()
+            self.state.execute("INSERT INTO comm_log (seq, timestamp, direction, message, type, device_id, device_type) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (seq, timestamp, direction, message, msg_type, device_id, device_type))
+        self.appends_since_trim += 1
+        if self.appends_since_trim >= LOG_TRIM_INTERVAL:
+            self.appends_since_trim = 0
+            self._trim()
+        return seq
+
+    def _trim(self):
+        with self.state.transaction():
+            self.state.execute("DELETE FROM comm_log WHERE seq <= "
+                               "(SELECT seq FROM comm_log ORDER BY seq DESC LIMIT 1 OFFSET ?)", (self.retention,))
+            chatty = self.state.execute("SELECT device_id FROM comm_log GROUP BY device_id HAVING COUNT(*) > ?",
+                                        (self.device_retention,)).fetchall()
+            for (device_id,) in chatty:
+                self.state.execute("DELETE FROM comm_log WHERE device_id = ? AND seq <= (SELECT seq FROM comm_log "
+                                   "WHERE device_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                                   (device_id, device_id, self.device_retention))
+
+    def update_message(self, seq, message):
+        with self.state.transaction():
+            if self.state.execute("SELECT 1 FROM comm_log WHERE seq = ?", (seq,)).fetchone() is None:
+                return None
+            updated_seq = self._next_seq()
+            self.state.execute("UPDATE comm_log SET message = ?, updated_seq = ? WHERE seq = ?", (message, updated_seq, seq))
+        return updated_seq
+
+    def _filters(self, device_id, msg_type, direction):
+        clauses, params = [], []
+        for column, value in (("device_id", device_id), ("type", msg_type), ("direction", direction)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return clauses, params
+
+    def changed(self, after_seq, device_id=None, msg_type=None, direction=None):
+        clauses, params = self._filters(device_id, msg_type, direction)
+        where = " AND ".join(["seq <= ?", "updated_seq > ?"] + clauses)
+        rows = self.state.execute(f"SELECT {LOG_COLUMNS} FROM comm_log WHERE {where} ORDER BY seq",
+                                  [after_seq, after_seq] + params).fetchall()
+        return [entry_dict(row[:-1], row[-1]) for row in rows]
+
+    def query(self, device_id=None, msg_type=None, direction=None, since=None, until=None, after_seq=None,
+              limit=commlog.DEFAULT_LIMIT):
+        limit = max(0, min(int(limit), commlog.MAX_LIMIT))
+        clauses, params = self._filters(device_id, msg_type, direction)
+        clauses.insert(0, "seq > ?")
+        params.insert(0, after_seq or 0)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+        order = "ASC" if after_seq is not None else "DESC"
+        rows = self.state.execute(f"SELECT {LOG_COLUMNS} FROM comm_log WHERE {' AND '.join(clauses)} "
+                                  f"ORDER BY seq {order} LIMIT ?", params + [limit]).fetchall()
+        if after_seq is None:
+            rows.reverse()
+        return [entry_dict(row[:-1], row[-1]) for row in rows]
+
+    def recent(self, limit=commlog.DEFAULT_LIMIT):
+        return self.query(limit=limit)
+
+    def last_seq(self):
+        row = self.state.execute("SELECT value FROM counters WHERE name = 'comm_log'").fetchone()
+        return row[0] if row else 0
+
+    def clear(self):
+        self.state.execute("DELETE FROM comm_log")
+
+    def describe(self):
+        entries, devices = self.state.execute("SELECT COUNT(*), COUNT(DISTINCT device_id) FROM comm_log").fetchone()
+        return {
+            "entries": entries,
+            "retention": self.retention,
+            "device_retention": self.device_retention,
+            "devices": devices,
+            "last_seq": self.last_seq()
+        }
+
+class SQLiteSlotInventory:
+    """SlotInventory in the shared database - a reserve is one conditional UPDATE, so two workers never take the last unit"""
+
+    def __init__(self, state, slot_count=SLOT_COUNT):
+        self.state = state
+        self.slot_count = slot_count
+
+    def is_tracked(self, device_id):
+        return self.state.execute("SELECT 1 FROM inventory_devices WHERE device_id = ?", (device_id,)).fetchone() is not None
+
+    def available(self, device_id, slot):
+        if not self.is_tracked(device_id):
+            return None
+        row = self.state.execute("SELECT stock FROM inventory WHERE device_id = ? AND slot = ?", (device_id, slot)).fetchone()
+        return row[0] if row else 0
+
+    def _touch(self, device_id):
+        self.state.execute("UPDATE inventory_devices SET updated_at = ? WHERE device_id = ?", (time.time(), device_id))
+
+    def reserve(self, device_id, slot):
+        if not self.is_tracked(device_id):
+            return True
+        with self.state.transaction():
+            if self.state.execute("UPDATE inventory SET stock = stock - 1 WHERE device_id = ? AND slot = ? AND stock > 0",
+                                  (device_id, slot)).rowcount == 0:
+                return False
+            self._touch(device_id)
+        return True
+
+    def restore(self, device_id, slot):
+        if not self.is_tracked(device_id):
+            return
+        with self.state.transaction():
+            self.state.execute("INSERT INTO inventory (device_id, slot, stock) VALUES (?, ?, 1) "
+                               "ON CONFLICT (device_id, slot) DO UPDATE SET stock = "
+                               "CASE WHEN capacity IS NULL THEN stock + 1 ELSE MIN(stock + 1, capacity) END",
+                               (device_id, slot))
+            self._touch(device_id)
+
+    def restock(self, device_id, levels, mode="set", capacities=None):
+        with self.state.transaction():
+            for slot, units in levels.items():
+                row = self.state.execute("SELECT stock, capacity FROM inventory WHERE device_id = ? AND slot = ?",
+                                         (device_id, slot)).fetchone()
+                stock, cap = row if row else (0, None)
+                units = units + stock if mode == "add" else units
+                if capacities and slot in capacities:
+                    cap = capacities[slot]
+                self.state.execute("INSERT OR REPLACE INTO inventory (device_id, slot, stock, capacity) VALUES (?, ?, ?, ?)",
+                                   (device_id, slot, max(0, min(units, cap) if cap is not None else units), cap))
+            self.state.execute("INSERT OR REPLACE INTO inventory_devices (device_id, updated_at) VALUES (?, ?)",
+                               (device_id, time.time()))
+
+    def clear(self, device_id):
+        with self.state.transaction():
+            self.state.execute("DELETE FROM inventory_devices WHERE device_id = ?", (device_id,))
+            self.state.execute("DELETE FROM inventory WHERE device_id = ?", (device_id,))
+
+    def snapshot(self, device_id):
+        row = self.state.execute("SELECT updated_at FROM inventory_devices WHERE device_id = ?", (device_id,)).fetchone()
+        if row is None:
+            return {"device_id": device_id, "tracked": False, "slots": {}}
+
+        stored = {slot: (stock, capacity) for slot, stock, capacity in self.state.execute(
+            "SELECT slot, stock, capacity FROM inventory WHERE device_id = ?", (device_id,)).fetchall()}
+        slots = {}
+        for slot in range(1, self.slot_count + 1):
+            stock, capacity = stored.get(slot, (0, None))
+            slots[str(slot)] = {"available": stock, "capacity": capacity}
+        return {
+            "device_id": device_id,
+            "tracked": True,
+            "slots": slots,
+            "empty_slots": [int(s) for s, info in slots.items() if info["available"] <= 0],
+            "updated_at": row[0]
+        }
+
+    def snapshot_all(self):
+        device_ids = [row[0] for row in self.state.execute("SELECT device_id FROM inventory_devices").fetchall()]
+        return {device_id: self.snapshot(device_id) for device_id in device_ids}
+
+class SQLitePresence:
+    """PresenceSlots in the shared database - one narrow row per online device"""
+
+    def __init__(self, state):
+        self.state = state
+
+    def touch(self, device_id, now):
+        return self.state.execute("UPDATE presence SET last_seen = ? WHERE device_id = ?",
+                                  (now, device_id)).rowcount > 0
+
+    def assign(self, device_id, now):
+        self.state.execute("INSERT OR REPLACE INTO presence (device_id, last_seen) VALUES (?, ?)", (device_id, now))
+
+    def release(self, device_id):
+        self.state.execute("DELETE FROM presence WHERE device_id = ?", (device_id,))
+
+    def last_seen(self, device_id):
+        row = self.state.execute("SELECT last_seen FROM presence WHERE device_id = ?", (device_id,)).fetchone()
+        return row[0] if row else None
+
+    def snapshot(self):
+        return dict(self.state.execute("SELECT device_id, last_seen FROM presence").fetchall())
+
+    def __len__(self):
+        return self.state.execute("SELECT COUNT(*) FROM presence").fetchone()[0]
+
+class WakeupChannel:
+    """Cross-process wakeups: every process binds a Unix datagram socket in a shared directory
+
+    Queuing a command sends the device_id to every socket there; sockets left
+    behind by dead processes refuse the datagram and are removed.
+    """
+
+    def __init__(self, directory, on_wakeup):
+        self.directory = directory
+        self.on_wakeup = on_wakeup
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{os.getpid()}-{id(self) % 100000}.sock")
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.running = True
+        self.thread = threading.Thread(target=self._listen, name="state-wakeups", daemon=True)
+        self.thread.start()
+
+    def _listen(self):
+        while self.running:
+            try:
+                data = self.sock.recv(1024)
+            except OSError:
+                break
+            self.on_wakeup(data.decode("utf-8", errors="ignore"))
+
+    def broadcast(self, device_id):
+        payload = device_id.encode("utf-8")
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if path == self.path or not name.endswith(".sock"):
+                continue
+            try:
+                self.sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)  # Process is gone
+                except OSError:
+                    pass
+            except OSError:
+                pass  # Receiver's buffer is full - it re-checks on its own shortly
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.close()
+            self.sender.close()
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class SQLiteState:
+    """Shared backend - one SQLite database in WAL mode used by every worker process"""
+
+    name = "sqlite"
+    shared = True
+
+    def __init__(self, path, log_retention=DEFAULT_RETENTION, log_device_retention=DEFAULT_DEVICE_RETENTION):
+        self.path = os.path.abspath(path)
+        self.local = threading.local()  # One connection per thread
+        self._connect().executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                scope TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+                PRIMARY KEY (scope, key)
+            );
+            CREATE TABLE IF NOT EXISTS command_history (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                command_id TEXT UNIQUE, device_id TEXT, slot INTEGER, status TEXT, entry TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS command_history_open ON command_history (device_id, slot, status);
+            CREATE TABLE IF NOT EXISTS command_queue (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                device_id TEXT NOT NULL, rank INTEGER NOT NULL, enqueued_at REAL NOT NULL, command TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS command_queue_device ON command_queue (device_id);
+            CREATE TABLE IF NOT EXISTS presence (
+                device_id TEXT PRIMARY KEY, last_seen REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY, value INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS comm_log (
+                seq INTEGER PRIMARY KEY, timestamp REAL NOT NULL, direction TEXT, message TEXT,
+                type TEXT, device_id TEXT, device_type TEXT, updated_seq INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS comm_log_device ON comm_log (device_id, seq);
+            CREATE INDEX IF NOT EXISTS comm_log_type ON comm_log (type, seq);
+            CREATE INDEX IF NOT EXISTS comm_log_direction ON comm_log (direction, seq);
+            CREATE INDEX IF NOT EXISTS comm_log_time ON comm_log (timestamp);
+            CREATE INDEX IF NOT EXISTS comm_log_updated ON comm_log (updated_seq) WHERE updated_seq IS NOT NULL;
+            CREATE TABLE IF NOT EXISTS inventory (
+                device_id TEXT NOT NULL, slot INTEGER NOT NULL, stock INTEGER NOT NULL, capacity INTEGER,
+                PRIMARY KEY (device_id, slot)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS inventory_devices (
+                device_id TEXT PRIMARY KEY, updated_at REAL
+            ) WITHOUT ROWID;
+        """)
+
+        self.devices = SQLiteTable(self, "kv", "devices")
+        self.network_devices = SQLiteTable(self, "kv", "network_devices")
+        self.presence = SQLitePresence(self)
+        self.settings = SQLiteTable(self, "kv", "settings")
+        self.command_history = SQLiteCommandHistory(self)
+        self.comm_log = SQLiteCommunicationLog(self, log_retention, log_device_retention)
+        self.inventory = SQLiteSlotInventory(self)
+        self.wakeups = CommandWakeups()
+
+        self.channel = None
+        if hasattr(socket, "AF_UNIX"):
+            # Short path in the temp dir - Unix socket paths are limited to ~100 bytes
+            digest = hashlib.sha1(self.path.encode()).hexdigest()[:12]
+            directory = os.path.join(tempfile.gettempdir(), f"vending-wakeups-{digest}")
+            try:
+                self.channel = WakeupChannel(directory, self.wakeups.wake)
+            except OSError as e:
+                print(f"⚠️ Cross-process wakeups unavailable ({e}) - long-polls re-check every {WAKEUP_RECHECK_INTERVAL}s")
+
+    def _connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; skips an fsync per write
+            self.local.conn = conn
+            self.local.depth = 0
+        return conn
+
+    def execute(self, sql, params=()):
+        return self._connect().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one transaction (nests; the outermost commits)"""
+        conn = self._connect()
+        if self.local.depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        self.local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            conn.execute("COMMIT")
+
+    def queue_command(self, device_id, command, priority=None):
+        """Queue a command for the device's polls and wake long-polls in every worker"""
+        rank = priority_rank(priority or classify(command.get("command")))
+        self.execute("INSERT INTO command_queue (device_id, rank, enqueued_at, command) VALUES (?, ?, ?, ?)",
+                     (device_id, rank, time.time(), json.dumps(command)))
+        self.wakeups.wake(device_id)
+        if self.channel:
+            self.channel.broadcast(device_id)
+
+    def _queued(self, device_id):
+        rows = self.execute("SELECT seq, rank, enqueued_at, command FROM command_queue WHERE device_id = ?",
+                            (device_id,)).fetchall()
+        now = time.time()
+        return sorted(rows, key=lambda row: dispatch_key(row[1], row[2], row[0], now))
+
+    def take_command(self, device_id):
+        """Atomic take of the next command - two workers never hand out the same one"""
+        with self.transaction():
+            rows = self._queued(device_id)
+            if not rows:
+                return None
+            self.execute("DELETE FROM command_queue WHERE seq = ?", (rows[0][0],))
+        return json.loads(rows[0][3])
+
+    def has_command(self, device_id):
+        return self.execute("SELECT 1 FROM command_queue WHERE device_id = ? LIMIT 1", (device_id,)).fetchone() is not None
+
+    def withdraw_command(self, device_id, command_id):
+        with self.transaction():
+            for seq, _rank, _enqueued_at, command in self._queued(device_id):
+                if json.loads(command).get("command_id") == command_id:
+                    self.execute("DELETE FROM command_queue WHERE seq = ?", (seq,))
+                    return True
+        return False
+
+    def drop_commands(self, device_id):
+        self.execute("DELETE FROM command_queue WHERE device_id = ?", (device_id,))
+
+    def pending_commands(self, device_id=None):
+        if device_id is not None:
+            device_ids = [device_id]
+        else:
+            device_ids = [row[0] for row in self.execute("SELECT DISTINCT device_id FROM command_queue").fetchall()]
+        pending = {}
+        for queued_device in device_ids:
+            rows = self._queued(queued_device)
+            if rows:
+                pending[queued_device] = [{"priority": PRIORITY_CLASSES[row[1]], "command": json.loads(row[3])}
+                                          for row in rows]
+        return pending
+
+    def take_all_commands(self):
+        with self.transaction():
+            taken = self.pending_commands()
+            self.execute("DELETE FROM command_queue")
+        return taken
+
+    def wait_for_command(self, device_id, timeout):
+        return self.wakeups.wait(device_id, timeout, lambda: self.has_command(device_id),
+                                 recheck=WAKEUP_RECHECK_INTERVAL)
+
+    def close(self):
+        if self.channel:
+            self.channel.close()
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+def create_state_backend(name="memory", path=None, log_retention=DEFAULT_RETENTION,
+                         log_device_retention=DEFAULT_DEVICE_RETENTION):
+    """Backend by name: "memory" (default, single process) or "sqlite" (shared by several workers)"""
+    if name == "sqlite":
+        return SQLiteState(path or "vending_state.db", log_retention, log_device_retention)
+    if name != "memory":
+        raise ValueError(f"Unknown state backend: {name}")
+    return InProcessState(log_retention, log_device_retention)
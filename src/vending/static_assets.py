@@ -0,0 +1,146 @@
+"""
+Static Asset Pipeline
+Fingerprints and precompresses the web interface assets once at startup
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import render_template, request
+
+try:
+    import brotli  # Optional - gzip is always available
+except ImportError:
+    brotli = None
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+MIN_COMPRESS_SIZE = 512  # Smaller bodies are not worth the encoding header
+
+class PrecompressedBody:
+    """One response body kept in identity, gzip and (optionally) brotli form"""
+
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.encodings = {"identity": data}
+
+        if len(data) >= MIN_COMPRESS_SIZE:
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) < len(data):
+                self.encodings["gzip"] = gzipped
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.encodings["br"] = compressed
+
+    def etag_for(self, encoding):
+        """Strong ETag per representation so caches never mix encodings"""
+        if encoding == "identity":
+            return self.digest[:16]
+        return f"{self.digest[:16]}-{encoding}"
+
+    def negotiate(self, accept_encodings):
+        """Pick the best encoding the client accepts (brotli > gzip > identity)"""
+        offered = [e for e in ("br", "gzip") if e in self.encodings]
+        if not offered or not accept_encodings:
+            return "identity"
+        best = accept_encodings.best_match(offered + ["identity"], default="identity")
+        return best if best in self.encodings else "identity"
+
+class StaticAssetCache:
+    """In-memory, fingerprinted copy of everything under the static folder"""
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self.manifest = {}  # "css/styles.css" -> "css/styles.<hash>.css"
+        self.assets = {}    # Both logical and fingerprinted names -> PrecompressedBody
+        self.fingerprinted = set()
+
+    def build(self):
+        """Read, hash and compress every static file (run once at startup)"""
+        self.manifest.clear()
+        self.assets.clear()
+        self.fingerprinted.clear()
+
+        if not self.static_folder or not os.path.isdir(self.static_folder):
+            return self
+
+        for root, _dirs, files in os.walk(self.static_folder):
+            for name in files:
+                full_path = os.path.join(root, name)
+                logical_name = os.path.relpath(full_path, self.static_folder).replace(os.sep, "/")
+
+                with open(full_path, "rb") as f:
+                    data = f.read()
+
+                mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                body = PrecompressedBody(data, mimetype)
+
+                stem, ext = os.path.splitext(logical_name)
+                fingerprinted_name = f"{stem}.{body.digest[:10]}{ext}"
+
+                self.manifest[logical_name] = fingerprinted_name
+                self.assets[logical_name] = body
+                self.assets[fingerprinted_name] = body
+                self.fingerprinted.add(fingerprinted_name)
+
+        return self
+
+    def url_defaults(self, endpoint, values):
+        """Rewrite url_for('static', filename=...) to the fingerprinted name"""
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = self.manifest.get(values["filename"], values["filename"])
+
+    def stats(self):
+        """Summarise sizes for logging"""
+        logical = [self.assets[name] for name in self.manifest]
+        return {
+            "files": len(logical),
+            "identity_bytes": sum(len(b.data) for b in logical),
+            "gzip_bytes": sum(len(b.encodings.get("gzip", b.data)) for b in logical),
+            "brotli": brotli is not None
+        }
+
+def make_cached_response(response_class, request, body, cache_control):
+    """Build a negotiated response for a precompressed body, honouring If-None-Match"""
+    encoding = body.negotiate(request.accept_encodings)
+    etag = body.etag_for(encoding)
+
+    if request.if_none_match.contains(etag):
+        response = response_class(status=304)
+    else:
+        response = response_class(body.encodings[encoding], mimetype=body.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def init_static_assets(app, index_template="index.html"):
+    """Startup step: build the asset cache, hook static serving and pre-render the index page"""
+    cache = StaticAssetCache(app.static_folder).build()
+    app.url_default_functions.setdefault(None, []).append(cache.url_defaults)
+
+    def serve_static(filename):
+        body = cache.assets.get(filename)
+        if body is None:
+            return app.send_static_file(filename)
+
+        cache_control = IMMUTABLE_CACHE_CONTROL if filename in cache.fingerprinted else REVALIDATE_CACHE_CONTROL
+        return make_cached_response(app.response_class, request, body, cache_control)
+
+    if "static" in app.view_functions:
+        app.view_functions["static"] = serve_static
+
+    # Render the (fully static) index page once with the fingerprinted URLs baked in
+    with app.test_request_context("/"):
+        html = render_template(index_template)
+    index_body = PrecompressedBody(html.encode("utf-8"), "text/html")
+
+    return cache, index_body
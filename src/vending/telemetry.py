@@ -0,0 +1,189 @@
+"""
+Device Telemetry
+Per-device, per-metric ring buffers for numeric /esp32/data fields, with range and downsampling queries
+"""
+
+import bisect
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+DEFAULT_SAMPLES = 120          # Per metric - e.g. two hours at one report a minute
+MAX_METRICS_PER_DEVICE = 16
+MAX_DEVICES = 10000            # Least recently reporting devices are dropped beyond this
+BYTES_PER_SAMPLE = 8           # uint32 second timestamp + float32 value
+FLOAT32_MAX = 3.4028234663852886e38  # Larger magnitudes would be stored as inf
+MAX_RAW_POINTS = 1000          # Unbucketed queries return at most this many (newest) points
+SKIP_FIELDS = {"device_id", "type", "timestamp", "ip_address"}
+
+def _f32(value):
+    """float32 sample as the shortest decimal that round-trips (3.3, not 3.2999999523)"""
+    return float(f"{value:.7g}")
+
+class MetricRing:
+    """Fixed-capacity columns (timestamps, values) allocated up front - the oldest sample is overwritten"""
+
+    __slots__ = ("times", "values", "capacity", "count", "next")
+
+    def __init__(self, capacity):
+        self.times = array("I", bytes(4 * capacity))
+        self.values = array("f", bytes(4 * capacity))
+        self.capacity = capacity
+        self.count = 0
+        self.next = 0  # Slot the next sample goes into (the oldest once the ring is full)
+
+    def append(self, timestamp, value):
+        self.times[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, index):
+        oldest = self.next if self.count == self.capacity else 0
+        return (oldest + index) % self.capacity
+
+    def __getitem__(self, index):
+        """Timestamp of the index-th oldest sample (lets bisect search the ring in time order)"""
+        return self.times[self._slot(index)]
+
+    def value_at(self, index):
+        return self.values[self._slot(index)]
+
+    def span(self, start=None, end=None):
+        """Index range [lo, hi) of samples with start <= t <= end"""
+        lo = 0 if start is None else bisect.bisect_left(self, start)
+        hi = len(self) if end is None else bisect.bisect_right(self, end)
+        return lo, hi
+
+    def latest(self):
+        if not len(self):
+            return None
+        return self[len(self) - 1], self.value_at(len(self) - 1)
+
+def _numeric_fields(payload, prefix=""):
+    """Flatten numeric fields one level deep: {"rssi": -60, "mem": {"heap": 1}} -> rssi, mem.heap
+
+    Numbers a float32 sample cannot hold (NaN/Infinity literals, 1e400, huge ints)
+    come out with value None so the caller can count and skip them.
+    """
+    for key, value in payload.items():
+        if not prefix and key in SKIP_FIELDS:
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            try:
+                value = float(value)
+            except OverflowError:
+                value = None
+            if value is not None and not (math.isfinite(value) and abs(value) <= FLOAT32_MAX):
+                value = None
+            yield name, value
+        elif isinstance(value, dict) and not prefix:
+            yield from _numeric_fields(value, f"{name}.")
+
+class TelemetryStore:
+    """Telemetry for the whole fleet - memory is bounded by devices x metrics x samples x 8 bytes"""
+
+    def __init__(self, samples=DEFAULT_SAMPLES, max_metrics=MAX_METRICS_PER_DEVICE, max_devices=MAX_DEVICES):
+        self.samples = samples
+        self.max_metrics = max_metrics
+        self.max_devices = max_devices
+        self.devices = OrderedDict()  # device_id -> {metric: MetricRing}, least recently reporting first
+        self.lock = threading.Lock()
+        self.stats = {"samples": 0, "dropped_metrics": 0, "non_finite": 0, "evicted_devices": 0}
+
+    def record(self, device_id, payload, now=None):
+        """Append every numeric field of a telemetry payload - returns the metric names stored"""
+        timestamp = int(time.time() if now is None else now)
+        stored = []
+        with self.lock:
+            metrics = self.devices.get(device_id)
+            if metrics is None:
+                metrics = self.devices[device_id] = {}
+                if len(self.devices) > self.max_devices:
+                    self.devices.popitem(last=False)
+                    self.stats["evicted_devices"] += 1
+            else:
+                self.devices.move_to_end(device_id)
+
+            for name, value in _numeric_fields(payload):
+                if value is None:
+                    self.stats["non_finite"] += 1
+                    continue
+                ring = metrics.get(name)
+                if ring is None:
+                    if len(metrics) >= self.max_metrics:
+                        self.stats["dropped_metrics"] += 1
+                        continue
+                    ring = metrics[name] = MetricRing(self.samples)
+                ring.append(timestamp, value)
+                stored.append(name)
+            self.stats["samples"] += len(stored)
+        return stored
+
+    def metrics(self, device_id):
+        """{metric: {"latest", "at", "samples"}} for one device"""
+        with self.lock:
+            summary = {}
+            for name, ring in (self.devices.get(device_id) or {}).items():
+                at, value = ring.latest()
+                summary[name] = {"latest": _f32(value), "at": at, "samples": len(ring)}
+            return summary
+
+    def query(self, device_id, metric, start=None, end=None, bucket=None):
+        """Samples in [start, end] - raw points, or min/max/avg per bucket-second window"""
+        with self.lock:
+            ring = (self.devices.get(device_id) or {}).get(metric)
+            if ring is None:
+                return None
+            lo, hi = ring.span(start, end)
+
+            if not bucket:
+                lo = max(lo, hi - MAX_RAW_POINTS)
+                return [{"t": ring[i], "value": _f32(ring.value_at(i))} for i in range(lo, hi)]
+
+            buckets = []
+            current = None
+            for i in range(lo, hi):
+                timestamp = ring[i]
+                value = ring.value_at(i)
+                bucket_start = timestamp - timestamp % bucket
+                if current is None or current["t"] != bucket_start:
+                    current = {"t": bucket_start, "min": value, "max": value, "sum": value, "count": 1}
+                    buckets.append(current)
+                    continue
+                if value < current["min"]:
+                    current["min"] = value
+                if value > current["max"]:
+                    current["max"] = value
+                current["sum"] += value
+                current["count"] += 1
+            for entry in buckets:
+                entry["avg"] = _f32(entry.pop("sum") / entry["count"])
+                entry["min"] = _f32(entry["min"])
+                entry["max"] = _f32(entry["max"])
+            return buckets
+
+    def drop(self, device_id):
+        with self.lock:
+            self.devices.pop(device_id, None)
+
+    def describe(self):
+        with self.lock:
+            rings = sum(len(metrics) for metrics in self.devices.values())
+            stored = sum(len(ring) for metrics in self.devices.values() for ring in metrics.values())
+        return dict(self.stats,
+                    devices=len(self.devices),
+                    metrics=rings,
+                    samples_per_metric=self.samples,
+                    stored_samples=stored,
+                    sample_bytes=rings * self.samples * BYTES_PER_SAMPLE,
+                    sample_bytes_limit=self.max_devices * self.max_metrics * self.samples * BYTES_PER_SAMPLE)
@@ -0,0 +1,210 @@
+"""
+Scheduled Vends
+Vends held on a timer heap and released into device queues at their due time
+"""
+
+import heapq
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .scheduler import TimerHeap
+
+DEFAULT_MAX_PENDING = 250000   # Scheduled vends waiting at once (about 650 bytes each)
+DEFAULT_MAX_LATE = 300.0       # A vend released later than this (server was down or draining) is skipped
+MAX_BATCH = 10000              # Entries one request may create
+RELEASE_WORKERS = 4            # Pushes block on HTTP - a slow device must not hold up the next due vend
+RECENT_RESULTS = 200
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 5000
+
+PENDING = "pending"
+RELEASED = "released"          # Dispatched like POST /vend (queued, pushed, sent to serial, or simulated)
+FAILED = "failed"              # Due, but no device could take it (offline, circuit open, out of stock)
+MISSED = "missed"              # Due more than max_late ago when the release came round
+CANCELLED = "cancelled"
+
+class ScheduledVend:
+    """One pending vend - device_id None means "any device with stock", chosen at release time"""
+
+    __slots__ = ("schedule_id", "batch_id", "device_id", "slot", "due_at", "created_at", "reference", "timer_id")
+
+    def __init__(self, schedule_id, batch_id, device_id, slot, due_at, created_at, reference=None):
+        self.schedule_id = schedule_id
+        self.batch_id = batch_id
+        self.device_id = device_id
+        self.slot = slot
+        self.due_at = due_at
+        self.created_at = created_at
+        self.reference = reference
+        self.timer_id = None
+
+    def to_dict(self):
+        entry = {
+            "schedule_id": self.schedule_id,
+            "batch_id": self.batch_id,
+            "device_id": self.device_id,
+            "slot": self.slot,
+            "due_at": self.due_at,
+            "created_at": self.created_at
+        }
+        if self.reference is not None:
+            entry["reference"] = self.reference
+        return entry
+
+class VendSchedule:
+    """Scheduled vends by id and batch, fired from a TimerHeap and released on a small pool"""
+
+    def __init__(self, release, max_pending=DEFAULT_MAX_PENDING, max_late=DEFAULT_MAX_LATE, workers=RELEASE_WORKERS):
+        self.release = release        # callable(ScheduledVend) -> {"status": RELEASED|FAILED, ...} - runs on the pool
+        self.max_pending = max_pending
+        self.max_late = max_late
+        self.timers = TimerHeap()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vend-release")
+        self.pending = {}             # schedule_id -> ScheduledVend
+        self.by_batch = {}            # batch_id -> set of pending schedule_ids
+        self.recent = deque(maxlen=RECENT_RESULTS)
+        self.lock = threading.Lock()
+        self.stats = {"scheduled": 0, RELEASED: 0, FAILED: 0, MISSED: 0, CANCELLED: 0}
+
+    def add(self, items, reference=None, batch_id=None, created_at=None):
+        """Schedule (due_at, device_id, slot) items as one batch - returns the entries, ValueError if it won't fit"""
+        batch_id = batch_id or f"sched-{uuid.uuid4().hex[:12]}"
+        created_at = time.time() if created_at is None else created_at
+        entries = [ScheduledVend(f"{batch_id}-{index}", batch_id, device_id, slot, float(due_at), created_at, reference)
+                   for index, (due_at, device_id, slot) in enumerate(items, 1)]
+        self._insert(entries)
+        return entries
+
+    def restore(self, saved):
+        """Re-arm entries from a snapshot (ScheduledVend.to_dict() form) - returns how many were restored"""
+        entries = [ScheduledVend(item["schedule_id"], item["batch_id"], item.get("device_id"), item["slot"],
+                                 float(item["due_at"]), item.get("created_at", 0), item.get("reference"))
+                   for item in saved or []]
+        return self._insert([entry for entry in entries if entry.schedule_id not in self.pending])
+
+    def _insert(self, entries):
+        with self.lock:
+            if len(self.pending) + len(entries) > self.max_pending:
+                raise ValueError(f"Schedule is full ({len(self.pending)} of {self.max_pending} pending)")
+            for entry in entries:
+                self.pending[entry.schedule_id] = entry
+                batch = self.by_batch.get(entry.batch_id)
+                if batch is None:
+                    batch = self.by_batch[entry.batch_id] = set()
+                batch.add(entry.schedule_id)
+                entry.timer_id = self.timers.schedule_at(entry.due_at, self._due, entry.schedule_id)
+            self.stats["scheduled"] += len(entries)
+        return len(entries)
+
+    def _detach(self, schedule_id):
+        entry = self.pending.pop(schedule_id, None)
+        if entry is not None:
+            batch = self.by_batch[entry.batch_id]
+            batch.discard(schedule_id)
+            if not batch:
+                del self.by_batch[entry.batch_id]
+        return entry
+
+    def _due(self, schedule_id):
+        with self.lock:
+            entry = self._detach(schedule_id)
+        if entry is not None:
+            self.pool.submit(self._release, entry)
+
+    def _release(self, entry):
+        late = time.time() - entry.due_at
+        if late > self.max_late:
+            result = {"status": MISSED, "error": f"Due {late:.0f}s ago"}
+        else:
+            try:
+                result = self.release(entry)
+            except Exception as e:
+                result = {"status": FAILED, "error": str(e)}
+        self._finish(entry, result)
+
+    def _finish(self, entry, result):
+        result = dict(entry.to_dict(), finished_at=time.time(), **result)
+        return self._record(result)
+
+    def _record(self, result, count=1):
+        with self.lock:
+            self.stats[result["status"]] = self.stats.get(result["status"], 0) + count
+            self.recent.append(result)
+        return result
+
+    def cancel(self, schedule_id):
+        """Cancel one pending vend - returns its final record, or None if it already fired or never existed"""
+        with self.lock:
+            entry = self._detach(schedule_id)
+        if entry is None:
+            return None
+        self.timers.cancel(entry.timer_id)
+        return self._finish(entry, {"status": CANCELLED})
+
+    def cancel_batch(self, batch_id):
+        """Cancel every pending vend of a batch - returns one summary record, or None if nothing was pending
+
+        A batch can hold MAX_BATCH entries, so it goes into recent as a single record rather than one per vend.
+        """
+        with self.lock:
+            entries = [self._detach(schedule_id) for schedule_id in list(self.by_batch.get(batch_id, ()))]
+        if not entries:
+            return None
+        for entry in entries:
+            self.timers.cancel(entry.timer_id)
+        result = {
+            "batch_id": batch_id,
+            "status": CANCELLED,
+            "cancelled": len(entries),
+            "first_due": min(entry.due_at for entry in entries),
+            "last_due": max(entry.due_at for entry in entries),
+            "finished_at": time.time()
+        }
+        if entries[0].reference is not None:
+            result["reference"] = entries[0].reference
+        return self._record(result, len(entries))
+
+    def list(self, device_id=None, batch_id=None, limit=DEFAULT_LIMIT):
+        """Pending vends due soonest, optionally for one device or batch"""
+        limit = max(0, min(int(limit), MAX_LIMIT))
+        with self.lock:
+            if batch_id is not None:
+                candidates = [self.pending[schedule_id] for schedule_id in self.by_batch.get(batch_id, ())]
+            else:
+                candidates = self.pending.values()
+            if device_id is not None:
+                candidates = [entry for entry in candidates if entry.device_id == device_id]
+            soonest = heapq.nsmallest(limit, candidates, key=lambda entry: entry.due_at)
+        return [dict(entry.to_dict(), status=PENDING) for entry in soonest]
+
+    def pending_entries(self):
+        """Every pending vend, for the drain snapshot"""
+        with self.lock:
+            return [entry.to_dict() for entry in self.pending.values()]
+
+    def __len__(self):
+        return len(self.pending)
+
+    def start(self):
+        self.timers.start("vend-schedule")
+        return self
+
+    def stop(self):
+        """Stop releasing - pending vends stay put (and go into the drain snapshot)"""
+        self.timers.stop()
+
+    def describe(self):
+        with self.lock:
+            recent = list(self.recent)
+            pending = len(self.pending)
+            batches = len(self.by_batch)
+        return dict(self.stats,
+                    pending=pending,
+                    batches=batches,
+                    next_due=self.timers.next_due(),
+                    max_pending=self.max_pending,
+                    max_late=self.max_late,
+                    recent=recent[::-1])